@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+measure the throughput and per packet latency of the mix data path:
+
+  forward_message   a client wrapping a message in a forward sphinx packet
+  unwrap            MixProtocol.received unwrapping a packet for its next hop
+  threshold release ThresholdMixNode admitting and releasing a batch
+  cascade           a packet crossing every hop of a cascade of
+                    ThresholdMixNodes and being decrypted by its client
+
+for each of the given sphinx parameters. keys and packets come from a
+seeded ChaCha20 stream and nodes talk over an in-memory network on a
+task.Clock, so runs differ only in timing. results can be saved as JSON
+and compared against a baseline saved at another commit, in which case
+the exit status is 1 if any benchmark's throughput fell by more than
+the threshold.
+"""
+
+from __future__ import print_function
+
+import sys
+import argparse
+
+from twisted.internet.task import Clock
+
+from sphinxmixcrypto import SphinxParams, SphinxPacket, PacketReplayCacheDict
+
+from txmix import MixProtocol, ThresholdMixNode, DummyPKI, MixKeyState, configure_packet_logging
+from txmix.client import ClientProtocol
+from txmix.instrumentation import PACKET_LOGGING_MODES, SAMPLED
+from txmix.utils import generate_node_id, generate_node_keypair
+
+from harness import ChachaNoiseReader, MemoryNetwork, time_each
+from harness import save_results, load_results, compare_results, print_result, print_comparison
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+
+SEED = "47ade5905376604cde0b57e732936b4298281c8a67b6a62c6107482eb69e2941"
+MESSAGE = b"the quick brown fox jumps over the lazy dog"
+
+
+class Mixnet(object):
+    """
+    i am a set of mix node keys, each with an address on a
+    MemoryNetwork, and the DummyPKI they are registered in
+    """
+
+    def __init__(self, params, node_count, rand_reader):
+        self.params = params
+        self.rand_reader = rand_reader
+        self.pki = DummyPKI()
+        self.network = MemoryNetwork()
+        self.node_ids = []
+        self.key_states = {}
+        self.addrs = {}
+        for addr in range(node_count):
+            node_id = generate_node_id(rand_reader)
+            public_key, private_key = generate_node_keypair(rand_reader)
+            self.node_ids.append(node_id)
+            self.key_states[node_id] = MixKeyState(public_key, private_key)
+            self.addrs[node_id] = addr
+
+    def register(self):
+        """
+        register every node in the pki, for nodes which are not started
+        """
+        for node_id in self.node_ids:
+            self.pki.set(node_id, self.key_states[node_id].get_public_key(), self.addrs[node_id])
+
+    def forward_packets(self, route, count):
+        return [SphinxPacket.forward_message(self.params, route, self.pki, route[-1], MESSAGE, self.rand_reader).get_raw_bytes()
+                for _ in range(count)]
+
+    def protocol(self, node_id, handler):
+        protocol = MixProtocol(PacketReplayCacheDict(), self.key_states[node_id], self.params, self.pki,
+                               packet_received_handler=handler)
+        protocol.make_connection(self.network.transport(self.addrs[node_id]))
+        return protocol
+
+
+def bench_forward_message(params, packets, hops):
+    mixnet = Mixnet(params, hops, ChachaNoiseReader(SEED))
+    mixnet.register()
+    route = mixnet.node_ids
+
+    def forward_message(_):
+        SphinxPacket.forward_message(params, route, mixnet.pki, route[-1], MESSAGE, mixnet.rand_reader).get_raw_bytes()
+    return time_each(forward_message, range(packets))
+
+
+def unwrap_packets(params, packets):
+    """
+    return the time taken to unwrap each of packets for its next hop,
+    the mixnet and the unwrapped messages
+    """
+    mixnet = Mixnet(params, 2, ChachaNoiseReader(SEED))
+    mixnet.register()
+    raw_packets = mixnet.forward_packets(mixnet.node_ids, packets)
+    unwrapped = []
+    protocol = mixnet.protocol(mixnet.node_ids[0], lambda x: unwrapped.append(x))
+    result = time_each(protocol.received, raw_packets)
+    assert len(unwrapped) == packets and all(x.next_hop for x in unwrapped)
+    return result, mixnet, unwrapped
+
+
+def bench_threshold_release(params, mixnet, unwrapped, threshold_count):
+    clock = Clock()
+    # the last node receives every released packet and does nothing with them
+    sink = mixnet.network.transport(mixnet.addrs[mixnet.node_ids[-1]])
+    sink.register_protocol(type("Sink", (object,), {"received": lambda self, message: None})())
+    node_id = generate_node_id(mixnet.rand_reader)
+    public_key, private_key = generate_node_keypair(mixnet.rand_reader)
+    mix = ThresholdMixNode(threshold_count, node_id, PacketReplayCacheDict(), MixKeyState(public_key, private_key),
+                           params, mixnet.pki, mixnet.network.transport("threshold"), clock, max_delay=0)
+    mix.start()
+    batches = [unwrapped[i:i + threshold_count] for i in range(0, len(unwrapped) - threshold_count + 1, threshold_count)]
+
+    def release(batch):
+        mix.messages_received(batch)
+        clock.advance(0)
+    result = time_each(release, batches, threshold_count)
+    assert mix.transport.sent == len(batches) * threshold_count
+    return result
+
+
+def bench_cascade(params, packets, hops):
+    rand_reader = ChachaNoiseReader(SEED)
+    mixnet = Mixnet(params, hops, rand_reader)
+    clock = Clock()
+    for node_id in mixnet.node_ids:
+        mix = ThresholdMixNode(1, node_id, PacketReplayCacheDict(), mixnet.key_states[node_id], params,
+                               mixnet.pki, mixnet.network.transport(mixnet.addrs[node_id]), clock, max_delay=0)
+        mix.start()
+
+    received = []
+    client = ClientProtocol(params, mixnet.pki, b"\x00" * 16, rand_reader,
+                            packet_received_handler=lambda x: received.append(x), reactor=clock)
+    client.make_connection(mixnet.network.transport("client"))
+    mixnet.pki.set_client_addr("memory", client.client_id, "client")
+    raw_packets = [client.create_reply_block(mixnet.node_ids).compose_forward_message(params, MESSAGE).get_raw_bytes()
+                   for _ in range(packets)]
+    first_hop = mixnet.addrs[mixnet.node_ids[0]]
+
+    def cross_cascade(raw_packet):
+        expected = len(received) + 1
+        mixnet.network.deliver(first_hop, raw_packet)
+        while len(received) < expected:
+            clock.advance(0)
+    result = time_each(cross_cascade, raw_packets)
+    assert received[-1].payload.startswith(MESSAGE)
+    return result
+
+
+def parse_params(value):
+    params = []
+    for pair in value.split(","):
+        max_hops, payload_size = pair.split(":")
+        params.append((int(max_hops), int(payload_size)))
+    return params
+
+
+def run(params_list, packets, hops, threshold_count):
+    results = {}
+    for max_hops, payload_size in params_list:
+        params = SphinxParams(max_hops, payload_size)
+        cascade_hops = min(hops, max_hops)
+        suffix = " %dx%d" % (max_hops, payload_size)
+        results["forward_message" + suffix] = bench_forward_message(params, packets, cascade_hops)
+        results["unwrap" + suffix], mixnet, unwrapped = unwrap_packets(params, packets)
+        results["threshold release" + suffix] = bench_threshold_release(params, mixnet, unwrapped, threshold_count)
+        results["cascade %d hops%s" % (cascade_hops, suffix)] = bench_cascade(params, packets, cascade_hops)
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--params", type=parse_params, default=parse_params("5:1024,5:4096,10:1024"),
+                        help="comma separated max_hops:payload_size sphinx parameters")
+    parser.add_argument("--packets", type=int, default=500, help="packets per benchmark")
+    parser.add_argument("--hops", type=int, default=3, help="hops in the cascade and forward_message routes")
+    parser.add_argument("--threshold-count", type=int, default=50, help="threshold mix batch size")
+    parser.add_argument("--packet-logging", choices=PACKET_LOGGING_MODES, default=SAMPLED,
+                        help="packet logging mode of the mix nodes")
+    parser.add_argument("--output", help="save the results as JSON to this file")
+    parser.add_argument("--compare", help="compare the results against those saved in this JSON file")
+    parser.add_argument("--regression-threshold", type=float, default=0.1,
+                        help="fall in throughput reported as a regression")
+    args = parser.parse_args(argv)
+    if args.packets < args.threshold_count:
+        parser.error("--packets must be at least --threshold-count")
+
+    configure_packet_logging(args.packet_logging)
+    results = run(args.params, args.packets, args.hops, args.threshold_count)
+    for name in sorted(results):
+        print_result(name, results[name])
+    if args.output:
+        save_results(args.output, results)
+    if args.compare:
+        print()
+        comparison = compare_results(load_results(args.compare), results, args.regression_threshold)
+        print_comparison(comparison)
+        if any(regressed for _, _, _, _, regressed in comparison):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+compare EntropyReader, which calls os.urandom for every read, with
+BufferedEntropyReader, which serves reads from blocks of ChaCha20
+keystream.
+
+reports the time per read for several read sizes and the time taken
+by the reads a client makes most: building random routes through a
+large pki, generating keypairs and creating reply block message IDs.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+import argparse
+
+from sphinxmixcrypto import SphinxParams, SECURITY_PARAMETER
+
+from txmix import EntropyReader, BufferedEntropyReader, RandomRouteFactory, DummyPKI
+from txmix.utils import generate_node_keypair
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+
+def time_per_call(function, number):
+    return min(timeit.repeat(function, number=number, repeat=3)) / number
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reads", type=int, default=100000, help="reads per measurement")
+    parser.add_argument("--mixes", type=int, default=1000, help="mixes in the pki routes are built from")
+    args = parser.parse_args(argv)
+
+    readers = (("EntropyReader", EntropyReader()), ("BufferedEntropyReader", BufferedEntropyReader()))
+    pki = DummyPKI()
+    for i in range(args.mixes):
+        pki.set(os.urandom(16), b"\x00" * 32, i)
+    params = SphinxParams(5, 1024)
+
+    print("%-24s %12s %12s %8s" % ("", readers[0][0], readers[1][0], "speedup"))
+    rows = [("read(%d)" % n, args.reads, lambda reader, n=n: reader.read(n)) for n in (4, 8, 16, 32, 256, 4096)]
+    rows.extend([
+        ("message ID", args.reads, lambda reader: reader.read(SECURITY_PARAMETER)),
+        ("generate_node_keypair", args.reads // 10, lambda reader: generate_node_keypair(reader)),
+        ("random route", 100, lambda reader: RandomRouteFactory(params, pki, reader).build_route()),
+    ])
+    for name, number, operation in rows:
+        times = [time_per_call(lambda: operation(reader), number) for _, reader in readers]
+        print("%-24s %9.2f us %9.2f us %7.1fx" % (name, times[0] * 1e6, times[1] * 1e6, times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+count the buffers a mix allocates to forward one packet, from
+MixProtocol.received to the transport's write, when the transport
+gathers a packet's parts itself and when they have to be joined for it:
+
+  next hop    a packet unwrapped and sent on to the next mix
+  client hop  a reply unwrapped and sent to its client
+
+for every packet the allocations traced by tracemalloc are cleared
+as it arrives and a snapshot is taken when it reaches the transport.
+the figures are the buffers of at least --min-size bytes allocated
+for the packet and still alive at that point, the bytes they hold,
+and the peak traced memory while forwarding it.
+
+tracemalloc needs python 3.4 or later. on older pythons the byte
+strings and bytearrays of at least --min-size bytes which objects
+tracked by the garbage collector refer to, including the frames
+of the calls forwarding the packet, are collected as it arrives
+and again when it reaches the transport, and those which are new
+are counted. buffers only held by untracked objects are missed and
+there is no peak, so run this on python 3 for the full figures:
+
+  python3 bench/bench_forwarding_allocations.py
+
+the "gather" transport is given a packet's parts like a UDPTransport
+using sendmmsg, or sendmsg on python 3, and the "join" transport is
+given them joined like a UDPTransport on python 2 without batch_io.
+"""
+
+from __future__ import print_function
+
+import gc
+import sys
+import argparse
+
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from sphinxmixcrypto import SphinxParams, PacketReplayCacheDict
+
+from txmix import IMixTransport, IGatherTransport, MixProtocol, configure_packet_logging
+from txmix.client import ClientProtocol
+from txmix.instrumentation import OFF
+
+from harness import ChachaNoiseReader, time_each
+from bench_datapath import Mixnet, SEED, MESSAGE
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+
+def live_buffers(min_size):
+    """
+    return a dict of the byte strings and bytearrays of at least
+    min_size bytes referred to by objects the garbage collector
+    tracks, by their id
+    """
+    buffers = {}
+    for referent in gc.get_referents(*gc.get_objects()):
+        if isinstance(referent, (bytes, bytearray)) and len(referent) >= min_size:
+            buffers[id(referent)] = referent
+    return buffers
+
+
+@implementer(IMixTransport)
+class CountingTransport(object):
+    """
+    i am a transport which sends nothing. with counting set i take a
+    tracemalloc snapshot of every message i am given and record the
+    number and size of its traced buffers of at least min_size bytes.
+    without tracemalloc i count the live buffers which are not in
+    baseline instead.
+    """
+    name = "counting"
+
+    def __init__(self, min_size):
+        self.min_size = min_size
+        self.counting = False
+        self.counts = []
+        self.baseline = {}
+
+    def register_protocol(self, protocol):
+        pass
+
+    def start(self):
+        return defer.succeed(None)
+
+    def send(self, addr, message):
+        self._count()
+        return defer.succeed(None)
+
+    def _count(self):
+        if not self.counting:
+            return
+        if tracemalloc is None:
+            sizes = [sys.getsizeof(buffer) for key, buffer in live_buffers(self.min_size).items()
+                     if key not in self.baseline]
+            self.counts.append((len(sizes), sum(sizes)))
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+        sizes = [trace.size for trace in snapshot.traces if trace.size >= self.min_size]
+        self.counts.append((len(sizes), sum(sizes)))
+
+
+@implementer(IGatherTransport)
+class GatheringCountingTransport(CountingTransport):
+    """
+    i am a CountingTransport which is given the parts of a message
+    """
+
+    def send_parts(self, addr, parts):
+        self._count()
+        return defer.succeed(None)
+
+
+def next_hop_packets(params, packets):
+    mixnet = Mixnet(params, 2, ChachaNoiseReader(SEED))
+    mixnet.register()
+    return mixnet, mixnet.forward_packets(mixnet.node_ids, packets)
+
+
+def client_hop_packets(params, packets):
+    rand_reader = ChachaNoiseReader(SEED)
+    mixnet = Mixnet(params, 1, rand_reader)
+    mixnet.register()
+    client = ClientProtocol(params, mixnet.pki, b"\x00" * 16, rand_reader, lambda x: None, reactor=Clock())
+    client.make_connection(CountingTransport(0))
+    mixnet.pki.set_client_addr(CountingTransport.name, client.client_id, "client")
+    return mixnet, [client.create_reply_block(mixnet.node_ids).compose_forward_message(params, MESSAGE).get_raw_bytes()
+                    for _ in range(packets)]
+
+
+def forward(mixnet, raw_packets, transport):
+    """
+    forward every packet through the first mix of mixnet onto transport,
+    returns the timings and a list of (buffers, bytes, peak bytes)
+    3-tuples, one per packet, whose peak is None without tracemalloc
+    """
+    protocol = MixProtocol(PacketReplayCacheDict(), mixnet.key_states[mixnet.node_ids[0]], mixnet.params,
+                           mixnet.pki, packet_received_handler=lambda x: protocol.packet_proxy(x))
+    protocol.make_connection(transport)
+    timing = time_each(protocol.received, raw_packets[:len(raw_packets) // 2])
+    protocol.replay_cache = PacketReplayCacheDict()
+    peaks = []
+    if tracemalloc is not None:
+        tracemalloc.start()
+    transport.counting = True
+    try:
+        for raw_packet in raw_packets[len(raw_packets) // 2:]:
+            if tracemalloc is None:
+                transport.baseline = live_buffers(transport.min_size)
+                protocol.received(raw_packet)
+                peaks.append(None)
+                continue
+            tracemalloc.clear_traces()
+            protocol.received(raw_packet)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+    finally:
+        transport.counting = False
+        transport.baseline = {}
+        if tracemalloc is not None:
+            tracemalloc.stop()
+    assert len(transport.counts) == len(peaks)
+    return timing, [(buffers, size, peak) for (buffers, size), peak in zip(transport.counts, peaks)]
+
+
+def mean(values):
+    return float(sum(values)) / len(values)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packets", type=int, default=400, help="packets per case, half timed and half counted")
+    parser.add_argument("--hops", type=int, default=5, help="sphinx max hops")
+    parser.add_argument("--payload-size", type=int, default=1024, help="sphinx payload size")
+    parser.add_argument("--min-size", type=int, default=256, help="smallest buffer counted, in bytes")
+    args = parser.parse_args(argv)
+
+    configure_packet_logging(OFF)
+    params = SphinxParams(args.hops, args.payload_size)
+    print("%-11s %-9s %9s %9s %11s %11s" % ("", "transport", "buffers", "bytes", "peak bytes", "us/packet"))
+    for case, build_packets in (("next hop", next_hop_packets), ("client hop", client_hop_packets)):
+        for transport_name, transport_class in (("gather", GatheringCountingTransport), ("join", CountingTransport)):
+            mixnet, raw_packets = build_packets(params, args.packets)
+            timing, counts = forward(mixnet, raw_packets, transport_class(args.min_size))
+            buffers, size, peaks = zip(*counts)
+            figures = ("%.1f" % mean(buffers), "%.1f" % mean(size), "n/a" if None in peaks else "%.1f" % mean(peaks))
+            row = (case, transport_name) + figures + (timing["latency_us"]["mean"],)
+            print("%-11s %-9s %9s %9s %11s %11.1f" % row)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
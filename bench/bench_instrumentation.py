@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+measure the per packet cost of eliot logging in each packet
+logging mode.
+
+sphinx packets are unwrapped by a MixProtocol and proxied to an
+in-memory transport while eliot writes every message to a destination
+which serializes it to json and discards it. the cost of a mode is
+its time per packet less that of the off mode.
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import argparse
+
+from eliot import add_destination
+from zope.interface import implementer
+from twisted.internet import defer
+
+from sphinxmixcrypto import SphinxParams, SphinxPacket, PacketReplayCacheDict
+
+from txmix import MixProtocol, DummyPKI, EntropyReader, MixKeyState, IMixTransport
+from txmix import generate_node_id, generate_node_keypair, configure_packet_logging
+from txmix.instrumentation import FULL, SAMPLED, OFF
+
+
+@implementer(IMixTransport)
+class NullTransport(object):
+    name = "null"
+    addr = None
+
+    def register_protocol(self, protocol):
+        self.protocol = protocol
+
+    def start(self):
+        return defer.succeed(None)
+
+    def send(self, addr, message):
+        return defer.succeed(None)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--packets", type=int, default=2000, help="packets unwrapped per mode")
+    parser.add_argument("--sample-every", type=int, default=100, help="sampling interval of the sampled mode")
+    args = parser.parse_args(argv)
+
+    add_destination(lambda message: json.dumps(message))
+    params = SphinxParams(5, 1024)
+    pki = DummyPKI()
+    rand_reader = EntropyReader()
+    key_states = {}
+    for i in range(3):
+        node_id = generate_node_id(rand_reader)
+        public_key, private_key = generate_node_keypair(rand_reader)
+        pki.set(node_id, public_key, i)
+        key_states[node_id] = MixKeyState(public_key, private_key)
+    route = list(pki.identities())
+    raw_packets = [SphinxPacket.forward_message(params, route, pki, route[-1], b"ping", rand_reader).get_raw_bytes()
+                   for _ in range(args.packets)]
+
+    def run(mode):
+        configure_packet_logging(mode, args.sample_every)
+        protocol = MixProtocol(PacketReplayCacheDict(), key_states[route[0]], params, pki,
+                               packet_received_handler=lambda x: protocol.packet_proxy(x))
+        protocol.make_connection(NullTransport())
+        start = time.time()
+        for raw_packet in raw_packets:
+            protocol.received(raw_packet)
+        return (time.time() - start) / args.packets
+
+    results = {}
+    # the best of a few rounds hides warm up and noise
+    for _ in range(3):
+        for mode in (OFF, SAMPLED, FULL):
+            results[mode] = min(results.get(mode, float("inf")), run(mode))
+    for mode in (OFF, SAMPLED, FULL):
+        print("%-8s %8.1f us per packet  %8.1f us logging overhead" % (
+            mode, results[mode] * 1e6, (results[mode] - results[OFF]) * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+measure the memory used per million replay tags by
+PacketReplayCacheDict and txmix's ReplayTagTable, and the
+time taken to load a large MmapReplayCache file.
+
+each cache is filled in a fresh child process and the growth
+of that process's resident set size is reported.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import struct
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+
+from sphinxmixcrypto import PacketReplayCacheDict
+
+from txmix.replay_cache import ReplayTagTable, MmapReplayCache
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+
+def rss_bytes():
+    """
+    return the resident set size of this process on linux
+    """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def fill(cache_name, tag_count, queue):
+    before = rss_bytes()
+    if cache_name == "dict":
+        cache = PacketReplayCacheDict()
+    else:
+        cache = ReplayTagTable(tag_count)
+    for i in range(tag_count):
+        cache.set_seen(hashlib.sha256(struct.pack("<Q", i)).digest())
+    queue.put(rss_bytes() - before)
+
+
+def measure(cache_name, tag_count):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=fill, args=(cache_name, tag_count, queue))
+    process.start()
+    used = queue.get()
+    process.join()
+    return used
+
+
+def measure_mmap_load(capacity, lookups=1000):
+    """
+    return the seconds taken to open a replay cache file
+    sized for capacity tags and to look up some tags in it
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "replay.cache")
+        cache = MmapReplayCache(path, capacity)
+        cache.test_and_set([hashlib.sha256(struct.pack("<Q", i)).digest() for i in range(lookups)])
+        cache.close()
+        start = time.time()
+        cache = MmapReplayCache(path, capacity)
+        for i in range(lookups):
+            assert cache.has_seen(hashlib.sha256(struct.pack("<Q", i)).digest())
+        elapsed = time.time() - start
+        cache.close()
+        return elapsed
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tags", type=int, default=1000000, help="number of tags to insert")
+    parser.add_argument("--mmap-capacity", type=int, default=50000000, help="capacity of the replay cache file to load")
+    args = parser.parse_args(argv)
+    for cache_name in ("dict", "table"):
+        used = measure(cache_name, args.tags)
+        per_million = used * 1000000.0 / args.tags
+        print("%-6s %10d tags  %8.1f MiB per million tags  %6.1f bytes per tag" % (
+            cache_name, args.tags, per_million / (1 << 20), float(used) / args.tags))
+    elapsed = measure_mmap_load(args.mmap_capacity)
+    print("mmap   %10d capacity %8.3f seconds to load and look up 1000 tags" % (args.mmap_capacity, elapsed))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
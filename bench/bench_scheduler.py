@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+compare ContinuousTimeMixNode's delayed sends using one reactor
+timer per message with its TimerWheel.
+
+each approach schedules a number of messages with random delays up
+to max_delay on an unstarted reactor whose clock is advanced by hand.
+it is run in a fresh child process and reports the growth of that
+process's resident set size per pending message and the cpu time
+spent scheduling and then releasing every message.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.internet.selectreactor import SelectReactor
+
+from sphinxmixcrypto import SphinxParams, SphinxPacket, PacketReplayCacheDict, UnwrappedMessage
+
+from txmix import ContinuousTimeMixNode, DummyPKI, MixKeyState, IMixTransport
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+@implementer(IMixTransport)
+class CountingTransport(object):
+    name = "counting"
+    addr = ("127.0.0.1", 0)
+
+    def __init__(self):
+        self.sent = 0
+
+    def register_protocol(self, protocol):
+        self.protocol = protocol
+
+    def start(self):
+        return defer.succeed(None)
+
+    def send(self, addr, message):
+        self.sent += 1
+        return defer.succeed(None)
+
+
+def run(timer_wheel_tick, message_count, max_delay, queue):
+    now = [0.0]
+    reactor = SelectReactor()
+    reactor.seconds = lambda: now[0]
+    params = SphinxParams(5, 1024)
+    pki = DummyPKI()
+    destination = b"\xff" * 16
+    pki.set(destination, b"\x00" * 32, ("127.0.0.1", 1))
+    transport = CountingTransport()
+    mix = ContinuousTimeMixNode(b"\xfe" * 16, max_delay, transport, PacketReplayCacheDict(),
+                                MixKeyState(b"\x01" * 32, b"\x02" * 32), params, pki, reactor,
+                                timer_wheel_tick=timer_wheel_tick)
+    mix.start()
+    sphinx_packet = SphinxPacket.from_raw_bytes(params, b"\x00" * sum(params.get_dimensions()))
+    message = UnwrappedMessage(next_hop=(destination, sphinx_packet), exit_hop=None, client_hop=None)
+
+    before = rss_bytes()
+    start = time.clock()
+    for _ in range(message_count):
+        mix.message_received(message)
+    schedule_time = time.clock() - start
+    used = rss_bytes() - before
+
+    start = time.clock()
+    while transport.sent < message_count:
+        now[0] += 1.0
+        reactor.runUntilCurrent()
+    release_time = time.clock() - start
+    queue.put((used, schedule_time, release_time))
+
+
+def measure(timer_wheel_tick, message_count, max_delay):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run, args=(timer_wheel_tick, message_count, max_delay, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200000, help="number of pending messages")
+    parser.add_argument("--max-delay", type=int, default=600, help="maximum delay in seconds")
+    parser.add_argument("--tick", type=float, default=1.0, help="timer wheel tick in seconds")
+    args = parser.parse_args(argv)
+    for name, tick in (("deferLater", None), ("timer wheel", args.tick)):
+        used, schedule_time, release_time = measure(tick, args.messages, args.max_delay)
+        print("%-12s %8d pending  %7.1f bytes per message  schedule %6.2f us  release %6.2f us per message" % (
+            name, args.messages, float(used) / args.messages,
+            schedule_time * 1e6 / args.messages, release_time * 1e6 / args.messages))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+simulate a mix network in one process on a SimulatedNetwork and
+report the end to end latency of its messages, the most messages its
+mixes held at once and how much faster than real time it ran.
+
+clients send messages to each other at random, as a poisson process
+of the given rate per client, over free routes through the mixes.
+each message is sent with a reply block of its recipient so that it
+is delivered to, and decrypted by, a client. every link has the same
+latency, jitter, bandwidth and loss.
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import struct
+import random
+import argparse
+
+from twisted.internet.task import Clock, LoopingCall
+
+from sphinxmixcrypto import SphinxParams, PacketReplayCacheDict
+
+from txmix import ThresholdMixNode, ContinuousTimeMixNode, StopAndGoMixNode, MixClient, SampledRouteFactory
+from txmix import DummyPKI, MixKeyState, configure_packet_logging
+from txmix.instrumentation import OFF
+from txmix.simulation import SimulatedNetwork, Link
+from txmix.utils import generate_node_id, generate_node_keypair
+
+from harness import ChachaNoiseReader, percentile, run_metadata
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+
+SEED = "47ade5905376604cde0b57e732936b4298281c8a67b6a62c6107482eb69e2941"
+TIMESTAMP = struct.Struct("!d")
+MIX_TYPES = ("continuous", "threshold", "stop-and-go")
+
+
+def build_mix(mix_type, args, node_id, key_state, params, pki, transport, clock):
+    if mix_type == "continuous":
+        return ContinuousTimeMixNode(node_id, args.max_delay, transport, PacketReplayCacheDict(), key_state,
+                                     params, pki, clock, timer_wheel_tick=1)
+    if mix_type == "threshold":
+        return ThresholdMixNode(args.threshold_count, node_id, PacketReplayCacheDict(), key_state, params, pki,
+                                transport, clock, max_delay=args.max_delay)
+    return StopAndGoMixNode(node_id, args.max_delay / 2.0, transport, PacketReplayCacheDict(), key_state,
+                            params, pki, clock)
+
+
+def simulate(args):
+    clock = Clock()
+    rand = random.Random(args.seed)
+    rand_reader = ChachaNoiseReader(SEED)
+    params = SphinxParams(args.hops, args.payload_size)
+    pki = DummyPKI()
+    network = SimulatedNetwork(clock, Link(args.latency, args.jitter, args.bandwidth, args.loss), args.seed)
+
+    mixes = []
+    for i in range(args.mixes):
+        public_key, private_key = generate_node_keypair(rand_reader)
+        mix = build_mix(args.mix_type, args, generate_node_id(rand_reader), MixKeyState(public_key, private_key),
+                        params, pki, network.transport(("mix", i)), clock)
+        mix.start()
+        mixes.append(mix)
+
+    route_factory = SampledRouteFactory(params, pki, rand_reader)
+    latencies = []
+
+    def received(message):
+        latencies.append(clock.seconds() - TIMESTAMP.unpack(message.payload[:TIMESTAMP.size])[0])
+
+    clients = []
+    for i in range(args.clients):
+        client = MixClient(params, pki, b"%016d" % i, rand_reader, network.transport(("client", i)),
+                           lambda x: received(x), route_factory, clock)
+        client.start()
+        clients.append(client)
+
+    total_rate = args.clients * args.rate / 3600.0
+    sent = [0]
+    send_call = [None]
+
+    def send_next():
+        sender, recipient = rand.sample(clients, 2)
+        sender.reply(recipient.create_reply_block(), TIMESTAMP.pack(clock.seconds()))
+        sent[0] += 1
+        send_call[0] = clock.callLater(rand.expovariate(total_rate), send_next)
+    send_call[0] = clock.callLater(rand.expovariate(total_rate), send_next)
+
+    peak_queued = [0]
+
+    def sample_queues():
+        peak_queued[0] = max(peak_queued[0], sum(len(mix.admission_queue) for mix in mixes))
+    sampler = LoopingCall(sample_queues)
+    sampler.clock = clock
+    sampler.start(1.0)
+
+    duration = args.hours * 3600
+    start = time.time()
+    network.run_until(duration)
+    send_call[0].cancel()
+    sampler.stop()
+    # let the messages in flight arrive
+    network.run_until(duration + 10 * args.max_delay + 60)
+    wall_time = time.time() - start
+
+    latencies.sort()
+    return {
+        "mixes": args.mixes,
+        "clients": args.clients,
+        "mix_type": args.mix_type,
+        "virtual_seconds": duration,
+        "wall_seconds": wall_time,
+        "speedup": duration / wall_time,
+        "messages_sent": sent[0],
+        "messages_received": len(latencies),
+        "datagrams_lost": network.lost,
+        "peak_queued_messages": peak_queued[0],
+        "peak_queued_bytes": peak_queued[0] * params.get_sphinx_forward_size(),
+        "latency_seconds": {
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1],
+        } if latencies else None,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mixes", type=int, default=50, help="number of mixes")
+    parser.add_argument("--clients", type=int, default=500, help="number of clients")
+    parser.add_argument("--hours", type=float, default=1.0, help="simulated hours of traffic")
+    parser.add_argument("--rate", type=float, default=6.0, help="messages sent per client per hour")
+    parser.add_argument("--mix-type", choices=MIX_TYPES, default="continuous", help="type of every mix")
+    parser.add_argument("--max-delay", type=int, default=60, help="maximum mix delay in seconds")
+    parser.add_argument("--threshold-count", type=int, default=10, help="threshold mix batch size")
+    parser.add_argument("--hops", type=int, default=3, help="hops in every route")
+    parser.add_argument("--payload-size", type=int, default=1024, help="sphinx payload size")
+    parser.add_argument("--latency", type=float, default=0.05, help="link latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="maximum link jitter in seconds")
+    parser.add_argument("--bandwidth", type=float, default=None, help="link bandwidth in bytes per second")
+    parser.add_argument("--loss", type=float, default=0.0, help="link loss probability")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the traffic and the network")
+    parser.add_argument("--output", help="save the results as JSON to this file")
+    args = parser.parse_args(argv)
+    if args.mixes < args.hops:
+        parser.error("--mixes must be at least --hops")
+
+    configure_packet_logging(OFF)
+    result = simulate(args)
+    print("%(mixes)d %(mix_type)s mixes, %(clients)d clients, %(virtual_seconds)d simulated seconds "
+          "in %(wall_seconds).1f seconds (%(speedup).1fx)" % result)
+    print("%(messages_sent)d messages sent, %(messages_received)d received, "
+          "%(datagrams_lost)d datagrams lost" % result)
+    print("peak queued: %(peak_queued_messages)d messages, %(peak_queued_bytes)d bytes" % result)
+    if result["latency_seconds"]:
+        print("latency: p50 %(p50).2fs  p90 %(p90).2fs  p99 %(p99).2fs  max %(max).2fs" % result["latency_seconds"])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"metadata": run_metadata(), "results": result}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+compare the loopback throughput of UDPTransport using twisted's
+recvfrom and sendto per datagram with its recvmmsg and sendmmsg
+batch_io path.
+
+a sending transport writes bursts of datagrams once per reactor
+turn to a receiving transport for a fixed time and the number of
+datagrams received per second is reported.
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+
+from twisted.internet import reactor, task
+
+from txmix import UDPTransport
+from txmix import mmsg
+
+
+class CountingProtocol(object):
+    def __init__(self):
+        self.count = 0
+        self.batches = 0
+
+    def received(self, message):
+        self.count += 1
+        self.batches += 1
+
+    def received_batch(self, messages):
+        self.count += len(messages)
+        self.batches += 1
+
+
+def run(batch_io, seconds, burst, packet_size):
+    receiving_protocol = CountingProtocol()
+    receiver = UDPTransport(reactor, ("127.0.0.1", 0), batch_io=batch_io)
+    receiver.register_protocol(receiving_protocol)
+    receiver.start()
+    sender = UDPTransport(reactor, ("127.0.0.1", 0), batch_io=batch_io)
+    sender.register_protocol(CountingProtocol())
+    sender.start()
+    addr = ("127.0.0.1", receiver.port.getHost().port)
+    payload = b"\x00" * packet_size
+    sent = [0]
+
+    def send_burst():
+        for _ in range(burst):
+            sender.send(addr, payload)
+        sent[0] += burst
+
+    sending = task.LoopingCall(send_burst)
+    sending.start(0)
+    start = time.time()
+    deadline = start + seconds
+    while time.time() < deadline:
+        reactor.iterate(0)
+    sending.stop()
+    elapsed = time.time() - start
+    # drain whatever is still in the socket buffer
+    for _ in range(10):
+        reactor.iterate(0.01)
+    receiver.port.stopListening()
+    sender.port.stopListening()
+    return sent[0] / elapsed, receiving_protocol.count / elapsed, receiving_protocol.batches
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seconds", type=float, default=3.0, help="how long to send for")
+    parser.add_argument("--burst", type=int, default=64, help="datagrams sent per reactor turn")
+    parser.add_argument("--packet-size", type=int, default=1024, help="datagram size in bytes")
+    args = parser.parse_args(argv)
+    paths = [("recvfrom/sendto", False)]
+    if mmsg.available():
+        paths.append(("recvmmsg/sendmmsg", True))
+    else:
+        print("recvmmsg and sendmmsg are unavailable on this platform")
+    for name, batch_io in paths:
+        sent_pps, received_pps, batches = run(batch_io, args.seconds, args.burst, args.packet_size)
+        print("%-18s sent %10.0f pps  received %10.0f pps  %8d reads" % (name, sent_pps, received_pps, batches))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
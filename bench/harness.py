@@ -0,0 +1,194 @@
+"""
+shared helpers for the txmix benchmarks
+
+a deterministic entropy source, an in-memory network of transports
+which delivers each datagram synchronously, a timer which turns the
+durations of repeated operations into throughput and latency figures,
+and saving and comparing those figures as JSON so that a run can be
+checked against a baseline recorded at another commit.
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import socket
+import binascii
+import platform
+import subprocess
+import timeit
+
+from zope.interface import implementer
+from twisted.internet import defer
+from Cryptodome.Cipher import ChaCha20
+
+from sphinxmixcrypto import IReader
+
+from txmix import IMixTransport
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+
+@implementer(IReader)
+class ChachaNoiseReader(object):
+    """
+    i am a deterministic entropy source, the keystream of ChaCha20
+    under a hex seed, so every run builds the same keys and packets
+    """
+
+    def __init__(self, seed_string):
+        assert len(seed_string) == 64
+        self.cipher = ChaCha20.new(key=binascii.unhexlify(seed_string), nonce=b"\x00" * 8)
+
+    def read(self, n):
+        return self.cipher.encrypt(b"\x00" * n)
+
+
+class MemoryNetwork(object):
+    """
+    i connect MemoryTransports by address. a datagram sent to an
+    address is passed straight to the receiving protocol, and one
+    sent to an address without a transport is counted and dropped.
+    """
+
+    def __init__(self):
+        self.transports = {}
+        self.unrouted = 0
+
+    def transport(self, addr):
+        transport = MemoryTransport(self, addr)
+        self.transports[addr] = transport
+        return transport
+
+    def deliver(self, addr, message):
+        transport = self.transports.get(addr)
+        if transport is None or transport.protocol is None:
+            self.unrouted += 1
+            return
+        transport.protocol.received(message)
+
+
+@implementer(IMixTransport)
+class MemoryTransport(object):
+    """
+    i am a transport on a MemoryNetwork
+    """
+    name = "memory"
+
+    def __init__(self, network, addr):
+        self.network = network
+        self.addr = addr
+        self.protocol = None
+        self.sent = 0
+
+    def register_protocol(self, protocol):
+        self.protocol = protocol
+
+    def start(self):
+        return defer.succeed(None)
+
+    def send(self, addr, message):
+        self.sent += 1
+        self.network.deliver(addr, message)
+        return defer.succeed(None)
+
+
+def percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarize(durations, packets_per_operation=1):
+    """
+    return a dict of the throughput in packets per second and the
+    per packet latency in microseconds of operations which took the
+    given durations in seconds and each handled packets_per_operation
+    packets
+    """
+    per_packet = sorted(d / packets_per_operation for d in durations)
+    total = sum(durations)
+    packets = len(durations) * packets_per_operation
+    return {
+        "packets": packets,
+        "packets_per_sec": packets / total if total > 0 else float("inf"),
+        "latency_us": {
+            "mean": total * 1e6 / packets,
+            "p50": percentile(per_packet, 0.5) * 1e6,
+            "p90": percentile(per_packet, 0.9) * 1e6,
+            "p99": percentile(per_packet, 0.99) * 1e6,
+        },
+    }
+
+
+def time_each(operation, arguments, packets_per_operation=1):
+    """
+    call operation once with each of arguments and summarize how
+    long the calls took
+    """
+    clock = timeit.default_timer
+    durations = []
+    for argument in arguments:
+        start = clock()
+        operation(argument)
+        durations.append(clock() - start)
+    return summarize(durations, packets_per_operation)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"]).strip().decode("ascii")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_metadata():
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "host": socket.gethostname(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def save_results(path, results):
+    with open(path, "w") as f:
+        json.dump({"metadata": run_metadata(), "results": results}, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare_results(baseline, results, threshold):
+    """
+    return a list of (name, baseline packets per second, packets per
+    second, ratio, regressed) 5-tuples for the benchmarks in both
+    baseline and results. a benchmark has regressed when its
+    throughput fell by more than the threshold fraction.
+    """
+    comparison = []
+    for name in sorted(set(baseline) & set(results)):
+        old = baseline[name]["packets_per_sec"]
+        new = results[name]["packets_per_sec"]
+        ratio = new / old if old else float("inf")
+        comparison.append((name, old, new, ratio, ratio < 1.0 - threshold))
+    return comparison
+
+
+def print_result(name, result, out=sys.stdout):
+    latency = result["latency_us"]
+    print("%-36s %10.1f packets/s  mean %9.1f us  p50 %9.1f us  p99 %9.1f us" % (
+        name, result["packets_per_sec"], latency["mean"], latency["p50"], latency["p99"]), file=out)
+
+
+def print_comparison(comparison, out=sys.stdout):
+    for name, old, new, ratio, regressed in comparison:
+        print("%-36s %10.1f -> %10.1f packets/s  %+6.1f%%%s" % (
+            name, old, new, (ratio - 1.0) * 100, "  REGRESSION" if regressed else ""), file=out)
@@ -0,0 +1,104 @@
+
+import random
+
+import pytest
+
+from twisted.internet.task import Clock
+
+from sphinxmixcrypto import PacketReplayCacheDict, SphinxParams
+
+from txmix import AdmissionQueue, ThresholdMixNode, ContinuousTimeMixNode, DummyPKI
+from txmix.admission import REJECT_NEW, DROP_RANDOM, DROP_OLDEST
+from test_txmix import generate_node_id, generate_node_keypair, ChachaNoiseReader, MixKeyState, DummyTransport, SEED
+
+
+def test_admission_queue_reject_new():
+    queue = AdmissionQueue(max_messages=2, max_bytes=15)
+    a, dropped = queue.admit("a", 10)
+    b, dropped = queue.admit("b", 5)
+    assert queue.admit("c", 1) == (None, [])
+    assert queue.remove(a) == "a"
+    assert queue.admit("d", 11) == (None, [])
+    c, dropped = queue.admit("c", 10)
+    assert c is not None and dropped == []
+    assert len(queue) == 2 and queue.bytes == 15
+    assert queue.drop_counts[REJECT_NEW] == 2
+    assert queue.remove(a) is None
+
+
+def test_admission_queue_drop_oldest():
+    queue = AdmissionQueue(max_messages=3, policy=DROP_OLDEST)
+    handles = [queue.admit(x)[0] for x in "abc"]
+    queue.remove(handles[0])
+    d, dropped = queue.admit("d")
+    assert dropped == []
+    e, dropped = queue.admit("e")
+    assert dropped == [(handles[1], "b")]
+    f, dropped = queue.admit("f")
+    assert dropped == [(handles[2], "c")]
+    assert sorted(queue.remove(x) for x in (d, e, f)) == ["d", "e", "f"]
+    assert queue.dropped == 2
+
+
+def test_admission_queue_drop_random():
+    queue = AdmissionQueue(max_bytes=100, policy=DROP_RANDOM, rand=random.Random(1))
+    handles = dict((queue.admit(i, 10)[0], i) for i in range(10))
+    handle, dropped = queue.admit(10, 25)
+    assert len(dropped) == 3 and queue.bytes == 95
+    for dropped_handle, message in dropped:
+        assert handles.pop(dropped_handle) == message
+    assert sorted(queue.remove(x) for x in handles) == sorted(handles.values())
+    assert queue.remove(handle) == 10
+    assert len(queue) == 0 and queue.bytes == 0
+    # a message larger than max_bytes is always rejected
+    assert queue.admit(11, 101) == (None, [])
+    assert queue.drop_counts == {REJECT_NEW: 1, DROP_RANDOM: 3, DROP_OLDEST: 0}
+
+
+def test_admission_queue_unknown_policy():
+    with pytest.raises(ValueError):
+        AdmissionQueue(policy="drop_everything")
+
+
+def test_threshold_mix_admission():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    public_key, private_key = generate_node_keypair(rand_reader)
+    clock = Clock()
+    mix = ThresholdMixNode(3, generate_node_id(rand_reader), PacketReplayCacheDict(), MixKeyState(public_key, private_key),
+                           params, pki, DummyTransport(0), clock, max_delay=10,
+                           admission_queue=AdmissionQueue(max_messages=5, policy=DROP_OLDEST))
+    mix.start()
+    sent = []
+    mix.protocol.packet_proxy = lambda x: sent.append(x)
+    for i in range(8):
+        mix.message_received(i)
+    # 0, 1 and 2 were released then dropped for 5, 6 and 7
+    assert len(mix._pending_batch_sends) == 2
+    assert sorted(mix._batch.values()) == [6, 7]
+    assert len(mix.admission_queue) == 5
+    clock.advance(10)
+    assert sorted(sent) == [3, 4, 5]
+    assert len(mix.admission_queue) == 2
+
+
+def test_continuous_time_mix_admission():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    public_key, private_key = generate_node_keypair(rand_reader)
+    clock = Clock()
+    mix = ContinuousTimeMixNode(generate_node_id(rand_reader), 10, DummyTransport(0), PacketReplayCacheDict(),
+                                MixKeyState(public_key, private_key), params, pki, clock,
+                                admission_queue=AdmissionQueue(max_messages=4, policy=DROP_OLDEST))
+    mix.start()
+    sent = []
+    mix.protocol.packet_proxy = lambda x: sent.append(x)
+    mix.messages_received(list(range(10)))
+    # the reactor timers of dropped messages are cancelled
+    assert len(mix._pending_sends) == 4
+    assert len(clock.getDelayedCalls()) == 4
+    clock.advance(10)
+    assert sorted(sent) == [6, 7, 8, 9]
+    assert mix.admission_queue.drop_counts[DROP_OLDEST] == 6
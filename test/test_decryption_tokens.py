@@ -0,0 +1,80 @@
+
+import pytest
+
+from twisted.internet.task import Clock
+
+from sphinxmixcrypto import SphinxParams, PacketReplayCacheDict, sphinx_packet_unwrap
+
+from txmix import ClientProtocol, DummyPKI
+from txmix.decryption_tokens import DecryptionTokenStore
+from test_txmix import ChachaNoiseReader, DummyTransport, SEED, build_route
+
+
+def test_reply_decrypted_once():
+    clock = Clock()
+    params = SphinxParams(5, 1024)
+    pki = DummyPKI()
+    rand_reader = ChachaNoiseReader(SEED)
+    route, key_states = build_route(pki, rand_reader)
+
+    received = []
+    client = ClientProtocol(params, pki, b"\x01" * 16, rand_reader,
+                            packet_received_handler=lambda x: received.append(x), reactor=clock)
+    client.make_connection(DummyTransport("client"))
+    reply_block = client.create_reply_block(route)
+    assert len(client.decryption_tokens) == 1
+
+    sphinx_packet = reply_block.compose_forward_message(params, b"hello")
+    for node_id in route:
+        unwrapped = sphinx_packet_unwrap(params, PacketReplayCacheDict(), key_states[node_id], sphinx_packet)
+        if unwrapped.next_hop:
+            sphinx_packet = unwrapped.next_hop[1]
+    client_id, message_id, body = unwrapped.client_hop
+    assert client_id == client.client_id
+
+    client.received(message_id + body.delta)
+    assert received[0].payload.startswith(b"hello")
+    assert len(client.decryption_tokens) == 0
+    with pytest.raises(KeyError):
+        client.received(message_id + body.delta)
+
+
+def test_token_store_bound_and_expiry():
+    clock = Clock()
+    store = DecryptionTokenStore(clock, ttl=100, max_tokens=5, expire_interval=60, expire_batch=2)
+    secrets = b"\x00" * 32 * 4
+    for i in range(6):
+        store.add(b"%016d" % i, secrets)
+    assert len(store) == 5
+    assert store.evicted == 1
+    assert b"%016d" % 0 not in store
+
+    clock.advance(50)
+    store.pop(b"%016d" % 5)
+    store.add(b"%016d" % 6, secrets)
+    clock.advance(90)
+    assert store.expired == 4
+    assert len(store) == 1
+    assert len(store.pop(b"%016d" % 6).keys) == 4
+
+    store.add(b"%016d" % 7, secrets)
+    store.stop()
+    clock.advance(100)
+    with pytest.raises(KeyError):
+        store.pop(b"%016d" % 7)
+    assert store.expired == 5
+    assert clock.getDelayedCalls() == []
+
+
+def test_token_store_incremental_expiry():
+    clock = Clock()
+    store = DecryptionTokenStore(clock, ttl=10, expire_interval=1000, expire_batch=2)
+    for i in range(5):
+        store.add(b"%016d" % i, b"\x00" * 64)
+    clock.advance(10)
+    assert len(store) == 5
+
+    # expiry deletes at most expire_batch tokens per reactor turn
+    store._expire()
+    assert len(store) == 3
+    assert [x.getTime() for x in clock.getDelayedCalls()] == [10, 1000]
@@ -0,0 +1,50 @@
+from zope.interface import implementer
+from twisted.internet import defer
+
+from sphinxmixcrypto import SphinxPacket, SphinxHeader, SphinxBody
+
+from txmix import IMixTransport, IGatherTransport
+from txmix.framing import sphinx_packet_parts, client_packet_parts, split_client_packet, send_parts
+
+
+@implementer(IMixTransport)
+class SendingTransport(object):
+    name = "test"
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, addr, message):
+        self.sent.append((addr, message))
+        return defer.succeed(None)
+
+
+@implementer(IGatherTransport)
+class GatheringTransport(SendingTransport):
+
+    def send_parts(self, addr, parts):
+        self.sent.append((addr, parts))
+        return defer.succeed(None)
+
+
+def test_sphinx_packet_parts():
+    sphinx_packet = SphinxPacket(SphinxHeader(b"a" * 32, b"b" * 176, b"g" * 16), SphinxBody(b"d" * 1024))
+    assert b"".join(sphinx_packet_parts(sphinx_packet)) == sphinx_packet.get_raw_bytes()
+    assert b"".join(client_packet_parts(b"m" * 16, sphinx_packet.body)) == b"m" * 16 + b"d" * 1024
+
+
+def test_split_client_packet():
+    message_id, payload = split_client_packet(b"m" * 16 + b"p" * 1024)
+    assert message_id == b"m" * 16
+    assert len(payload) == 1024
+    assert bytes(payload) == b"p" * 1024
+
+
+def test_send_parts():
+    transport = SendingTransport()
+    send_parts(transport, "addr", [b"a", b"bc"])
+    assert transport.sent == [("addr", b"abc")]
+
+    transport = GatheringTransport()
+    send_parts(transport, "addr", [b"a", b"bc"])
+    assert transport.sent == [("addr", [b"a", b"bc"])]
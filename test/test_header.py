@@ -0,0 +1,17 @@
+
+from sphinxmixcrypto import SphinxParams, create_header as sphinx_create_header
+
+from txmix import DummyPKI
+from txmix.header import create_header
+from test_txmix import ChachaNoiseReader, SEED, build_route
+
+
+def test_create_header_matches_sphinxmixcrypto():
+    params = SphinxParams(5, 1024)
+    pki = DummyPKI()
+    build_route(pki, ChachaNoiseReader(SEED), 5)
+    route = sorted(pki.identities())
+    for hops in range(1, 6):
+        for dest, message_id in ((b"\x00", b"\x00" * 16), (b"\x01" * 17, b"\x02" * 16)):
+            expected = sphinx_create_header(params, route[:hops], pki, dest, message_id, ChachaNoiseReader(SEED))
+            assert create_header(params, route[:hops], pki, dest, message_id, ChachaNoiseReader(SEED)) == expected
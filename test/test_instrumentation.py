@@ -0,0 +1,63 @@
+
+import pytest
+
+from eliot import add_destination, remove_destination
+
+from sphinxmixcrypto import PacketReplayCacheDict, SphinxParams, SphinxPacket
+
+from txmix import MixProtocol, DummyPKI, configure_packet_logging
+from txmix.instrumentation import PacketLogSampler, FULL, SAMPLED, OFF
+from test_txmix import ChachaNoiseReader, DummyTransport, SEED, build_route
+
+
+def test_packet_log_sampler():
+    sampler = PacketLogSampler(SAMPLED, sample_every=4)
+    assert [sampler.sample(u"a") for _ in range(8)] == [True, False, False, False] * 2
+    # every action type is sampled at the same rate
+    assert [(sampler.sample(u"b"), sampler.sample(u"c")) for _ in range(4)] == [(True, True)] + [(False, False)] * 3
+    sampler.configure(FULL)
+    assert all(sampler.sample(u"a") for _ in range(8))
+    sampler.configure(OFF)
+    assert not any(sampler.sample(u"a") for _ in range(8))
+    with pytest.raises(ValueError):
+        sampler.configure("verbose")
+
+
+@pytest.fixture
+def logged_messages():
+    messages = []
+    add_destination(messages.append)
+    yield messages
+    remove_destination(messages.append)
+    configure_packet_logging(SAMPLED)
+
+
+@pytest.mark.parametrize("mode,sample_every,expected", [
+    (FULL, 1, 20),
+    (SAMPLED, 5, 4),
+    (OFF, 1, 0),
+])
+def test_packet_logging_modes(logged_messages, mode, sample_every, expected):
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    route, key_states = build_route(pki, rand_reader)
+    raw_packets = [SphinxPacket.forward_message(params, route, pki, route[-1], b"ping", rand_reader).get_raw_bytes()
+                   for _ in range(20)]
+    received = []
+    protocol = MixProtocol(PacketReplayCacheDict(), key_states[route[0]], params, pki,
+                           packet_received_handler=lambda x: received.append(x))
+    protocol.make_connection(DummyTransport(0))
+    configure_packet_logging(mode, sample_every)
+    del logged_messages[:]
+    for raw_packet in raw_packets:
+        protocol.received(raw_packet)
+    assert len(received) == 20
+    started = [x for x in logged_messages
+               if x.get("action_type") == u"mix packet unwrap" and x.get("action_status") == u"started"]
+    assert len(started) == expected
+
+    # batches are always logged
+    del logged_messages[:]
+    protocol.received_batch(raw_packets[:1])
+    assert any(x.get("action_type") == u"mix packet batch unwrap" for x in logged_messages)
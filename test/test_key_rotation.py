@@ -0,0 +1,84 @@
+import pytest
+
+from twisted.internet.task import Clock
+
+from sphinxmixcrypto import SphinxParams, SphinxPacket, ReplayError, IncorrectMACError
+
+from txmix import MixProtocol, DummyPKI, EpochKeyState, KeyRotation, EpochReplayCache, IEpochKeyState
+from txmix.unwrap import unwrap_raw_packet
+from test_txmix import generate_node_id, generate_node_keypair, ChachaNoiseReader, DummyTransport, SEED
+
+
+def rotating_mix(params, rand_reader, replay_cache):
+    pki = DummyPKI()
+    node_id = generate_node_id(rand_reader)
+    key_state = EpochKeyState(0, *generate_node_keypair(rand_reader))
+    pki.set(node_id, key_state.get_public_key(), 0)
+    received = []
+    protocol = MixProtocol(replay_cache, key_state, params, pki, packet_received_handler=lambda x: received.append(x))
+    protocol.make_connection(DummyTransport(0))
+    return pki, node_id, key_state, protocol, received
+
+
+def forward_packet(params, pki, node_id, rand_reader):
+    return SphinxPacket.forward_message(params, [node_id], pki, node_id, b"ping", rand_reader).get_raw_bytes()
+
+
+def test_epoch_key_state():
+    rand_reader = ChachaNoiseReader(SEED)
+    first, second = generate_node_keypair(rand_reader), generate_node_keypair(rand_reader)
+    key_state = EpochKeyState(3, *first)
+    assert IEpochKeyState.providedBy(key_state)
+    assert key_state.get_public_key() == first[0]
+    assert key_state.previous_epoch is None
+
+    key_state.rotate(4, *second)
+    assert key_state.epoch == 4
+    assert key_state.previous_epoch == 3
+    assert key_state.get_private_key() == second[1]
+    assert [key.get_public_key() for key in key_state.live_keys()] == [second[0], first[0]]
+
+    key_state.retire_previous()
+    assert key_state.previous_epoch is None
+    assert [key.get_public_key() for key in key_state.live_keys()] == [second[0]]
+
+
+def test_key_rotation_overlap():
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    replay_cache = EpochReplayCache(100)
+    pki, node_id, key_state, protocol, received = rotating_mix(params, rand_reader, replay_cache)
+    clock = Clock()
+    rotation = KeyRotation(clock, node_id, key_state, rand_reader, pki=pki, replay_cache=replay_cache,
+                           epoch_duration=100, overlap=20, precompute_lead=10)
+    rotation.start()
+    old_packets = [forward_packet(params, pki, node_id, rand_reader) for _ in range(3)]
+    protocol.received(old_packets[0])
+
+    clock.advance(90)
+    assert rotation.next_public_key is not None
+    assert key_state.epoch == 0
+
+    clock.advance(10)
+    assert key_state.epoch == 1
+    assert replay_cache.epochs == [0, 1]
+    assert pki.get(node_id) == key_state.get_public_key()
+    with pytest.raises(ReplayError):
+        protocol.received(old_packets[0])
+    protocol.received(old_packets[1])
+    protocol.received(forward_packet(params, pki, node_id, rand_reader))
+    assert len(received) == 3
+
+    clock.advance(20)
+    assert key_state.previous_epoch is None
+    assert replay_cache.epochs == [1]
+    with pytest.raises(IncorrectMACError):
+        protocol.received(old_packets[2])
+    with pytest.raises(IncorrectMACError):
+        unwrap_raw_packet(params, key_state, old_packets[2])
+
+    clock.advance(80)
+    assert key_state.epoch == 2
+    assert replay_cache.epochs == [1, 2]
+    rotation.stop()
+    assert clock.getDelayedCalls() == []
@@ -0,0 +1,131 @@
+
+import pytest
+
+from zope.interface import implementer
+from twisted.internet import reactor, defer
+from twisted.web.client import Agent, readBody
+
+from sphinxmixcrypto import PacketReplayCacheDict, SphinxParams, SphinxPacket, ReplayError
+
+from txmix import MixProtocol, DummyPKI, IPacketUnwrapper
+from txmix import metrics
+from txmix.unwrap import unwrap_raw_packet
+from txmix.metrics import MetricsRegistry, listen_metrics
+from test_txmix import generate_node_id, generate_node_keypair, ChachaNoiseReader, MixKeyState, DummyTransport, SEED, build_route
+
+
+def test_registry_render():
+    registry = MetricsRegistry()
+    registry.counter("packets_total", "packets seen").inc(3)
+    registry.counter("sent_total", "datagrams sent", {"transport": "udp"}).inc()
+    registry.counter("sent_total", "datagrams sent", {"transport": "onion"}).inc(2)
+    gauge = registry.gauge("queued", "queued messages")
+    gauge.inc(5)
+    gauge.dec(2)
+    registry.gauge("answer", "computed when rendered", function=lambda: 42)
+    histogram = registry.histogram("latency_seconds", "latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert registry.counter("packets_total", "packets seen").value == 3
+    with pytest.raises(ValueError):
+        registry.gauge("packets_total", "packets seen")
+
+    assert registry.render() == "\n".join([
+        "# HELP answer computed when rendered",
+        "# TYPE answer gauge",
+        "answer 42.0",
+        "# HELP latency_seconds latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 2.0',
+        'latency_seconds_bucket{le="1.0"} 3.0',
+        'latency_seconds_bucket{le="+Inf"} 4.0',
+        "latency_seconds_sum 2.65",
+        "latency_seconds_count 4.0",
+        "# HELP packets_total packets seen",
+        "# TYPE packets_total counter",
+        "packets_total 3.0",
+        "# HELP queued queued messages",
+        "# TYPE queued gauge",
+        "queued 3.0",
+        "# HELP sent_total datagrams sent",
+        "# TYPE sent_total counter",
+        'sent_total{transport="onion"} 2.0',
+        'sent_total{transport="udp"} 1.0',
+    ]) + "\n"
+
+
+def test_mix_protocol_metrics():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    route, key_states = build_route(pki, rand_reader)
+    raw_packet = SphinxPacket.forward_message(params, route, pki, route[-1], b"ping", rand_reader).get_raw_bytes()
+    protocol = MixProtocol(PacketReplayCacheDict(), key_states[route[0]], params, pki,
+                           packet_received_handler=lambda x: protocol.packet_proxy(x))
+    protocol.make_connection(DummyTransport(0))
+
+    received = metrics.PACKETS_RECEIVED.value
+    sent = metrics.PACKETS_SENT.value
+    replays = metrics.REPLAYS.value
+    unwraps = metrics.UNWRAP_SECONDS.count
+    protocol.received(raw_packet)
+    with pytest.raises(ReplayError):
+        protocol.received(raw_packet)
+    protocol.received_batch([raw_packet, raw_packet])
+    assert metrics.PACKETS_RECEIVED.value == received + 4
+    assert metrics.PACKETS_SENT.value == sent + 1
+    assert metrics.REPLAYS.value == replays + 3
+    assert metrics.UNWRAP_SECONDS.count == unwraps + 3
+
+
+@implementer(IPacketUnwrapper)
+class InlineUnwrapper(object):
+    def start(self):
+        pass
+
+    def unwrap(self, params, key_state, raw_sphinx_packet):
+        return defer.succeed(unwrap_raw_packet(params, key_state, raw_sphinx_packet))
+
+
+class FakeTime(object):
+    def __init__(self, times):
+        self.times = list(times)
+
+    def time(self):
+        return self.times.pop(0)
+
+
+def test_unwrapper_batch_unwrap_seconds(monkeypatch):
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    node_id = generate_node_id(rand_reader)
+    key_state = MixKeyState(*generate_node_keypair(rand_reader))
+    pki.set(node_id, key_state.get_public_key(), 0)
+    raw_packets = [SphinxPacket.forward_message(params, [node_id], pki, node_id, b"ping", rand_reader).get_raw_bytes()
+                   for _ in range(4)]
+    protocol = MixProtocol(PacketReplayCacheDict(), key_state, params, pki,
+                           packet_received_handler=lambda x: None, unwrapper=InlineUnwrapper())
+    protocol.make_connection(DummyTransport(0))
+
+    # a batch of 4 packets which took 4 seconds is 1 second per packet
+    unwraps, total = metrics.UNWRAP_SECONDS.count, metrics.UNWRAP_SECONDS.sum
+    monkeypatch.setattr("txmix.mix.time", FakeTime([10.0, 14.0]))
+    protocol.received_batch(raw_packets)
+    assert metrics.UNWRAP_SECONDS.count == unwraps + 4
+    assert metrics.UNWRAP_SECONDS.sum == total + 4.0
+
+
+@pytest.inlineCallbacks
+def test_metrics_endpoint():
+    registry = MetricsRegistry()
+    registry.counter("txmix_test_total", "a test counter").inc(7)
+    port = listen_metrics(reactor, 0, registry=registry)
+    try:
+        url = "http://127.0.0.1:%d/metrics" % port.getHost().port
+        response = yield Agent(reactor).request(b"GET", url.encode("ascii"))
+        body = yield readBody(response)
+        assert response.headers.getRawHeaders(b"content-type")[0].startswith(b"text/plain; version=0.0.4")
+        assert b"txmix_test_total 7.0\n" in body
+    finally:
+        yield port.stopListening()
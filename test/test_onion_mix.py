@@ -11,13 +11,20 @@ import txtorcon
 
 from eliot import add_destination
 from twisted.internet import reactor, defer, endpoints
+from twisted.internet.task import deferLater, Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.internet.error import ConnectionRefusedError, ConnectionDone
+from twisted.python.failure import Failure
+from zope.interface import implementer
+from twisted.internet.interfaces import IStreamClientEndpoint
 from twisted.protocols.basic import Int32StringReceiver
 
 from sphinxmixcrypto import SphinxParams, PacketReplayCacheDict
 
 from txmix import OnionTransportFactory, ThresholdMixNode, IMixTransport, ContinuousTimeMixNode
 from txmix.client import MixClient, RandomRouteFactory, CascadeRouteFactory
-from txmix.onion_transport import OnionDatagramProxyFactory
+from txmix.onion_transport import OnionDatagramProxyFactory, StreamConnectionPool, OnionSendProtocol, SendQueueFullError
+from txmix.onion_transport import SphinxFrameReceiver, REJECTED_FRAMES
 from test_txmix import generate_node_id, generate_node_keypair, ChachaNoiseReader, MixKeyState, DummyPKI
 
 
@@ -61,6 +68,243 @@ def test_onion_datagram_proxy():
     assert received_buffer[0] == packet
 
 
+def test_sphinx_frame_receiver():
+    batches = []
+    protocol = SphinxFrameReceiver(4, lambda x: batches.append(x))
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    frames = [b"AAAA", b"BBBB", b"CCCC"]
+    stream = b"".join(b"\x00\x00\x00\x04" + frame for frame in frames)
+
+    # frames read together are delivered together
+    protocol.dataReceived(stream)
+    assert batches == [frames]
+
+    # frames and prefixes split across reads are gathered
+    del batches[:]
+    for i in range(0, len(stream), 3):
+        protocol.dataReceived(stream[i:i + 3])
+    assert [frame for batch in batches for frame in batch] == frames
+    assert all(len(batch) == 1 for batch in batches)
+    assert not transport.disconnecting
+
+    # a frame of the wrong size loses the connection, frames before it are delivered
+    del batches[:]
+    rejected = REJECTED_FRAMES.value
+    protocol.dataReceived(b"\x00\x00\x00\x04DDDD\xff\xff\xff\xffEEEE")
+    assert batches == [[b"DDDD"]]
+    assert transport.disconnecting
+    assert REJECTED_FRAMES.value == rejected + 1
+    protocol.dataReceived(stream)
+    assert batches == [[b"DDDD"]]
+
+
+@pytest.inlineCallbacks
+def test_onion_datagram_proxy_frame_size():
+    received_buffer = []
+    received_d = defer.Deferred()
+
+    def received_batch(datagrams):
+        received_buffer.extend(datagrams)
+        if len(received_buffer) == 3:
+            received_d.callback(None)
+
+    proxy_factory = OnionDatagramProxyFactory(lambda x: None, frame_size=100, batch_received_handler=received_batch)
+    service_port = yield txtorcon.util.available_tcp_port(reactor)
+    service_endpoint = endpoints.serverFromString(reactor, "tcp:interface=127.0.0.1:%s" % service_port)
+    listening_port = yield service_endpoint.listen(proxy_factory)
+    client_endpoint = endpoints.clientFromString(reactor, "tcp:127.0.0.1:%s" % service_port)
+    client_protocol = Int32StringReceiver()
+    yield endpoints.connectProtocol(client_endpoint, client_protocol)
+    packets = [c * 100 for c in (b"A", b"B", b"C")]
+    for packet in packets:
+        client_protocol.sendString(packet)
+    yield received_d
+    assert received_buffer == packets
+    client_protocol.transport.loseConnection()
+    yield listening_port.stopListening()
+
+
+@pytest.inlineCallbacks
+def test_stream_connection_pool():
+    received_buffer = []
+    received_d = defer.Deferred()
+
+    def received(data):
+        received_buffer.append(data)
+        if len(received_buffer) == 3:
+            received_d.callback(None)
+
+    proxy_factory = OnionDatagramProxyFactory(received)
+    service_port = yield txtorcon.util.available_tcp_port(reactor)
+    service_endpoint = endpoints.serverFromString(reactor, "tcp:interface=127.0.0.1:%s" % service_port)
+    listening_port = yield service_endpoint.listen(proxy_factory)
+
+    def endpoint_factory(addr):
+        return endpoints.clientFromString(reactor, "tcp:%s:%s" % addr)
+
+    pool = StreamConnectionPool(reactor, endpoint_factory, idle_timeout=0.1)
+    addr = ("127.0.0.1", service_port)
+    yield defer.gatherResults([pool.send(addr, b"A" * i) for i in range(1, 4)])
+    assert len(pool.connections(addr)) == 1
+    yield received_d
+    assert received_buffer == [b"A", b"AA", b"AAA"]
+
+    # idle streams are closed and reopened on the next send
+    protocol = pool.connections(addr)[0]
+    while pool.connections(addr):
+        yield deferLater(reactor, 0.05, lambda: None)
+    yield pool.send(addr, b"B")
+    assert pool.connections(addr)[0] is not protocol
+    pool.close()
+    yield listening_port.stopListening()
+
+
+@pytest.inlineCallbacks
+def test_stream_connection_pool_connect_failure():
+    closed_port = yield txtorcon.util.available_tcp_port(reactor)
+
+    def endpoint_factory(addr):
+        return endpoints.clientFromString(reactor, "tcp:%s:%s" % addr)
+
+    pool = StreamConnectionPool(reactor, endpoint_factory, connect_retries=2)
+    addr = ("127.0.0.1", closed_port)
+    with pytest.raises(ConnectionRefusedError):
+        yield pool.send(addr, b"A")
+    assert pool.connections(addr) == []
+
+
+@implementer(IStreamClientEndpoint)
+class PendingEndpoint(object):
+    """
+    an endpoint whose connection attempts never complete
+    until they are cancelled
+    """
+
+    def __init__(self):
+        self.attempts = []
+        self.cancelled = 0
+
+    def connect(self, factory):
+        d = defer.Deferred(lambda d: self._cancel())
+        self.attempts.append(d)
+        return d
+
+    def _cancel(self):
+        self.cancelled += 1
+
+
+def test_stream_connection_pool_close_cancels_connects():
+    endpoint = PendingEndpoint()
+    pool = StreamConnectionPool(Clock(), lambda addr: endpoint, connect_retries=2)
+    failures = []
+    pool.send(("127.0.0.1", 1), b"A").addErrback(failures.append)
+    assert len(endpoint.attempts) == 1
+    pool.close()
+    # the connect is cancelled and not retried
+    assert endpoint.cancelled == 1
+    assert len(endpoint.attempts) == 1
+    assert failures[0].check(defer.CancelledError)
+    assert pool.connections(("127.0.0.1", 1)) == []
+
+    pool.send(("127.0.0.1", 1), b"B").addErrback(failures.append)
+    assert failures[1].check(defer.CancelledError)
+    assert len(endpoint.attempts) == 1
+
+
+class WriteCountingTransport(StringTransport):
+
+    write_calls = 0
+
+    def write(self, data):
+        self.write_calls += 1
+        StringTransport.write(self, data)
+
+    def writeSequence(self, seq):
+        self.write_calls += 1
+        StringTransport.writeSequence(self, seq)
+
+
+def test_onion_send_protocol_coalescing():
+    clock = Clock()
+    lost = []
+    protocol = OnionSendProtocol(lambda x: lost.append(x), clock, flush_delay=0.01, max_queued_bytes=10)
+    transport = WriteCountingTransport()
+    protocol.makeConnection(transport)
+    protocol.queue_frame(b"A")
+    protocol.queue_frame(b"BB")
+    assert transport.value() == b""
+    clock.advance(0.01)
+    assert transport.write_calls == 1
+    assert transport.value() == b"\x00\x00\x00\x01A\x00\x00\x00\x02BB"
+
+    # reaching max_queued_bytes flushes at once
+    protocol.queue_frame(b"C" * 10)
+    assert transport.write_calls == 2
+    assert clock.getDelayedCalls() == []
+
+
+def test_onion_send_protocol_frame_parts():
+    clock = Clock()
+    protocol = OnionSendProtocol(lambda x: None, clock)
+    transport = WriteCountingTransport()
+    protocol.makeConnection(transport)
+    protocol.queue_frame_parts([b"A", b"BB"])
+    protocol.queue_frame(b"C")
+    clock.advance(0)
+    assert transport.write_calls == 1
+    assert transport.value() == b"\x00\x00\x00\x03ABB\x00\x00\x00\x01C"
+
+
+def test_onion_send_protocol_backpressure():
+    clock = Clock()
+    protocol = OnionSendProtocol(lambda x: None, clock, max_paused_bytes=4)
+    transport = WriteCountingTransport()
+    protocol.makeConnection(transport)
+    sent = []
+    protocol.queue_frame(b"A").addCallback(sent.append)
+    assert sent == []
+    clock.advance(0)
+    assert sent == [None]
+
+    # frames are held while the write buffer is full, up to max_paused_bytes
+    protocol.pauseProducing()
+    protocol.queue_frame(b"BB").addCallback(sent.append)
+    protocol.queue_frame(b"CC").addCallback(sent.append)
+    failures = []
+    protocol.queue_frame(b"D").addErrback(failures.append)
+    assert failures[0].check(SendQueueFullError)
+    clock.advance(0)
+    assert transport.write_calls == 1
+    assert len(sent) == 1
+
+    protocol.resumeProducing()
+    assert transport.write_calls == 2
+    assert len(sent) == 3
+    assert transport.value() == b"\x00\x00\x00\x01A\x00\x00\x00\x02BB\x00\x00\x00\x02CC"
+
+    # the limit holds for the first frame queued while paused too
+    protocol.pauseProducing()
+    protocol.queue_frame(b"E" * 5).addErrback(failures.append)
+    assert failures[1].check(SendQueueFullError)
+    protocol.queue_frame(b"F" * 4).addCallback(sent.append)
+    protocol.resumeProducing()
+    assert len(sent) == 4
+
+
+def test_onion_send_protocol_connection_lost():
+    clock = Clock()
+    lost = []
+    protocol = OnionSendProtocol(lambda x: lost.append(x), clock)
+    protocol.makeConnection(WriteCountingTransport())
+    failures = []
+    protocol.queue_frame(b"A").addErrback(failures.append)
+    protocol.connectionLost(Failure(ConnectionDone()))
+    assert failures[0].check(ConnectionDone)
+    assert lost == [protocol]
+    assert clock.getDelayedCalls() == []
+
+
 def create_transport_factory(receive_size, tor_control_tcp_port):
     tor_control_unix_socket = ""
     tor_control_tcp_host = "127.0.0.1"
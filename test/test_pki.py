@@ -0,0 +1,94 @@
+
+import json
+import binascii
+
+import pytest
+
+from txmix import ConsensusPKI, ConsensusVersionError, SampledRouteFactory
+from sphinxmixcrypto import SphinxParams
+from test_txmix import ChachaNoiseReader, SEED
+
+
+def node(i):
+    return {
+        "id": binascii.hexlify(b"\xff" + chr(i) * 15),
+        "public_key": binascii.hexlify(chr(i) * 32),
+        "addrs": {"udp": ["127.0.0.1", 9000 + i], "onion": "node%d.onion" % i},
+    }
+
+
+def test_consensus_pki_load_and_diff():
+    pki = ConsensusPKI.from_json(json.dumps({"version": 1, "nodes": [node(i) for i in range(4)]}))
+    node_id = b"\xff" + chr(2) * 15
+    assert len(pki) == 4
+    assert pki.consensus_version == 1
+    version = pki.version
+    identities = pki.identities()
+    assert pki.identities() is identities
+    assert sorted(identities) == sorted(b"\xff" + chr(i) * 15 for i in range(4))
+    assert pki.get(node_id) == chr(2) * 32
+    assert pki.get_mix_addr("udp", node_id) == ("127.0.0.1", 9002)
+    assert pki.get_mix_addr("onion", node_id) == "node2.onion"
+    with pytest.raises(KeyError):
+        pki.get_mix_addr("dummy", node_id)
+
+    with pytest.raises(ConsensusVersionError):
+        pki.apply_diff({"from_version": 0, "version": 2, "nodes": [node(5)]})
+    assert pki.version == version
+
+    replaced = node(2)
+    replaced["public_key"] = binascii.hexlify(b"\x01" * 32)
+    record = pki.record(b"\xff" + chr(1) * 15)
+    pki.apply_diff({"from_version": 1, "version": 2, "remove": [node(0)["id"]], "nodes": [node(5), replaced]})
+    assert pki.consensus_version == 2
+    assert pki.version > version
+    assert pki.get(node_id) == b"\x01" * 32
+    assert pki.record(b"\xff" + chr(1) * 15) is record
+    assert sorted(pki.identities()) == sorted(b"\xff" + chr(i) * 15 for i in (1, 2, 3, 5))
+
+
+def test_consensus_pki_rotate_stages_key():
+    pki = ConsensusPKI({"version": 1, "nodes": [node(i) for i in range(3)]})
+    node_id = b"\xff" + chr(1) * 15
+    pki.rotate(node_id, b"\x01" * 32, b"")
+    assert pki.get(node_id) == chr(1) * 32
+    assert pki.staged_key(node_id) == b"\x01" * 32
+
+    # the staged key is used once the next consensus is applied
+    version = pki.version
+    pki.apply_diff({"from_version": 1, "version": 2, "nodes": [node(5)]})
+    assert pki.get(node_id) == b"\x01" * 32
+    assert pki.get_mix_addr("udp", node_id) == ("127.0.0.1", 9001)
+    assert pki.staged_key(node_id) is None
+    assert pki.version > version
+
+    # unless the consensus has changed the key itself
+    pki.rotate(node_id, b"\x02" * 32, b"")
+    replaced = node(1)
+    replaced["public_key"] = binascii.hexlify(b"\x03" * 32)
+    pki.load({"version": 3, "nodes": [node(0), replaced]})
+    assert pki.get(node_id) == b"\x03" * 32
+    assert pki.staged_key(node_id) is None
+
+
+def test_consensus_pki_set_and_clients():
+    pki = ConsensusPKI()
+    node_id = b"\xff" * 16
+    pki.set(node_id, b"\x02" * 32, ("127.0.0.1", 1))
+    # an address without a transport is used for every transport
+    assert pki.get_mix_addr("udp", node_id) == ("127.0.0.1", 1)
+    assert pki.get_mix_addr("onion", node_id) == ("127.0.0.1", 1)
+
+    pki.set_client_addr("udp", b"\x01" * 16, ("127.0.0.1", 2))
+    assert pki.get_client_addr("udp", b"\x01" * 16) == ("127.0.0.1", 2)
+    with pytest.raises(KeyError):
+        pki.get_client_addr("onion", b"\x01" * 16)
+
+
+def test_sampled_route_factory_follows_consensus():
+    pki = ConsensusPKI({"version": 1, "nodes": [node(i) for i in range(5)]})
+    route_factory = SampledRouteFactory(SphinxParams(5, 1024), pki,
+                                        ChachaNoiseReader(SEED))
+    assert sorted(route_factory.build_route()) == sorted(pki.identities())
+    pki.apply_diff({"from_version": 1, "version": 2, "remove": [node(0)["id"]], "nodes": [node(6)]})
+    assert sorted(route_factory.build_route()) == sorted(pki.identities())
@@ -0,0 +1,148 @@
+
+from twisted.internet.task import Clock
+
+from sphinxmixcrypto import PacketReplayCacheDict, SphinxParams, SphinxPacket, sphinx_packet_unwrap
+
+from txmix import MixClient, HeaderPool, ReplyBlockPool, CascadeRouteFactory, DummyPKI
+from txmix.precompute import PrecomputedHeader
+from test_txmix import ChachaNoiseReader, DummyTransport, SEED, build_route
+
+
+def test_precomputed_header_matches_forward_message():
+    params = SphinxParams(5, 1024)
+    pki = DummyPKI()
+    route, _ = build_route(pki, ChachaNoiseReader(SEED))
+    message = b"hello"
+
+    precomputed = PrecomputedHeader.build(params, route, pki, ChachaNoiseReader(SEED))
+    expected = SphinxPacket.forward_message(params, route, pki, route[-1], message, ChachaNoiseReader(SEED))
+    assert precomputed.compose_forward_message(params, message).get_raw_bytes() == expected.get_raw_bytes()
+
+
+def test_header_pool_refill_take_and_expire():
+    clock = Clock()
+    params = SphinxParams(5, 1024)
+    pki = DummyPKI()
+    rand_reader = ChachaNoiseReader(SEED)
+    route, _ = build_route(pki, rand_reader)
+    pool = HeaderPool(params, pki, CascadeRouteFactory(route), rand_reader, clock, depth=3, max_age=10)
+    pool.start()
+    assert len(pool) == 0
+    assert len(clock.getDelayedCalls()) == 1
+    clock.advance(0)
+    assert len(pool) == 3
+
+    first = pool.take()
+    second = pool.take()
+    assert first.header != second.header
+    assert len(pool) == 1
+    clock.advance(0)
+    assert len(pool) == 3
+    assert pool.hits == 2
+
+    # stale headers are replaced without waiting for a take
+    clock.advance(10)
+    assert pool.expired == 3
+    assert len(pool) == 3
+    assert pool.misses == 0
+
+    pool.stop()
+    assert len(pool) == 0
+    assert clock.getDelayedCalls() == []
+
+
+def test_mix_client_header_pool():
+    clock = Clock()
+    params = SphinxParams(5, 1024)
+    pki = DummyPKI()
+    rand_reader = ChachaNoiseReader(SEED)
+    route, key_states = build_route(pki, rand_reader)
+    transport = DummyTransport("client")
+    client = MixClient(params, pki, b"\x01" * 16, rand_reader, transport, lambda x: None,
+                       CascadeRouteFactory(route), clock, header_pool_depth=2)
+    client.start()
+    clock.advance(0)
+    assert len(client.header_pool) == 2
+
+    for message in (b"one", b"two", b"three"):
+        client.send(route[-1], message)
+    assert client.header_pool.hits == 2
+    assert client.header_pool.misses == 1
+
+    tags = set()
+    for addr, raw_packet in transport.sent:
+        assert addr == 0
+        replay_cache = PacketReplayCacheDict()
+        sphinx_packet = SphinxPacket.from_raw_bytes(params, raw_packet)
+        unwrapped = sphinx_packet_unwrap(params, replay_cache, key_states[route[0]], sphinx_packet)
+        assert unwrapped.next_hop[0] == route[1]
+        tags.update(replay_cache.cache)
+    assert len(tags) == 3
+    client.stop()
+    assert clock.getDelayedCalls() == []
+
+
+def test_reply_block_pool_watermarks():
+    clock = Clock()
+    params = SphinxParams(5, 1024)
+    pki = DummyPKI()
+    rand_reader = ChachaNoiseReader(SEED)
+    route, _ = build_route(pki, rand_reader)
+    transport = DummyTransport("client")
+    client = MixClient(params, pki, b"\x01" * 16, rand_reader, transport, lambda x: None,
+                       CascadeRouteFactory(route), clock,
+                       reply_block_low_watermark=2, reply_block_high_watermark=4)
+    client.start()
+    pool = client.reply_block_pool
+    assert isinstance(pool, ReplyBlockPool)
+    clock.advance(0)
+    assert len(pool) == 4
+
+    # no refill until fewer than low_watermark are left
+    reply_blocks = [client.create_reply_block(), client.create_reply_block()]
+    assert len(pool) == 2
+    # only the decryption token expiry is scheduled
+    assert len(clock.getDelayedCalls()) == 1
+    reply_blocks.append(client.create_reply_block())
+    assert len(pool) == 1
+    clock.advance(0)
+    assert len(pool) == 4
+    assert len(set(x.key for x in reply_blocks)) == 3
+
+    pool.stop()
+    reply_blocks.append(client.create_reply_block())
+    assert pool.hits == 3
+    assert pool.misses == 1
+    assert pool.hit_rate == 0.75
+    # only the reply blocks handed out have decryption tokens
+    assert len(client.protocol.decryption_tokens) == 4
+
+
+def test_reply_block_pool_token_ttl():
+    clock = Clock()
+    params = SphinxParams(5, 1024)
+    pki = DummyPKI()
+    rand_reader = ChachaNoiseReader(SEED)
+    route, key_states = build_route(pki, rand_reader)
+    received = []
+    client = MixClient(params, pki, b"\x01" * 16, rand_reader, DummyTransport("client"),
+                       lambda x: received.append(x), CascadeRouteFactory(route), clock,
+                       reply_block_low_watermark=1, reply_block_high_watermark=2)
+    client.start()
+    clock.advance(0)
+    assert len(client.reply_block_pool) == 2
+    assert len(client.protocol.decryption_tokens) == 0
+
+    # a reply block taken after waiting longer than the token ttl can be replied to
+    clock.advance(client.protocol.token_ttl + 1)
+    reply_block = client.create_reply_block()
+    assert client.reply_block_pool.hits == 1
+    sphinx_packet = reply_block.compose_forward_message(params, b"hello")
+    for node_id in route:
+        unwrapped = sphinx_packet_unwrap(params, PacketReplayCacheDict(), key_states[node_id], sphinx_packet)
+        if unwrapped.next_hop:
+            sphinx_packet = unwrapped.next_hop[1]
+    client_id, message_id, body = unwrapped.client_hop
+    client.protocol.received(message_id + body.delta)
+    assert received[0].payload.startswith(b"hello")
+    client.stop()
@@ -0,0 +1,136 @@
+
+import hashlib
+import struct
+import pytest
+
+from twisted.internet.task import Clock
+
+from txmix.replay_cache import ReplayTagTable, EpochReplayCache, MmapReplayCache
+from txmix.replay_cache import ReplayCacheFullError, ReplayCacheFileError
+from txmix.interfaces import IBatchPacketReplayCache
+
+
+def make_tag(i):
+    return hashlib.sha256(struct.pack("<Q", i)).digest()
+
+
+def test_replay_tag_table():
+    table = ReplayTagTable(100)
+    assert IBatchPacketReplayCache.providedBy(table)
+    tags = [make_tag(i) for i in range(100)]
+    for tag in tags:
+        assert not table.has_seen(tag)
+        table.set_seen(tag)
+        assert table.has_seen(tag)
+    assert len(table) == 100
+    table.set_seen(tags[0])
+    assert len(table) == 100
+    with pytest.raises(ReplayCacheFullError):
+        table.set_seen(make_tag(100))
+    assert not table.has_seen(make_tag(100))
+    table.flush()
+    assert len(table) == 0
+    assert not any(table.has_seen(tag) for tag in tags)
+
+
+def test_replay_tag_table_test_and_set():
+    table = ReplayTagTable(10)
+    table.set_seen(make_tag(1))
+    assert table.test_and_set([make_tag(0), make_tag(1), make_tag(0)]) == [False, True, True]
+
+    # new tags which do not fit are reported as None and not set
+    table = ReplayTagTable(2)
+    assert table.test_and_set([make_tag(0), make_tag(1), make_tag(2), make_tag(0)]) == [False, False, None, True]
+    assert not table.has_seen(make_tag(2))
+
+
+def test_epoch_replay_cache():
+    cache = EpochReplayCache(10, epoch=1, max_epochs=2)
+    cache.set_seen(make_tag(1))
+    cache.rotate(2)
+    assert cache.epochs == [1, 2]
+    assert cache.has_seen(make_tag(1))
+    assert cache.test_and_set([make_tag(1), make_tag(2)]) == [True, False]
+    assert cache.epoch(2).has_seen(make_tag(2))
+    assert not cache.epoch(1).has_seen(make_tag(2))
+
+    cache.drop_epoch(1)
+    assert not cache.has_seen(make_tag(1))
+    assert cache.has_seen(make_tag(2))
+
+    cache.rotate(3)
+    cache.rotate(4)
+    assert cache.epochs == [3, 4]
+    assert not cache.has_seen(make_tag(2))
+
+
+def test_mmap_replay_cache(tmpdir):
+    path = str(tmpdir.join("replay.cache"))
+    cache = MmapReplayCache(path, 10)
+    assert cache.test_and_set([make_tag(i) for i in range(5)]) == [False] * 5
+    cache.close()
+
+    cache = MmapReplayCache(path, 10)
+    assert len(cache) == 5
+    assert all(cache.has_seen(make_tag(i)) for i in range(5))
+    assert not cache.has_seen(make_tag(5))
+    cache.flush()
+    cache.close()
+
+    cache = MmapReplayCache(path, 10)
+    assert len(cache) == 0
+    assert not cache.has_seen(make_tag(0))
+    cache.close()
+
+
+def test_mmap_replay_cache_compact(tmpdir):
+    path = str(tmpdir.join("replay.cache"))
+    clock = Clock()
+    cache = MmapReplayCache(path, 4, max_capacity=8, reactor=clock, compact_batch=2)
+    for i in range(3):
+        cache.set_seen(make_tag(i))
+    # compaction starts at the high water mark and runs on later reactor turns
+    assert cache.compacting
+    assert cache.capacity == 4
+
+    # the old file fills up while the tags are being copied
+    for i in range(3, 6):
+        cache.set_seen(make_tag(i))
+    assert len(cache) == 4
+    assert cache.test_and_set([make_tag(5), make_tag(6)]) == [True, False]
+    assert all(cache.has_seen(make_tag(i)) for i in range(7))
+
+    assert len(clock.getDelayedCalls()) == 1
+    clock.advance(0)
+    assert not cache.compacting
+    assert cache.capacity == 8
+    assert len(cache) == 7
+    cache.set_seen(make_tag(7))
+    with pytest.raises(ReplayCacheFullError):
+        cache.set_seen(make_tag(8))
+    cache.close()
+
+    cache = MmapReplayCache(path, 4)
+    assert cache.capacity == 8
+    assert sorted(cache.tags()) == sorted(make_tag(i) for i in range(8))
+    cache.close()
+
+
+def test_mmap_replay_cache_bad_file(tmpdir):
+    path = tmpdir.join("replay.cache")
+    path.write(b"\x00" * 100)
+    with pytest.raises(ReplayCacheFileError):
+        MmapReplayCache(str(path), 10)
+
+
+def test_mmap_replay_cache_close_while_compacting(tmpdir):
+    path = str(tmpdir.join("replay.cache"))
+    cache = MmapReplayCache(path, 4, max_capacity=8, reactor=Clock())
+    for i in range(6):
+        cache.set_seen(make_tag(i))
+    cache.close()
+
+    cache = MmapReplayCache(path, 4)
+    assert cache.capacity == 8
+    assert sorted(cache.tags()) == sorted(make_tag(i) for i in range(6))
+    cache.close()
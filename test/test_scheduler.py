@@ -0,0 +1,77 @@
+
+from twisted.internet.task import Clock
+
+from txmix.scheduler import TimerWheel, HeapScheduler
+
+
+def test_timer_wheel():
+    clock = Clock()
+    released = []
+    wheel = TimerWheel(clock, 1.0, 4, lambda x: released.append(sorted(x)))
+    wheel.schedule(2, "a")
+    wheel.schedule(1.5, "b")
+    wheel.schedule(2, "c")
+    wheel.schedule(3, "d")
+    assert len(wheel) == 4
+    assert len(clock.getDelayedCalls()) == 1
+
+    clock.advance(1)
+    assert released == []
+    clock.advance(1)
+    assert released == [["a", "b", "c"]]
+    clock.advance(1)
+    assert released == [["a", "b", "c"], ["d"]]
+    assert len(wheel) == 0
+    assert clock.getDelayedCalls() == []
+
+
+def test_timer_wheel_never_early_and_catches_up():
+    clock = Clock()
+    clock.advance(0.5)
+    released = []
+    wheel = TimerWheel(clock, 1.0, 4, lambda x: released.extend(x))
+    wheel.schedule(0.2, "a")
+    clock.advance(0.4)
+    assert released == []
+    clock.advance(0.1)
+    assert released == ["a"]
+
+    # delays longer than the wheel wait for their round
+    wheel.schedule(6, "b")
+    clock.advance(5)
+    assert released == ["a"]
+    clock.advance(1)
+    assert released == ["a", "b"]
+
+    # a reactor which stalls for longer than the wheel releases everything due
+    wheel.schedule(1, "c")
+    wheel.schedule(2, "d")
+    wheel.schedule(20, "e")
+    clock.pump([10])
+    assert released == ["a", "b", "c", "d"]
+    assert wheel.stop() == ["e"]
+    assert clock.getDelayedCalls() == []
+
+
+def test_heap_scheduler():
+    clock = Clock()
+    released = []
+    scheduler = HeapScheduler(clock, lambda x: released.append(x))
+    scheduler.schedule(5, "a")
+    scheduler.schedule(2, "b")
+    scheduler.schedule(2, "c")
+    scheduler.schedule(9, "d")
+    assert len(clock.getDelayedCalls()) == 1
+    assert clock.getDelayedCalls()[0].getTime() == 2
+
+    clock.advance(2)
+    assert released == [["b", "c"]]
+    # a late timer releases everything which has come due at once
+    clock.advance(8)
+    assert released == [["b", "c"], ["a", "d"]]
+    assert len(scheduler) == 0
+    assert clock.getDelayedCalls() == []
+
+    scheduler.schedule(1, "e")
+    assert scheduler.stop() == ["e"]
+    assert clock.getDelayedCalls() == []
@@ -0,0 +1,217 @@
+
+import os
+import socket
+import shutil
+import tempfile
+
+import pytest
+
+from zope.interface import implementer
+from twisted.internet import reactor, defer
+from twisted.internet.error import ProcessTerminated
+from twisted.internet.interfaces import IReactorProcess
+from twisted.internet.task import deferLater, Clock
+from twisted.python.failure import Failure
+
+from sphinxmixcrypto import SphinxParams, SphinxPacket, ReplayError
+
+from txmix import UDPTransport, ThresholdMixNode, DummyPKI, ShardedMixSupervisor, SharedMmapReplayCache, EpochKeyState
+from txmix.sharding import encode_unwrapped_message, decode_unwrapped_message, encode_frame, READY_FRAME
+from txmix.sharding import ShardWorkerProcessProtocol, WorkerKeyState, worker_keys
+from txmix.unwrap import unwrap_raw_packet
+from test_txmix import generate_node_id, generate_node_keypair, ChachaNoiseReader, MixKeyState, SEED, build_route
+
+
+class CollectingProtocol(object):
+    def __init__(self):
+        self.messages = []
+
+    def received(self, message):
+        self.messages.append(message)
+
+
+def free_udp_port():
+    skt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    skt.bind(("127.0.0.1", 0))
+    port = skt.getsockname()[1]
+    skt.close()
+    return port
+
+
+def test_shared_replay_cache_set_seen():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "replay.cache")
+        cache1 = SharedMmapReplayCache(path, 100)
+        cache2 = SharedMmapReplayCache(path, 100)
+        tag = os.urandom(32)
+        assert not cache1.has_seen(tag)
+        assert not cache2.has_seen(tag)
+        cache1.set_seen(tag)
+        with pytest.raises(ReplayError):
+            cache2.set_seen(tag)
+        assert cache2.test_and_set([tag, os.urandom(32)]) == [True, False]
+        assert len(cache1) == 2
+        cache1.close()
+        cache2.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_unwrapped_message_frames():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    route, key_states = build_route(pki, rand_reader)
+    sphinx_packet = SphinxPacket.forward_message(params, route, pki, route[-1], b"ping", rand_reader)
+    _, unwrapped = unwrap_raw_packet(params, key_states[route[0]], sphinx_packet.get_raw_bytes())
+    assert decode_unwrapped_message(params, encode_unwrapped_message(unwrapped)) == unwrapped
+
+
+class FrameCollectingSupervisor(object):
+    def __init__(self, params):
+        self.node = type("Node", (object,), {"params": params})()
+        self.batches = []
+
+    def worker_messages_received(self, index, messages):
+        self.batches.append(messages)
+
+
+def test_shard_worker_frames():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    node_id = generate_node_id(rand_reader)
+    key_state = MixKeyState(*generate_node_keypair(rand_reader))
+    pki.set(node_id, key_state.get_public_key(), 0)
+    frames = b""
+    for _ in range(3):
+        raw_packet = SphinxPacket.forward_message(params, [node_id, node_id], pki, node_id, b"ping", rand_reader).get_raw_bytes()
+        frames += encode_frame(encode_unwrapped_message(unwrap_raw_packet(params, key_state, raw_packet)[1]))
+
+    supervisor = FrameCollectingSupervisor(params)
+    process_protocol = ShardWorkerProcessProtocol(supervisor, 0)
+    process_protocol.outReceived(encode_frame(READY_FRAME) + frames[:-10])
+    assert process_protocol.ready.called
+    assert len(supervisor.batches[0]) == 2
+    process_protocol.outReceived(frames[-10:])
+    assert len(supervisor.batches[1]) == 1
+    assert process_protocol._buffer == b""
+
+
+def test_worker_key_state():
+    rand_reader = ChachaNoiseReader(SEED)
+    first, second = generate_node_keypair(rand_reader), generate_node_keypair(rand_reader)
+    key_state = EpochKeyState(0, *first)
+    worker_key_state = WorkerKeyState(worker_keys(key_state))
+    assert worker_key_state.get_private_key() == first[1]
+    key_state.rotate(1, *second)
+    worker_key_state.update(worker_keys(key_state))
+    assert worker_key_state.epoch == 1
+    assert [key.get_public_key() for key in worker_key_state.live_keys()] == [second[0], first[0]]
+
+
+@implementer(IReactorProcess)
+class SpawnRecordingClock(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, process_protocol, *args, **kwargs):
+        self.spawned.append(process_protocol)
+
+
+def test_sharded_mix_supervisor_restart_backoff():
+    tmpdir = tempfile.mkdtemp()
+    clock = SpawnRecordingClock()
+    node = type("Node", (object,), {})()
+    node.start = lambda: defer.succeed(None)
+    node.replay_cache = SharedMmapReplayCache(os.path.join(tmpdir, "replay.cache"), 10)
+    node.transport = type("Transport", (object,), {"reuse_port": True})()
+    node.key_state = MixKeyState(*generate_node_keypair(ChachaNoiseReader("00" * 32)))
+    supervisor = ShardedMixSupervisor(node, 1, reactor=clock, restart_delay=1, max_restart_delay=3)
+    try:
+        supervisor.start().addErrback(lambda failure: None)
+        ended = Failure(ProcessTerminated(exitCode=1))
+        for delay in (1, 2, 3, 3):
+            clock.spawned[-1].processEnded(ended)
+            clock.advance(delay - 0.5)
+            spawned = len(clock.spawned)
+            clock.advance(0.5)
+            assert len(clock.spawned) == spawned + 1
+
+        # a worker which starts listening resets the delay
+        clock.spawned[-1].outReceived(encode_frame(READY_FRAME))
+        clock.spawned[-1].processEnded(ended)
+        clock.advance(1)
+        assert len(clock.spawned) == 6
+        clock.spawned[-1].processEnded(ended)
+        supervisor.stop()
+        assert clock.getDelayedCalls() == []
+    finally:
+        node.replay_cache.close()
+        shutil.rmtree(tmpdir)
+
+
+@pytest.inlineCallbacks
+def test_sharded_mix_supervisor():
+    tmpdir = tempfile.mkdtemp()
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    node_id = generate_node_id(rand_reader)
+    public_key, private_key = generate_node_keypair(rand_reader)
+    addr = ("127.0.0.1", free_udp_port())
+    key_state = EpochKeyState(0, public_key, private_key)
+    node = ThresholdMixNode(4,
+                            node_id,
+                            SharedMmapReplayCache(os.path.join(tmpdir, "replay.cache"), 1000),
+                            key_state,
+                            params,
+                            pki,
+                            UDPTransport(reactor, addr, reuse_port=True),
+                            max_delay=0)
+    next_hop_id = generate_node_id(rand_reader)
+    next_hop_public_key, next_hop_private_key = generate_node_keypair(rand_reader)
+    next_hop = UDPTransport(reactor, ("127.0.0.1", 0))
+    collector = CollectingProtocol()
+    next_hop.register_protocol(collector)
+    yield next_hop.start()
+    pki.set(next_hop_id, next_hop_public_key, ("127.0.0.1", next_hop.port.getHost().port))
+    supervisor = ShardedMixSupervisor(node, 2)
+    yield supervisor.start()
+    senders = []
+    try:
+        # the workers are given the node's keys when they are rotated
+        public_key, private_key = generate_node_keypair(rand_reader)
+        key_state.rotate(1, public_key, private_key)
+        key_state.retire_previous()
+        pki.rotate(node_id, public_key, b"")
+        yield deferLater(reactor, 0.2, lambda: None)
+
+        route = [node_id, next_hop_id]
+        raw_packets = [SphinxPacket.forward_message(params, route, pki, next_hop_id, b"ping", rand_reader).get_raw_bytes()
+                       for _ in range(8)]
+        # each packet is sent, twice, from its own socket so that
+        # the kernel spreads them and their replays across the processes
+        for raw_packet in raw_packets + raw_packets:
+            skt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            skt.sendto(raw_packet, addr)
+            senders.append(skt)
+        for _ in range(300):
+            if len(collector.messages) == 8:
+                break
+            yield deferLater(reactor, 0.01, lambda: None)
+        yield deferLater(reactor, 0.2, lambda: None)
+        assert len(collector.messages) == 8
+        assert len(set(collector.messages)) == 8
+        assert len(node.replay_cache) == 8
+        assert supervisor.messages_from_workers > 0
+    finally:
+        for skt in senders:
+            skt.close()
+        yield supervisor.stop()
+        yield node.transport.port.stopListening()
+        yield next_hop.port.stopListening()
+        node.replay_cache.close()
+        shutil.rmtree(tmpdir)
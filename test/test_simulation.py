@@ -0,0 +1,72 @@
+
+from twisted.internet.task import Clock
+
+from sphinxmixcrypto import PacketReplayCacheDict, SphinxParams
+
+from txmix import ThresholdMixNode, MixClient, CascadeRouteFactory, DummyPKI
+from txmix.simulation import SimulatedNetwork, Link
+from test_txmix import generate_node_id, generate_node_keypair, ChachaNoiseReader, MixKeyState, SEED
+
+
+class Recorder(object):
+    def __init__(self, clock):
+        self.clock = clock
+        self.messages = []
+
+    def received(self, message):
+        self.messages.append((self.clock.seconds(), message))
+
+
+def test_simulated_links():
+    clock = Clock()
+    network = SimulatedNetwork(clock, Link(latency=0.05), seed=1)
+    network.set_link("a", "b", Link(latency=0.1, bandwidth=1000))
+    network.set_link("a", "c", Link(loss=1.0))
+    a = network.transport("a")
+    b = network.transport("b")
+    recorder = Recorder(clock)
+    b.register_protocol(recorder)
+    network.transport("c").register_protocol(recorder)
+
+    # the second datagram waits for the first to be sent
+    a.send("b", b"x" * 100)
+    a.send("b", b"y" * 100)
+    a.send("c", b"z")
+    b.send("a", b"lost")
+    assert network.in_flight == 3
+    network.run_until(3600)
+    assert clock.seconds() == 3600
+    assert [(round(t, 6), m[0]) for t, m in recorder.messages] == [(0.2, b"x"), (0.3, b"y")]
+    assert (network.sent, network.delivered, network.lost, network.unrouted) == (4, 2, 1, 1)
+    assert clock.getDelayedCalls() == []
+
+
+def test_simulated_cascade():
+    clock = Clock()
+    params = SphinxParams(5, 1024)
+    pki = DummyPKI()
+    rand_reader = ChachaNoiseReader(SEED)
+    network = SimulatedNetwork(clock, Link(latency=0.01, jitter=0.01), seed=1)
+    route = []
+    for i in range(3):
+        node_id = generate_node_id(rand_reader)
+        public_key, private_key = generate_node_keypair(rand_reader)
+        mix = ThresholdMixNode(2, node_id, PacketReplayCacheDict(), MixKeyState(public_key, private_key),
+                               params, pki, network.transport(("mix", i)), clock, max_delay=10)
+        mix.start()
+        route.append(node_id)
+
+    clients = []
+    received = []
+    for i in range(2):
+        client = MixClient(params, pki, b"%016d" % i, rand_reader, network.transport(("client", i)),
+                           lambda x: received.append((clock.seconds(), x)), CascadeRouteFactory(route), clock)
+        client.start()
+        clients.append(client)
+
+    for i in range(4):
+        clients[0].reply(clients[1].create_reply_block(), b"message %d" % i)
+    network.run_until(3600)
+    assert sorted(x.payload[:9] for _, x in received) == [b"message %d" % i for i in range(4)]
+    assert all(0.03 <= t <= 30.06 for t, _ in received)
+    assert network.failed == 0
@@ -8,15 +8,18 @@ import pytest
 from eliot import add_destination
 from Cryptodome.Cipher import ChaCha20
 from twisted.internet import defer
+from twisted.internet.task import Clock
 from zope.interface import implementer
 
-from sphinxmixcrypto import PacketReplayCacheDict, GroupCurve25519, SphinxParams, SECURITY_PARAMETER
+from sphinxmixcrypto import PacketReplayCacheDict, GroupCurve25519, SphinxParams, SphinxPacket, SECURITY_PARAMETER
 from sphinxmixcrypto import IReader, IKeyState
 
 from txmix.interfaces import IMixTransport
-from txmix.mix import ThresholdMixNode
-from txmix.client import MixClient, RandomRouteFactory
+from txmix.mix import ThresholdMixNode, ContinuousTimeMixNode, StopAndGoMixNode
+from txmix.client import MixClient, RandomRouteFactory, SampledRouteFactory
 from txmix.utils import DummyPKI
+from txmix.replay_cache import ReplayTagTable, ReplayCacheFullError
+from txmix import metrics
 
 
 # tell eliot to log a line of json for each message to stdout
@@ -27,6 +30,9 @@ def stdout(message):
 add_destination(stdout)
 
 
+SEED = "47ade5905376604cde0b57e732936b4298281c8a67b6a62c6107482eb69e2941"
+
+
 def generate_node_id(rand_reader):
     idnum = rand_reader.read(4)
     node_id = b"\xff" + idnum + (b"\x00" * (SECURITY_PARAMETER - len(idnum) - 1))
@@ -54,6 +60,22 @@ class MixKeyState:
         return self.public_key
 
 
+def build_route(pki, rand_reader, hops=3):
+    """
+    add hops mix nodes to pki, returns a 2-tuple of their node IDs
+    in the order they were added and a dict of their key states
+    """
+    route = []
+    key_states = {}
+    for addr in range(hops):
+        node_id = generate_node_id(rand_reader)
+        public_key, private_key = generate_node_keypair(rand_reader)
+        pki.set(node_id, public_key, addr)
+        route.append(node_id)
+        key_states[node_id] = MixKeyState(public_key, private_key)
+    return route, key_states
+
+
 @implementer(IReader)
 class ChachaNoiseReader():
     """
@@ -126,7 +148,7 @@ def build_mixnet_nodes(pki, params, rand_reader):
 def test_node_protocol():
     pki = DummyPKI()
     params = SphinxParams(5, 1024)
-    rand_reader = ChachaNoiseReader("47ade5905376604cde0b57e732936b4298281c8a67b6a62c6107482eb69e2941")
+    rand_reader = ChachaNoiseReader(SEED)
 
     nodes, addr_to_nodes = yield build_mixnet_nodes(pki, params, rand_reader)
     dummy_client_transport = DummyTransport(99)
@@ -145,3 +167,175 @@ def test_node_protocol():
     yield client.send(destination, message)
     address, raw_sphinx_packet = dummy_client_transport.sent.pop()
     addr_to_nodes[address].protocol.received(raw_sphinx_packet)
+
+
+@pytest.inlineCallbacks
+def test_node_protocol_received_batch():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    nodes, addr_to_nodes = yield build_mixnet_nodes(pki, params, rand_reader)
+    route = RandomRouteFactory(params, pki, rand_reader).build_route()
+    raw_packets = [SphinxPacket.forward_message(params, route, pki, route[-1], b"ping", rand_reader).get_raw_bytes()
+                   for _ in range(3)]
+    node = nodes[route[0]]
+    node.protocol.received_batch(raw_packets + [raw_packets[0], b"garbage"])
+    assert len(node._batch) == 3
+    assert all(x.next_hop[0] == route[1] for x in node._batch.values())
+
+    # a replay in a later batch is also dropped
+    node.protocol.received_batch(raw_packets[1:2])
+    assert len(node._batch) == 3
+
+
+@pytest.inlineCallbacks
+def test_node_protocol_received_batch_replay_cache_full():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    nodes, addr_to_nodes = yield build_mixnet_nodes(pki, params, rand_reader)
+    route = RandomRouteFactory(params, pki, rand_reader).build_route()
+    raw_packets = [SphinxPacket.forward_message(params, route, pki, route[-1], b"ping", rand_reader).get_raw_bytes()
+                   for _ in range(3)]
+    node = nodes[route[0]]
+    node.protocol.replay_cache = ReplayTagTable(2)
+    full = metrics.REPLAY_CACHE_FULL.value
+
+    # only the packet which does not fit in the replay cache is dropped
+    node.protocol.received_batch(raw_packets)
+    assert len(node._batch) == 2
+    assert metrics.REPLAY_CACHE_FULL.value == full + 1
+    with pytest.raises(ReplayCacheFullError):
+        node.protocol.received(raw_packets[2])
+    assert metrics.REPLAY_CACHE_FULL.value == full + 2
+
+
+def test_threshold_mix_messages_received():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    public_key, private_key = generate_node_keypair(rand_reader)
+    clock = Clock()
+    mix = ThresholdMixNode(3, generate_node_id(rand_reader), PacketReplayCacheDict(), MixKeyState(public_key, private_key),
+                           params, pki, DummyTransport(0), clock)
+    mix.start()
+    mix.messages_received(list(range(7)))
+    assert len(mix._pending_batch_sends) == 2
+    assert len(mix._batch) == 1
+
+
+def test_continuous_time_mix_timer_wheel():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    public_key, private_key = generate_node_keypair(rand_reader)
+    clock = Clock()
+    mix = ContinuousTimeMixNode(generate_node_id(rand_reader), 10, DummyTransport(0), PacketReplayCacheDict(),
+                                MixKeyState(public_key, private_key), params, pki, clock, timer_wheel_tick=1)
+    mix.start()
+    sent = []
+    mix.protocol.packet_proxy = lambda x: sent.append(x)
+    mix.messages_received(list(range(100)))
+    assert len(clock.getDelayedCalls()) == 1
+    clock.pump([1] * 11)
+    assert sorted(sent) == list(range(100))
+    assert clock.getDelayedCalls() == []
+
+
+def test_continuous_time_mix_timer_wheel_send_error():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    public_key, private_key = generate_node_keypair(rand_reader)
+    clock = Clock()
+    mix = ContinuousTimeMixNode(generate_node_id(rand_reader), 0, DummyTransport(0), PacketReplayCacheDict(),
+                                MixKeyState(public_key, private_key), params, pki, clock, timer_wheel_tick=1)
+    mix.start()
+    sent = []
+
+    def packet_proxy(message):
+        if message % 3 == 0:
+            raise KeyError(message)
+        sent.append(message)
+    mix.protocol.packet_proxy = packet_proxy
+    send_errors = metrics.SEND_ERRORS.value
+    mix.messages_received(list(range(10)))
+    clock.pump([1] * 2)
+    # a message which fails to send does not stop the rest of its tick
+    assert sorted(sent) == [1, 2, 4, 5, 7, 8]
+    assert metrics.SEND_ERRORS.value == send_errors + 4
+
+
+def test_stop_and_go_mix():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    public_key, private_key = generate_node_keypair(rand_reader)
+    clock = Clock()
+    mix = StopAndGoMixNode(generate_node_id(rand_reader), 2.0, DummyTransport(0), PacketReplayCacheDict(),
+                           MixKeyState(public_key, private_key), params, pki, clock)
+    mix.start()
+    sent = []
+    mix.protocol.packet_proxy = lambda x: sent.append(x)
+    mix.messages_received(list(range(1000)))
+    assert len(clock.getDelayedCalls()) == 1
+    clock.advance(2.0)
+    # about 1 - 1/e of the messages are due after the mean delay
+    assert 500 < len(sent) < 760
+    clock.advance(100)
+    assert sorted(sent) == list(range(1000))
+    assert clock.getDelayedCalls() == []
+
+
+def test_stop_and_go_mix_send_error():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    public_key, private_key = generate_node_keypair(rand_reader)
+    clock = Clock()
+    mix = StopAndGoMixNode(generate_node_id(rand_reader), 2.0, DummyTransport(0), PacketReplayCacheDict(),
+                           MixKeyState(public_key, private_key), params, pki, clock)
+    mix.start()
+    sent = []
+
+    def packet_proxy(message):
+        if message == 0:
+            raise KeyError(message)
+        sent.append(message)
+    mix.protocol.packet_proxy = packet_proxy
+    send_errors = metrics.SEND_ERRORS.value
+    mix.messages_received(list(range(100)))
+    # every message is due in one release, a failed send does not stop the rest
+    clock.advance(1000)
+    assert sorted(sent) == list(range(1, 100))
+    assert metrics.SEND_ERRORS.value == send_errors + 1
+    assert clock.getDelayedCalls() == []
+
+
+def test_sampled_route_factory():
+    pki = DummyPKI()
+    params = SphinxParams(3, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    for i in range(10):
+        pki.set(generate_node_id(rand_reader), b"\x00" * 32, i)
+    identities_calls = []
+    identities = pki.identities
+    pki.identities = lambda: identities_calls.append(1) or identities()
+    route_factory = SampledRouteFactory(params, pki, rand_reader)
+
+    counts = {}
+    for _ in range(3000):
+        route = route_factory.build_route()
+        assert len(set(route)) == 3
+        for position, node_id in enumerate(route):
+            counts[(position, node_id)] = counts.get((position, node_id), 0) + 1
+    assert len(identities_calls) == 1
+    # every mix is picked for every position about 300 times
+    assert len(counts) == 30
+    assert all(230 < x < 370 for x in counts.values())
+
+    node_id = generate_node_id(rand_reader)
+    pki.set(node_id, b"\x00" * 32, 10)
+    while node_id not in route_factory.build_route():
+        pass
+    assert len(identities_calls) == 2
@@ -0,0 +1,136 @@
+
+import errno
+import socket
+
+import pytest
+
+from twisted.internet import reactor, defer
+from twisted.internet.task import deferLater
+
+from txmix import UDPTransport
+from txmix import mmsg
+
+
+class ReceivingProtocol(object):
+    def __init__(self, batched):
+        self.messages = []
+        self.batches = []
+        if batched:
+            self.received_batch = self._received_batch
+
+    def received(self, message):
+        self.messages.append(message)
+
+    def _received_batch(self, messages):
+        self.batches.append(messages)
+        self.messages.extend(messages)
+
+
+def test_sockaddr_round_trip():
+    for addr in [("127.0.0.1", 4321), ("::1", 65535)]:
+        assert mmsg.decode_sockaddr(mmsg.encode_sockaddr(addr)) == addr
+
+
+@pytest.mark.skipif(not mmsg.available(), reason="recvmmsg and sendmmsg are unavailable")
+@pytest.inlineCallbacks
+def test_udp_transport_batch_io():
+    receiver = UDPTransport(reactor, ("127.0.0.1", 0), batch_io=True, batch_size=8)
+    receiving_protocol = ReceivingProtocol(batched=True)
+    receiver.register_protocol(receiving_protocol)
+    yield receiver.start()
+    sender = UDPTransport(reactor, ("127.0.0.1", 0), batch_io=True)
+    sender.register_protocol(ReceivingProtocol(batched=False))
+    yield sender.start()
+    try:
+        addr = ("127.0.0.1", receiver.port.getHost().port)
+        messages = [b"datagram %d" % i for i in range(20)]
+        for message in messages:
+            sender.send(addr, message)
+        for _ in range(100):
+            if len(receiving_protocol.messages) == len(messages):
+                break
+            yield deferLater(reactor, 0.01, lambda: None)
+        assert receiving_protocol.messages == messages
+        assert len(receiving_protocol.batches) < len(messages)
+        assert all(len(batch) <= 8 for batch in receiving_protocol.batches)
+        assert sender.port.send_drops == 0
+    finally:
+        yield defer.maybeDeferred(receiver.port.stopListening)
+        yield defer.maybeDeferred(sender.port.stopListening)
+
+
+@pytest.inlineCallbacks
+def test_udp_transport_batch_io_fallback(monkeypatch):
+    monkeypatch.setattr(mmsg, "available", lambda: False)
+    receiver = UDPTransport(reactor, ("127.0.0.1", 0), batch_io=True)
+    receiving_protocol = ReceivingProtocol(batched=False)
+    receiver.register_protocol(receiving_protocol)
+    yield receiver.start()
+    sender = UDPTransport(reactor, ("127.0.0.1", 0), batch_io=True)
+    yield sender.start()
+    try:
+        addr = ("127.0.0.1", receiver.port.getHost().port)
+        sender.send(addr, b"ping")
+        for _ in range(100):
+            if receiving_protocol.messages:
+                break
+            yield deferLater(reactor, 0.01, lambda: None)
+        assert receiving_protocol.messages == [b"ping"]
+    finally:
+        yield defer.maybeDeferred(receiver.port.stopListening)
+        yield defer.maybeDeferred(sender.port.stopListening)
+
+
+@pytest.mark.parametrize("batch_io", [False, True])
+@pytest.inlineCallbacks
+def test_udp_transport_send_parts(batch_io):
+    receiver = UDPTransport(reactor, ("127.0.0.1", 0))
+    receiving_protocol = ReceivingProtocol(batched=False)
+    receiver.register_protocol(receiving_protocol)
+    yield receiver.start()
+    sender = UDPTransport(reactor, ("127.0.0.1", 0), batch_io=batch_io)
+    yield sender.start()
+    try:
+        addr = ("127.0.0.1", receiver.port.getHost().port)
+        sender.send_parts(addr, [b"message id", b" and ", b"payload"])
+        for _ in range(100):
+            if receiving_protocol.messages:
+                break
+            yield deferLater(reactor, 0.01, lambda: None)
+        assert receiving_protocol.messages == [b"message id and payload"]
+    finally:
+        yield defer.maybeDeferred(receiver.port.stopListening)
+        yield defer.maybeDeferred(sender.port.stopListening)
+
+
+class FailingSender(object):
+    def __init__(self, errors):
+        self.errors = errors
+        self.sent = []
+
+    def send(self, fd, datagrams):
+        data = b"".join(datagrams[0][0])
+        if data in self.errors:
+            raise socket.error(self.errors[data], "failed")
+        self.sent.append(data)
+        return 1
+
+
+@pytest.mark.skipif(not mmsg.available(), reason="recvmmsg and sendmmsg are unavailable")
+@pytest.inlineCallbacks
+def test_mmsg_port_flush_drops_failed_datagram():
+    sender = UDPTransport(reactor, ("127.0.0.1", 0), batch_io=True)
+    sender.register_protocol(ReceivingProtocol(batched=False))
+    yield sender.start()
+    try:
+        port = sender.port
+        port._sender = FailingSender({b"too big": errno.EMSGSIZE, b"unreachable": errno.EHOSTUNREACH})
+        for data in (b"one", b"too big", b"two", b"unreachable", b"three"):
+            port.write_batched([data], ("127.0.0.1", 9))
+        port.flush()
+        # the datagrams after a failed one are still sent
+        assert port._sender.sent == [b"one", b"two", b"three"]
+        assert port.send_drops == 2
+        assert port._outgoing == []
+    finally:
+        yield defer.maybeDeferred(sender.port.stopListening)
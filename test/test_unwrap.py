@@ -0,0 +1,118 @@
+
+import pickle
+import pytest
+
+from zope.interface import implementer
+from twisted.internet import reactor, defer
+from twisted.internet.interfaces import IReactorThreads
+from twisted.internet.task import Clock
+
+from sphinxmixcrypto import PacketReplayCacheDict, SphinxParams, SphinxPacket
+from sphinxmixcrypto import sphinx_packet_unwrap
+
+from txmix import MixProtocol, ProcessPoolUnwrapper, UnwrapPoolFullError, UnwrapTimeoutError, DummyPKI
+from txmix import metrics
+from txmix.unwrap import unwrap_raw_packet, _pool_unwrap
+from test_txmix import generate_node_keypair, ChachaNoiseReader, MixKeyState, DummyTransport, SEED, build_route
+
+
+def test_unwrap_raw_packet():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    route, key_states = build_route(pki, rand_reader, 5)
+    sphinx_packet = SphinxPacket.forward_message(params, route, pki, route[-1], b"ping", rand_reader)
+    raw_sphinx_packet = sphinx_packet.get_raw_bytes()
+
+    tag, unwrapped = unwrap_raw_packet(params, key_states[route[0]], raw_sphinx_packet)
+    replay_cache = PacketReplayCacheDict()
+    expected = sphinx_packet_unwrap(params, replay_cache, key_states[route[0]], sphinx_packet)
+    assert unwrapped == expected
+    assert replay_cache.has_seen(tag)
+
+
+@pytest.inlineCallbacks
+def test_process_pool_unwrapper():
+    pki = DummyPKI()
+    params = SphinxParams(5, 1024)
+    rand_reader = ChachaNoiseReader(SEED)
+    route, key_states = build_route(pki, rand_reader, 5)
+    received = []
+    unwrapper = ProcessPoolUnwrapper(reactor, pool_size=2, max_in_flight=4)
+    protocol = MixProtocol(PacketReplayCacheDict(),
+                           key_states[route[0]],
+                           params,
+                           pki,
+                           packet_received_handler=lambda x: received.append(x),
+                           unwrapper=unwrapper)
+    yield protocol.make_connection(DummyTransport(0))
+    try:
+        raw_packets = [SphinxPacket.forward_message(params, route, pki, route[-1], b"ping", rand_reader).get_raw_bytes()
+                       for _ in range(4)]
+        yield defer.gatherResults([protocol.received(x) for x in raw_packets])
+        assert len(received) == 4
+        assert all(x.next_hop[0] == route[1] for x in received)
+
+        # replays are detected on the reactor thread even when in flight
+        # together, and dropped packets are counted without failing
+        replays = metrics.REPLAYS.value
+        yield defer.gatherResults([protocol.received(raw_packets[0]), protocol.received(raw_packets[0])])
+        assert metrics.REPLAYS.value == replays + 2
+        assert len(received) == 4
+
+        packet_errors = metrics.PACKET_ERRORS.value
+        yield protocol.received(b"\x00" * len(raw_packets[0]))
+        assert metrics.PACKET_ERRORS.value == packet_errors + 1
+
+        pool_full = metrics.UNWRAP_POOL_FULL.value
+        ds = [protocol.received(x) for x in raw_packets]
+        yield protocol.received(raw_packets[0])
+        assert metrics.UNWRAP_POOL_FULL.value == pool_full + 1
+        yield defer.gatherResults(ds)
+        assert unwrapper.in_flight == 0
+    finally:
+        unwrapper.stop()
+
+
+@implementer(IReactorThreads)
+class ThreadsClock(Clock):
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class LostResultPool(object):
+    """
+    a pool whose worker died, or whose result could not be pickled,
+    so that apply_async never calls back
+    """
+
+    def apply_async(self, func, args, callback=None, error_callback=None):
+        pass
+
+
+def test_process_pool_unwrapper_lost_result():
+    clock = ThreadsClock()
+    unwrapper = ProcessPoolUnwrapper(clock, pool_size=1, max_in_flight=1, unwrap_timeout=5)
+    unwrapper._pool = LostResultPool()
+    unwrapper._in_flight = 0
+    params = SphinxParams(5, 1024)
+    key_state = MixKeyState(*generate_node_keypair(ChachaNoiseReader(SEED)))
+    pool_full = metrics.UNWRAP_POOL_FULL.value
+
+    failures = []
+    unwrapper.unwrap(params, key_state, b"x").addErrback(failures.append)
+    unwrapper.unwrap(params, key_state, b"x").addErrback(failures.append)
+    assert failures[0].check(UnwrapPoolFullError)
+    assert metrics.UNWRAP_POOL_FULL.value == pool_full + 1
+
+    clock.advance(5)
+    assert failures[1].check(UnwrapTimeoutError)
+    assert unwrapper.in_flight == 0
+    unwrapper.unwrap(params, key_state, b"x").addErrback(failures.append)
+    assert unwrapper.in_flight == 1
+
+
+def test_pool_unwrap_errors_are_returned():
+    ok, error = _pool_unwrap(SphinxParams(5, 1024), [], b"not a sphinx packet")
+    assert not ok
+    pickle.dumps(error)
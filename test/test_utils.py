@@ -1,5 +1,7 @@
 
-from txmix import MixKeyState, EntropyReader
+import os
+
+from txmix import MixKeyState, EntropyReader, BufferedEntropyReader
 from test_txmix import generate_node_keypair
 
 
@@ -9,3 +11,29 @@ def test_mix_key_state():
     state = MixKeyState(public_key, private_key)
     assert state.public_key == public_key
     assert state.private_key == private_key
+
+
+def test_buffered_entropy_reader():
+    reader = BufferedEntropyReader(block_size=64)
+    data = [reader.read(n) for n in (1, 8, 16, 31, 32, 100, 3)]
+    assert [len(x) for x in data] == [1, 8, 16, 31, 32, 100, 3]
+    assert len(set(data)) == len(data)
+
+    # every byte served, and the key of the next block, is erased from the block
+    assert reader._block[:reader._offset] == bytearray(reader._offset)
+    assert reader._block[reader._offset:] != bytearray(reader.block_size - reader._offset)
+
+    # a child process reseeds instead of repeating its parent's output,
+    # even when most of the parent's block is left
+    reader = BufferedEntropyReader(block_size=4096)
+    reader.read(16)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(write_fd, reader.read(16))
+        os._exit(0)
+    os.waitpid(pid, 0)
+    child, parent = os.read(read_fd, 16), reader.read(16)
+    assert all(child[i:i + 4] != parent[i:i + 4] for i in range(0, 16, 4))
+    os.close(read_fd)
+    os.close(write_fd)
@@ -3,35 +3,80 @@ txmix - sphinx crypto and twisted python asynchronous networking library
 for constructing mix networks with reduced code complexity
 """
 
-from txmix.interfaces import IMixTransport, IRouteFactory
-from txmix.client import ClientProtocol, MixClient, RandomRouteFactory, CascadeRouteFactory
-from txmix.mix import MixProtocol, ThresholdMixNode, ContinuousTimeMixNode
+from txmix.interfaces import IMixTransport, IGatherTransport, IRouteFactory, IPacketUnwrapper, IBatchPacketReplayCache
+from txmix.interfaces import IEpochKeyState
+from txmix.client import ClientProtocol, MixClient, RandomRouteFactory, SampledRouteFactory, CascadeRouteFactory
+from txmix.precompute import HeaderPool, ReplyBlockPool
+from txmix.decryption_tokens import DecryptionTokenStore
+from txmix.mix import MixProtocol, ThresholdMixNode, ContinuousTimeMixNode, StopAndGoMixNode
+from txmix.unwrap import ProcessPoolUnwrapper, UnwrapPoolFullError, UnwrapWorkerError, UnwrapTimeoutError
+from txmix.key_rotation import EpochKeyState, KeyRotation
+from txmix.replay_cache import ReplayTagTable, EpochReplayCache, MmapReplayCache, SharedMmapReplayCache, ReplayCacheFullError
+from txmix.admission import AdmissionQueue
+from txmix.instrumentation import configure_packet_logging
+from txmix.metrics import MetricsRegistry, listen_metrics
 from txmix.udp_transport import UDPTransport
+from txmix.sharding import ShardedMixSupervisor
 from txmix.onion_transport import OnionTransport, OnionTransportFactory
-from txmix.utils import DummyPKI, EntropyReader, generate_node_keypair, generate_node_id, MixKeyState
+from txmix.simulation import SimulatedNetwork
+from txmix.pki import ConsensusPKI, ConsensusVersionError
+from txmix.utils import DummyPKI, EntropyReader, BufferedEntropyReader, generate_node_keypair, generate_node_id, MixKeyState
 
 __all__ = [
     "ClientProtocol",
     "Client",
     "MixClient",
+    "HeaderPool",
+    "ReplyBlockPool",
+    "DecryptionTokenStore",
 
     "MixProtocol",
     "ThresholdMixNode",
     "ContinuousTimeMixNode",
+    "StopAndGoMixNode",
+    "AdmissionQueue",
+    "ShardedMixSupervisor",
+
+    "IPacketUnwrapper",
+    "ProcessPoolUnwrapper",
+    "UnwrapPoolFullError",
+    "UnwrapWorkerError",
+    "UnwrapTimeoutError",
+
+    "IBatchPacketReplayCache",
+    "ReplayTagTable",
+    "EpochReplayCache",
+    "MmapReplayCache",
+    "SharedMmapReplayCache",
+    "ReplayCacheFullError",
+
+    "IEpochKeyState",
+    "EpochKeyState",
+    "KeyRotation",
 
     "IRouteFactory",
     "RandomRouteFactory",
+    "SampledRouteFactory",
     "CascadeRouteFactory",
 
     "IMixTransport",
+    "IGatherTransport",
     "UDPTransport",
     "OnionTransport",
     "OnionTransportFactory",
+    "SimulatedNetwork",
+
+    "configure_packet_logging",
+    "MetricsRegistry",
+    "listen_metrics",
 
     "NodeDescriptor",
     "SphinxPacketEncoding",
     "DummyPKI",
+    "ConsensusPKI",
+    "ConsensusVersionError",
     "EntropyReader",
+    "BufferedEntropyReader",
     "MixKeyState",
     "generate_node_keypair",
     "generate_node_id",
@@ -0,0 +1,129 @@
+"""
+admission control for the messages a mix node holds
+
+A node admits each unwrapped message into its AdmissionQueue before
+queueing it for sending and removes it again just before it is sent.
+The queue bounds the number of messages and bytes held and, when a
+new message would exceed a bound, applies one of three overflow
+policies. Every operation is O(1) so that admission control never
+becomes the hot spot under a flood.
+"""
+
+import random
+
+from txmix.metrics import QUEUED_MESSAGES
+
+
+REJECT_NEW = "reject_new"
+DROP_RANDOM = "drop_random"
+DROP_OLDEST = "drop_oldest"
+OVERFLOW_POLICIES = (REJECT_NEW, DROP_RANDOM, DROP_OLDEST)
+
+
+def message_size(unwrapped_message):
+    """
+    return the number of bytes held by an UnwrappedMessage
+    without encoding it
+    """
+    if unwrapped_message.next_hop:
+        destination, sphinx_packet = unwrapped_message.next_hop
+        header = sphinx_packet.header
+        return len(header.alpha) + len(header.beta) + len(header.gamma) + len(sphinx_packet.body.delta)
+    if unwrapped_message.client_hop:
+        client_id, message_id, client_message = unwrapped_message.client_hop
+        return len(client_id) + len(message_id) + len(client_message.delta)
+    if unwrapped_message.exit_hop:
+        destination, body = unwrapped_message.exit_hop
+        return len(destination) + len(body)
+    return 0
+
+
+class AdmissionQueue(object):
+    """
+    i am a bounded set of the messages held by a mix node. admit
+    returns a handle for each message, which the node queues in its
+    place. when admitting a message would exceed max_messages or
+    max_bytes my policy either rejects it or drops the oldest or a
+    random held message to make room. dropped messages are counted
+    per policy in drop_counts and the node learns which were dropped
+    so it can forget their handles.
+
+    messages are kept in a dict keyed by handle and their handles in
+    a list, so a random message is dropped by swapping the last
+    handle into its place. handles are increasing integers so the
+    oldest message is found by advancing past removed handles.
+    """
+
+    def __init__(self, max_messages=None, max_bytes=None, policy=REJECT_NEW, rand=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy %r" % (policy,))
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._rand = random.SystemRandom() if rand is None else rand
+        self._messages = {}  # handle -> [message, size, index into self._handles]
+        self._handles = []
+        self._next_handle = 0
+        self._oldest_handle = 0
+        self.bytes = 0
+        self.drop_counts = dict((x, 0) for x in OVERFLOW_POLICIES)
+
+    def __len__(self):
+        return len(self._handles)
+
+    @property
+    def dropped(self):
+        return sum(self.drop_counts.values())
+
+    def _full(self, size):
+        if self.max_messages is not None and len(self._handles) + 1 > self.max_messages:
+            return True
+        return self.max_bytes is not None and self.bytes + size > self.max_bytes
+
+    def admit(self, message, size=0):
+        """
+        return a 2-tuple of the handle of the admitted message, or
+        None if it was rejected, and a list of the (handle, message)
+        2-tuples dropped to make room for it
+        """
+        dropped = []
+        if self._full(size):
+            if self.policy == REJECT_NEW or (self.max_bytes is not None and size > self.max_bytes):
+                self.drop_counts[REJECT_NEW] += 1
+                return None, dropped
+            while self._handles and self._full(size):
+                if self.policy == DROP_OLDEST:
+                    handle = self._oldest()
+                else:
+                    handle = self._handles[self._rand.randrange(len(self._handles))]
+                dropped.append((handle, self.remove(handle)))
+                self.drop_counts[self.policy] += 1
+        handle = self._next_handle
+        self._next_handle += 1
+        self._messages[handle] = [message, size, len(self._handles)]
+        self._handles.append(handle)
+        self.bytes += size
+        QUEUED_MESSAGES.inc()
+        return handle, dropped
+
+    def _oldest(self):
+        while self._oldest_handle not in self._messages:
+            self._oldest_handle += 1
+        return self._oldest_handle
+
+    def remove(self, handle):
+        """
+        remove and return the message with the given handle,
+        or None if it was dropped
+        """
+        entry = self._messages.pop(handle, None)
+        if entry is None:
+            return None
+        message, size, index = entry
+        last_handle = self._handles.pop()
+        if last_handle != handle:
+            self._handles[index] = last_handle
+            self._messages[last_handle][2] = index
+        self.bytes -= size
+        QUEUED_MESSAGES.dec()
+        return message
@@ -1,17 +1,24 @@
 
 import attr
 import types
+import struct
 import binascii
 
 from eliot import start_action
 from eliot.twisted import DeferredContext
 
 from zope.interface import implementer
+from twisted.internet.interfaces import IReactorTime
+from twisted.internet import reactor
 
-from sphinxmixcrypto import SphinxParams, SphinxPacket, ReplyBlock
+from sphinxmixcrypto import SphinxParams, ReplyBlock
 from sphinxmixcrypto import IMixPKI, IReader, SECURITY_PARAMETER
 
 from txmix import IMixTransport, IRouteFactory
+from txmix.metrics import CLIENT_MESSAGES_SENT, CLIENT_MESSAGES_RECEIVED
+from txmix.precompute import PrecomputedHeader, HeaderPool, ReplyBlockPool
+from txmix.decryption_tokens import DecryptionTokenStore, compose_reply_block
+from txmix.framing import sphinx_packet_parts, split_client_packet, send_parts, client_frame_size
 
 
 @attr.s
@@ -20,6 +27,10 @@ class ClientProtocol(object):
     I am a sphinx mix network client protocol which means I act as a
     proxy between the client and the transport.  I decrypt messages
     before proxying them.
+
+    the decryption tokens of my reply blocks are held in a
+    DecryptionTokenStore until their reply is decrypted, for at
+    most token_ttl seconds and at most max_tokens of them.
     """
 
     params = attr.ib(validator=attr.validators.instance_of(SphinxParams))
@@ -27,6 +38,16 @@ class ClientProtocol(object):
     client_id = attr.ib(validator=attr.validators.instance_of(bytes))
     rand_reader = attr.ib(validator=attr.validators.provides(IReader))
     packet_received_handler = attr.ib(validator=attr.validators.instance_of(types.FunctionType))
+    reactor = attr.ib(validator=attr.validators.provides(IReactorTime), default=reactor)
+    token_ttl = attr.ib(default=3600)
+    max_tokens = attr.ib(validator=attr.validators.instance_of(int), default=100000)
+
+    @property
+    def frame_size(self):
+        """
+        the size of every packet i receive
+        """
+        return client_frame_size(self.params)
 
     def make_connection(self, transport):
         """
@@ -34,7 +55,7 @@ class ClientProtocol(object):
         and start the transport
         """
         assert IMixTransport.providedBy(transport)
-        self._decryption_tokens = {}
+        self.decryption_tokens = DecryptionTokenStore(self.reactor, self.token_ttl, self.max_tokens)
         transport.register_protocol(self)
         d = transport.start()
         self.transport = transport
@@ -43,10 +64,10 @@ class ClientProtocol(object):
     def received(self, packet):
         """
         receive a client packet, a message ID
-        and an encrypted payload
+        and an encrypted payload, which is decrypted
+        without being copied out of the packet
         """
-        message_id = packet[:16]
-        payload = packet[16:]
+        message_id, payload = split_client_packet(packet)
         assert len(payload) == self.params.payload_size
         self.message_received(message_id, payload)
 
@@ -54,7 +75,7 @@ class ClientProtocol(object):
         """
         decrypt the message and pass it to the message handler
         """
-        message = self._decryption_tokens[message_id].decrypt(ciphertext)
+        message = self.decryption_tokens.pop(message_id).decrypt(ciphertext)
         self.packet_received_handler(message)
 
     def send(self, route, message):
@@ -62,22 +83,46 @@ class ClientProtocol(object):
         send a wrapped inside a forward sphinx packet
         """
         first_hop_addr = self.pki.get_mix_addr(self.transport.name, route[0])
-        sphinx_packet = SphinxPacket.forward_message(self.params, route, self.pki, route[-1], message, self.rand_reader)
-        raw_sphinx_packet = sphinx_packet.get_raw_bytes()
-        return self.transport.send(first_hop_addr, raw_sphinx_packet)
+        precomputed_header = PrecomputedHeader.build(self.params, route, self.pki, self.rand_reader)
+        sphinx_packet = precomputed_header.compose_forward_message(self.params, message)
+        return send_parts(self.transport, first_hop_addr, sphinx_packet_parts(sphinx_packet))
+
+    def send_precomputed(self, precomputed_header, message):
+        """
+        send a message inside a forward sphinx packet
+        built with the given PrecomputedHeader
+        """
+        first_hop_addr = self.pki.get_mix_addr(self.transport.name, precomputed_header.route[0])
+        sphinx_packet = precomputed_header.compose_forward_message(self.params, message)
+        return send_parts(self.transport, first_hop_addr, sphinx_packet_parts(sphinx_packet))
+
+    def compose_reply_block(self, route):
+        """
+        return a 3-tuple of the message ID, the secrets and a new reply
+        block for the given route, whose decryption token is not held
+        until it is passed to add_decryption_token
+        """
+        message_id = self.rand_reader.read(SECURITY_PARAMETER)
+        secrets, reply_block = compose_reply_block(message_id,
+                                                   self.params,
+                                                   route,
+                                                   self.pki,
+                                                   self.client_id,
+                                                   self.rand_reader)
+        return message_id, secrets, reply_block
+
+    def add_decryption_token(self, message_id, secrets):
+        """
+        hold the decryption token of a reply block for token_ttl seconds
+        """
+        self.decryption_tokens.add(message_id, secrets)
 
     def create_reply_block(self, route):
         """
         given a route and a client ID
         """
-        message_id = self.rand_reader.read(SECURITY_PARAMETER)
-        decryption_token, reply_block = ReplyBlock.compose_reply_block(message_id,
-                                                                       self.params,
-                                                                       route,
-                                                                       self.pki,
-                                                                       self.client_id,
-                                                                       self.rand_reader)
-        self._decryption_tokens[decryption_token.message_id] = decryption_token
+        message_id, secrets, reply_block = self.compose_reply_block(route)
+        self.add_decryption_token(message_id, secrets)
         return reply_block
 
 
@@ -103,6 +148,56 @@ class RandomRouteFactory(object):
         return [x[1] for x in nodeids[:self.params.max_hops]]
 
 
+def random_below(rand_reader, n):
+    """
+    return an integer drawn uniformly from [0, n) using rand_reader
+    """
+    assert 0 < n <= 2 ** 32
+    # reject the values above the largest multiple of n so that none is favoured
+    limit = (2 ** 32 // n) * n
+    while True:
+        value = struct.unpack("!I", rand_reader.read(4))[0]
+        if value < limit:
+            return value % n
+
+
+@implementer(IRouteFactory)
+@attr.s
+class SampledRouteFactory(object):
+    """
+    I create random routes like RandomRouteFactory but in O(max_hops)
+    time and entropy. I cache the pki's identities, which are fetched
+    again whenever the pki's version attribute changes or on every
+    route if it has none, and pick max_hops of them with a partial
+    Fisher-Yates shuffle of the cache, which keeps every ordered
+    choice of distinct mixes equally likely.
+    """
+    params = attr.ib(validator=attr.validators.instance_of(SphinxParams))
+    pki = attr.ib(validator=attr.validators.provides(IMixPKI))
+    rand_reader = attr.ib(validator=attr.validators.provides(IReader))
+    _mixes = attr.ib(init=False, default=None)
+    _pki_version = attr.ib(init=False, default=None)
+
+    def _identities(self):
+        version = getattr(self.pki, "version", None)
+        if self._mixes is None or version is None or version != self._pki_version:
+            self._mixes = list(self.pki.identities())
+            self._pki_version = version
+        return self._mixes
+
+    def build_route(self):
+        """
+        return a new random route
+        """
+        mixes = self._identities()
+        hops = self.params.max_hops
+        assert len(mixes) >= hops
+        for i in range(hops):
+            j = i + random_below(self.rand_reader, len(mixes) - i)
+            mixes[i], mixes[j] = mixes[j], mixes[i]
+        return mixes[:hops]
+
+
 @implementer(IRouteFactory)
 @attr.s
 class CascadeRouteFactory(object):
@@ -116,6 +211,17 @@ class CascadeRouteFactory(object):
 class MixClient(object):
     """
     i am a client of the mixnet.
+
+    if header_pool_depth is set i keep that many forward sphinx
+    headers for routes from my route_factory in a HeaderPool, so that
+    a send only has to encrypt the message. headers older than
+    header_pool_max_age seconds are dropped. when the pool is empty
+    a send builds its whole packet as usual.
+
+    likewise if reply_block_high_watermark is set i keep reply blocks
+    in a ReplyBlockPool, refilled up to that many whenever fewer than
+    reply_block_low_watermark are left, for create_reply_block to
+    hand out.
     """
 
     params = attr.ib(validator=attr.validators.instance_of(SphinxParams))
@@ -125,21 +231,50 @@ class MixClient(object):
     transport = attr.ib(validator=attr.validators.provides(IMixTransport))
     message_received_handler = attr.ib(validator=attr.validators.instance_of(types.FunctionType))
     route_factory = attr.ib(validator=attr.validators.provides(IRouteFactory))
+    reactor = attr.ib(validator=attr.validators.provides(IReactorTime), default=reactor)
+    header_pool_depth = attr.ib(validator=attr.validators.instance_of(int), default=0)
+    header_pool_max_age = attr.ib(default=600)
+    reply_block_low_watermark = attr.ib(validator=attr.validators.instance_of(int), default=0)
+    reply_block_high_watermark = attr.ib(validator=attr.validators.instance_of(int), default=0)
+    reply_block_max_age = attr.ib(default=None)
 
     def start(self):
         """
         start the mix client
         """
         self.protocol = ClientProtocol(self.params, self.pki, self.client_id, self.rand_reader,
-                                       packet_received_handler=lambda x: self.message_received(x))
+                                       packet_received_handler=lambda x: self.message_received(x),
+                                       reactor=self.reactor)
         d = self.protocol.make_connection(self.transport)
-        self.pki.set_client_addr("onion", self.protocol.client_id, self.transport.addr)
+        self.pki.set_client_addr(self.transport.name, self.protocol.client_id, self.transport.addr)
+        self.header_pool = None
+        if self.header_pool_depth > 0:
+            self.header_pool = HeaderPool(self.params, self.pki, self.route_factory, self.rand_reader,
+                                          self.reactor, self.header_pool_depth, self.header_pool_max_age)
+            self.header_pool.start()
+        self.reply_block_pool = None
+        if self.reply_block_high_watermark > 0:
+            self.reply_block_pool = ReplyBlockPool(self.protocol, self.route_factory, self.reactor,
+                                                   self.reply_block_low_watermark, self.reply_block_high_watermark,
+                                                   self.reply_block_max_age)
+            self.reply_block_pool.start()
         return d
 
+    def stop(self):
+        """
+        stop the mix client's header and reply block pools
+        and the expiry of its decryption tokens
+        """
+        for pool in (self.header_pool, self.reply_block_pool):
+            if pool is not None:
+                pool.stop()
+        self.protocol.decryption_tokens.stop()
+
     def message_received(self, message):
         """
         receive a message
         """
+        CLIENT_MESSAGES_RECEIVED.inc()
         action = start_action(
             action_type=u"mix client:message received",
             client_id=binascii.hexlify(self.client_id),
@@ -152,18 +287,29 @@ class MixClient(object):
         send a message to the given destination
         returns a deferred
         """
+        CLIENT_MESSAGES_SENT.inc()
         action = start_action(
             action_type=u"mix client:message send",
             client_id=binascii.hexlify(self.client_id),
         )
         with action.context():
-            d = self.protocol.send(self.route_factory.build_route(), message)
+            precomputed_header = None
+            if self.header_pool is not None:
+                precomputed_header = self.header_pool.take()
+            if precomputed_header is None:
+                d = self.protocol.send(self.route_factory.build_route(), message)
+            else:
+                d = self.protocol.send_precomputed(precomputed_header, message)
             return DeferredContext(d).addActionFinish()
 
     def create_reply_block(self):
         """
         return a new reply block for the given destination
         """
+        if self.reply_block_pool is not None:
+            reply_block = self.reply_block_pool.take()
+            if reply_block is not None:
+                return reply_block
         return self.protocol.create_reply_block(self.route_factory.build_route())
 
     def reply(self, reply_block, message):
@@ -172,5 +318,5 @@ class MixClient(object):
         """
         assert isinstance(reply_block, ReplyBlock)
         sphinx_packet = reply_block.compose_forward_message(self.params, message)
-        dest_addr = self.pki.get_mix_addr("onion", reply_block.destination)
-        return self.protocol.transport.send(dest_addr, sphinx_packet.get_raw_bytes())
+        dest_addr = self.pki.get_mix_addr(self.transport.name, reply_block.destination)
+        return send_parts(self.protocol.transport, dest_addr, sphinx_packet_parts(sphinx_packet))
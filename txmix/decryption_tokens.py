@@ -0,0 +1,129 @@
+"""
+a bounded, expiring store for reply block decryption tokens
+
+A client keeps a decryption token for every reply block it hands
+out until the reply arrives. Instead of sphinxmixcrypto's
+ReplyBlockDecryptionToken, which holds a Lioness key of several
+hundred bytes per hop, the store keeps the 32 byte secret of each hop
+in one string and derives the keys only when a reply is decrypted.
+Tokens are deleted when their reply is decrypted, when they are older
+than the store's ttl, or when the store is full and they are the
+oldest.
+"""
+
+import collections
+
+from sphinxmixcrypto import ReplyBlock, ReplyBlockDecryptionToken, SphinxLioness
+from sphinxmixcrypto import destination_encode
+
+from txmix.header import create_header
+from txmix.metrics import default_registry
+
+
+SECRET_SIZE = 32
+
+TOKENS_EXPIRED = default_registry.counter(
+    "txmix_client_decryption_tokens_expired_total", "reply block decryption tokens deleted unused after their ttl")
+TOKENS_EVICTED = default_registry.counter(
+    "txmix_client_decryption_tokens_evicted_total", "reply block decryption tokens deleted unused to bound the store")
+
+
+def compose_reply_block(message_id, params, route, pki, dest, rand_reader):
+    """
+    create a reply block like ReplyBlock.compose_reply_block, returns
+    a 2-tuple of the reply block's secrets as one string and the
+    reply block
+    """
+    header, secrets = create_header(params, route, pki, destination_encode(dest), message_id, rand_reader)
+    ktilde = rand_reader.read(SECRET_SIZE)
+    return ktilde + b"".join(secrets[:len(route)]), ReplyBlock(header, route[0], ktilde)
+
+
+def decryption_token(message_id, secrets):
+    """
+    return the ReplyBlockDecryptionToken for a reply block's secrets
+    """
+    block_cipher = SphinxLioness()
+    keys = [secrets[:SECRET_SIZE]]
+    for i in range(SECRET_SIZE, len(secrets), SECRET_SIZE):
+        keys.append(block_cipher.create_block_cipher_key(secrets[i:i + SECRET_SIZE]))
+    return ReplyBlockDecryptionToken(message_id, keys)
+
+
+class DecryptionTokenStore(object):
+    """
+    i hold the secrets of reply blocks by message ID for up to ttl
+    seconds and at most max_tokens of them, deleting the oldest to
+    make room. my entries are kept in the order they were added,
+    which is also the order in which they expire, so expiry only
+    looks at the oldest entries. it runs every expire_interval
+    seconds and deletes at most expire_batch entries per reactor
+    turn so that it never pauses the reactor for long.
+    """
+
+    def __init__(self, reactor, ttl=3600, max_tokens=100000, expire_interval=10, expire_batch=1000):
+        assert ttl > 0 and max_tokens > 0 and expire_batch > 0
+        self.reactor = reactor
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        self.expire_interval = expire_interval
+        self.expire_batch = expire_batch
+        self._tokens = collections.OrderedDict()  # message ID -> (expiry time, secrets)
+        self._expire_call = None
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __contains__(self, message_id):
+        return message_id in self._tokens
+
+    def add(self, message_id, secrets):
+        """
+        hold the secrets of the reply block with the given message ID
+        """
+        while len(self._tokens) >= self.max_tokens:
+            self._tokens.popitem(last=False)
+            self.evicted += 1
+            TOKENS_EVICTED.inc()
+        self._tokens[message_id] = (self.reactor.seconds() + self.ttl, secrets)
+        if self._expire_call is None:
+            self._expire_call = self.reactor.callLater(self.expire_interval, self._expire)
+
+    def pop(self, message_id):
+        """
+        delete and return the decryption token of a reply block,
+        raises KeyError if it is unknown or has expired
+        """
+        expires, secrets = self._tokens.pop(message_id)
+        if expires <= self.reactor.seconds():
+            self.expired += 1
+            TOKENS_EXPIRED.inc()
+            raise KeyError(message_id)
+        return decryption_token(message_id, secrets)
+
+    def _expire(self):
+        self._expire_call = None
+        now = self.reactor.seconds()
+        deleted = 0
+        for message_id in self._tokens:
+            if deleted == self.expire_batch or self._tokens[message_id][0] > now:
+                break
+            deleted += 1
+        for _ in range(deleted):
+            self._tokens.popitem(last=False)
+        self.expired += deleted
+        TOKENS_EXPIRED.inc(deleted)
+        if deleted == self.expire_batch:
+            self._expire_call = self.reactor.callLater(0, self._expire)
+        elif self._tokens:
+            self._expire_call = self.reactor.callLater(self.expire_interval, self._expire)
+
+    def stop(self):
+        """
+        cancel my expiry timer
+        """
+        if self._expire_call is not None:
+            self._expire_call.cancel()
+            self._expire_call = None
@@ -0,0 +1,65 @@
+"""
+packets as sequences of byte strings
+
+A sphinx packet is sent as its four elements and a message to a
+client as its message ID and payload, without concatenating them.
+Transports providing IGatherTransport hand the parts to the kernel
+in one scatter/gather write; send_parts joins them, once, for any
+other transport.
+
+Received client packets are split with a zero-copy view of their
+payload, which the lioness cipher reads in place.
+"""
+
+from txmix.interfaces import IGatherTransport
+
+
+try:
+    _view = buffer
+except NameError:
+    def _view(data, offset):
+        return memoryview(data)[offset:]
+
+
+MESSAGE_ID_SIZE = 16
+
+
+def sphinx_packet_parts(sphinx_packet):
+    """
+    return the byte strings of a SphinxPacket's raw bytes, in order
+    """
+    header = sphinx_packet.header
+    return [header.alpha, header.beta, header.gamma, sphinx_packet.body.delta]
+
+
+def client_packet_parts(message_id, client_message):
+    """
+    return the byte strings of a packet forwarding
+    a SphinxBody to a client, in order
+    """
+    return [message_id, client_message.delta]
+
+
+def client_frame_size(params):
+    """
+    return the size of a packet forwarded to a client
+    """
+    return MESSAGE_ID_SIZE + params.payload_size
+
+
+def split_client_packet(packet):
+    """
+    return a 2-tuple of a client packet's message ID
+    and a view of its payload which shares packet's memory
+    """
+    return packet[:MESSAGE_ID_SIZE], _view(packet, MESSAGE_ID_SIZE)
+
+
+def send_parts(transport, addr, parts):
+    """
+    send the byte strings in parts as one message to addr,
+    joining them only if transport is not an IGatherTransport
+    """
+    if IGatherTransport.providedBy(transport):
+        return transport.send_parts(addr, parts)
+    return transport.send(addr, b"".join(parts))
@@ -0,0 +1,62 @@
+"""
+sphinx header construction for clients
+
+create_header builds the same headers as sphinxmixcrypto's, from the
+same entropy, with less work. Each hop's alpha is its predecessor's
+raised to one more blinding factor instead of the generator raised to
+every factor so far. Each hop's stream is generated once and used for
+both the filler and beta.
+"""
+
+from sphinxmixcrypto import SphinxHeader, GroupCurve25519, SphinxDigest, SphinxStreamCipher
+from sphinxmixcrypto import SECURITY_PARAMETER
+from sphinxmixcrypto.crypto_primitives import xor
+
+
+def create_header(params, route, pki, dest, message_id, rand_reader):
+    """
+    return a 2-tuple of a SphinxHeader for route and the list of
+    secrets shared with each of its hops, like sphinxmixcrypto's
+    create_header
+    """
+    route_len = len(route)
+    assert len(dest) <= 2 * (params.max_hops - route_len + 1) * SECURITY_PARAMETER
+    assert route_len <= params.max_hops
+    assert len(message_id) == SECURITY_PARAMETER
+
+    group = GroupCurve25519()
+    digest = SphinxDigest()
+    stream_cipher = SphinxStreamCipher()
+    x = group.gensecret(rand_reader)
+    padding = rand_reader.read(((2 * (params.max_hops - route_len) + 2) * SECURITY_PARAMETER - len(dest)))
+
+    blinds = [x]
+    alphas = []
+    secrets = []
+    alpha = group.generator
+    for node_id in route:
+        alpha = group.expon(alpha, blinds[-1])
+        s = group.multiexpon(pki.get(node_id), blinds)
+        blinds.append(digest.hash_blinding(alpha, s))
+        alphas.append(alpha)
+        secrets.append(s)
+
+    streams = [stream_cipher.generate_stream(digest.create_stream_cipher_key(secret), params.beta_cipher_size)
+               for secret in secrets[:-1]]
+
+    phi = b''
+    for i in range(1, route_len):
+        offset = (2 * (params.max_hops - i) + 3) * SECURITY_PARAMETER
+        phi = xor(phi + (b"\x00" * (2 * SECURITY_PARAMETER)), streams[i - 1][offset:])
+
+    beta_len = (2 * (params.max_hops - route_len) + 3) * SECURITY_PARAMETER
+    stream_key = digest.create_stream_cipher_key(secrets[-1])
+    beta = xor(dest + message_id + padding, stream_cipher.generate_stream(stream_key, beta_len)[:beta_len]) + phi
+    gamma = digest.hmac(digest.create_hmac_key(secrets[-1]), beta)
+    for i in range(route_len - 2, -1, -1):
+        next_hop = route[i + 1]
+        assert len(next_hop) == SECURITY_PARAMETER
+        beta = xor(next_hop + gamma + beta[:(2 * params.max_hops - 1) * SECURITY_PARAMETER],
+                   streams[i][:(2 * params.max_hops + 1) * SECURITY_PARAMETER])
+        gamma = digest.hmac(digest.create_hmac_key(secrets[i]), beta)
+    return SphinxHeader(alphas[0], beta, gamma), secrets
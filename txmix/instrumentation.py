@@ -0,0 +1,119 @@
+"""
+sampled eliot logging for the per packet hot path
+
+Per packet actions are started with start_packet_action instead of
+eliot's start_action. Depending on the packet logging mode every such
+action is logged, one in every sample_every is logged, or none are.
+An action which is not logged is the shared NULL_ACTION, which does
+nothing, so a skipped packet costs one counter decrement. Per batch
+and lifecycle actions keep using start_action and are always logged.
+
+The default mode is sampled, which bounds the logging overhead to
+about 1/sample_every of that of full logging.
+"""
+
+from eliot import start_action
+from eliot.twisted import DeferredContext
+
+
+FULL = "full"
+SAMPLED = "sampled"
+OFF = "off"
+PACKET_LOGGING_MODES = (FULL, SAMPLED, OFF)
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullAction(object):
+    """
+    i stand in for an eliot action which is not logged
+    """
+
+    _context = _NullContext()
+
+    def context(self):
+        return self._context
+
+    def addSuccessFields(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_ACTION = NullAction()
+
+
+class PacketLogSampler(object):
+    """
+    i decide which packets get logged. in sampled mode the first of
+    every sample_every actions of each type is logged; counting is
+    cheaper than drawing a random number and logs a steady fraction
+    of packets. each type is counted separately so that the several
+    actions of one packet don't always sample the same one.
+    """
+
+    def __init__(self, mode=SAMPLED, sample_every=100):
+        self.configure(mode, sample_every)
+
+    def configure(self, mode, sample_every=100):
+        if mode not in PACKET_LOGGING_MODES:
+            raise ValueError("unknown packet logging mode %r" % (mode,))
+        if sample_every < 1:
+            raise ValueError("sample_every must be at least 1")
+        self.mode = mode
+        self.sample_every = sample_every
+        self._countdowns = {}
+
+    def sample(self, action_type):
+        """
+        return True if the next action of action_type should be logged
+        """
+        if self.mode == SAMPLED:
+            countdown = self._countdowns.get(action_type, 0)
+            if countdown == 0:
+                self._countdowns[action_type] = self.sample_every - 1
+                return True
+            self._countdowns[action_type] = countdown - 1
+            return False
+        return self.mode == FULL
+
+
+packet_log_sampler = PacketLogSampler()
+
+
+def configure_packet_logging(mode, sample_every=100):
+    """
+    set the packet logging mode to full, sampled or off. in
+    sampled mode one in every sample_every packets is logged.
+    """
+    packet_log_sampler.configure(mode, sample_every)
+
+
+def start_packet_action(action_type, **fields):
+    """
+    start an eliot action for a single packet if it is sampled,
+    otherwise return NULL_ACTION
+    """
+    if packet_log_sampler.sample(action_type):
+        return start_action(action_type=action_type, **fields)
+    return NULL_ACTION
+
+
+def finish_packet_action(action, d):
+    """
+    finish a packet action when the deferred d fires. i must be
+    called within the action's context, like DeferredContext.
+    """
+    if action is NULL_ACTION:
+        return d
+    return DeferredContext(d).addActionFinish()
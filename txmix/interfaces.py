@@ -4,6 +4,8 @@ Interfaces for writing mix nets
 
 from zope.interface import Interface, Attribute
 
+from sphinxmixcrypto import IPacketReplayCache, IKeyState
+
 
 class IMixTransport(Interface):
     """
@@ -28,6 +30,19 @@ class IMixTransport(Interface):
         """
 
 
+class IGatherTransport(IMixTransport):
+    """
+    Interface for a mix transport which can send a message given
+    as a sequence of byte strings without joining them first.
+    """
+
+    def send_parts(addr, parts):
+        """
+        Send the concatenation of the byte strings in parts
+        as one message to the mix network node identified by addr.
+        """
+
+
 class IRouteFactory(Interface):
     """
     Interface for a route factory which builds mixnet routes for clients.
@@ -37,3 +52,59 @@ class IRouteFactory(Interface):
         """
         return a new route
         """
+
+
+class IPacketUnwrapper(Interface):
+    """
+    Interface for a sphinx packet unwrapper which performs the
+    packet crypto somewhere other than the reactor thread.
+    """
+
+    def start():
+        """
+        start the unwrapper
+        """
+
+    def stop():
+        """
+        stop the unwrapper
+        """
+
+    def unwrap(params, key_state, raw_sphinx_packet):
+        """
+        unwrap a raw sphinx packet without consulting a replay cache.
+        returns a deferred which fires with a 2-tuple of the packet's
+        replay tag and the UnwrappedMessage.
+        """
+
+
+class IEpochKeyState(IKeyState):
+    """
+    Interface for a mix's key state which, while keys are being
+    rotated, holds more than one key. get_public_key and
+    get_private_key return the current key.
+    """
+
+    epoch = Attribute("""the epoch of the current key""")
+
+    def live_keys():
+        """
+        return a sequence of an IKeyState for each key which packets
+        may be encrypted to, the current key first.
+        """
+
+
+class IBatchPacketReplayCache(IPacketReplayCache):
+    """
+    Interface to a replay cache which can check and set
+    a whole batch of replay tags in one call.
+    """
+
+    def test_and_set(tags):
+        """
+        mark every tag in the list as seen and return a list of booleans,
+        True for each tag which had already been seen. a tag which
+        appears more than once in the list counts as seen after
+        its first appearance. a new tag which does not fit because
+        the cache is full is not set and is reported as None.
+        """
@@ -0,0 +1,212 @@
+"""
+mix key rotation with overlapping epochs
+
+A mix's key changes every epoch. Packets built by clients with a
+stale view of the pki are still encrypted to the key of the previous
+epoch, so after a rotation the previous key stays live for an overlap
+window: a packet is unwrapped with the current key and, if its header
+MAC does not check out, with the previous key.
+
+Replay tags are unique per key, so an EpochReplayCache partitioned by
+the same epochs can drop the tags of the previous epoch all at once
+when its key is retired; replays of those packets no longer unwrap.
+Tags of packets encrypted to the previous key during the overlap are
+set in the current epoch and dropped one epoch later.
+
+The next keypair and its empty replay table are made precompute_lead
+seconds ahead of the rotation, which then only swaps them in, so a
+rotation never delays the packets being received.
+"""
+
+from eliot import start_action
+from zope.interface import implementer
+
+from txmix.interfaces import IEpochKeyState
+from txmix.utils import MixKeyState, generate_node_keypair
+
+
+@implementer(IEpochKeyState)
+class EpochKeyState(object):
+    """
+    i am the key state of a mix whose keys are rotated. i hold the
+    key of the current epoch and, until it is retired, the key of
+    the previous one. my observers are called with me whenever my
+    live keys change.
+    """
+
+    def __init__(self, epoch, public_key, private_key):
+        self.epoch = epoch
+        self._current = MixKeyState(public_key, private_key)
+        self._previous = None
+        self._live_keys = (self._current,)
+        self._observers = []
+
+    def add_observer(self, observer):
+        self._observers.append(observer)
+
+    def remove_observer(self, observer):
+        self._observers.remove(observer)
+
+    def _changed(self):
+        for observer in list(self._observers):
+            observer(self)
+
+    def get_public_key(self):
+        return self._current.get_public_key()
+
+    def get_private_key(self):
+        return self._current.get_private_key()
+
+    def live_keys(self):
+        return self._live_keys
+
+    @property
+    def previous_epoch(self):
+        """
+        the epoch of the previous key or None if it has been retired
+        """
+        if self._previous is None:
+            return None
+        return self.epoch - 1
+
+    def rotate(self, epoch, public_key, private_key):
+        """
+        make the given key current, keeping the current key live
+        as the previous one. a previous key still live is retired.
+        """
+        assert epoch == self.epoch + 1
+        self._previous = self._current
+        self._current = MixKeyState(public_key, private_key)
+        self.epoch = epoch
+        self._live_keys = (self._current, self._previous)
+        self._changed()
+
+    def retire_previous(self):
+        """
+        stop unwrapping packets encrypted to the previous key
+        """
+        self._previous = None
+        self._live_keys = (self._current,)
+        self._changed()
+
+
+class KeyRotation(object):
+    """
+    i rotate the keys of a mix every epoch_duration seconds, keeping
+    the previous key live for overlap seconds after each rotation.
+    precompute_lead seconds before a rotation i generate the next
+    keypair and, given an EpochReplayCache, its next replay table.
+    at the rotation i publish the new public key with pki.rotate if
+    i am given a pki. a ConsensusPKI only stages the key until its
+    next consensus, while the previous key stays live for overlap
+    seconds, so the consensus interval should be shorter than that.
+    """
+
+    def __init__(self, reactor, node_id, key_state, rand_reader, pki=None, replay_cache=None,
+                 epoch_duration=3600, overlap=600, precompute_lead=60):
+        assert isinstance(key_state, EpochKeyState)
+        assert 0 < overlap < epoch_duration
+        assert 0 <= precompute_lead < epoch_duration - overlap
+        assert replay_cache is None or replay_cache.max_epochs >= 2
+        self.reactor = reactor
+        self.node_id = node_id
+        self.key_state = key_state
+        self.rand_reader = rand_reader
+        self.pki = pki
+        self.replay_cache = replay_cache
+        self.epoch_duration = epoch_duration
+        self.overlap = overlap
+        self.precompute_lead = precompute_lead
+        self.next_public_key = None
+        self._next = None
+        self._calls = {}
+
+    def start(self):
+        """
+        schedule the rotations, the first epoch_duration seconds from now
+        """
+        self._schedule(self.reactor.seconds() + self.epoch_duration)
+
+    def stop(self):
+        """
+        cancel my scheduled rotations
+        """
+        for call in self._calls.values():
+            call.cancel()
+        self._calls = {}
+
+    def _schedule(self, rotate_at):
+        now = self.reactor.seconds()
+        self._calls["precompute"] = self.reactor.callLater(max(0, rotate_at - self.precompute_lead - now),
+                                                           self._precompute_call)
+        self._calls["rotate"] = self.reactor.callLater(rotate_at - now, self._rotate_call)
+
+    def _precompute_call(self):
+        del self._calls["precompute"]
+        self.precompute()
+
+    def _rotate_call(self):
+        del self._calls["rotate"]
+        rotate_at = self.reactor.seconds() + self.epoch_duration
+        self.rotate()
+        self._schedule(rotate_at)
+
+    def _retire_call(self):
+        del self._calls["retire"]
+        self.retire_previous()
+
+    def precompute(self):
+        """
+        generate the next keypair and replay table if they
+        have not been generated since the last rotation
+        """
+        if self._next is not None:
+            return
+        public_key, private_key = generate_node_keypair(self.rand_reader)
+        table = None
+        if self.replay_cache is not None:
+            table = self.replay_cache.new_table()
+        self._next = public_key, private_key, table
+        self.next_public_key = public_key
+
+    def rotate(self):
+        """
+        make the next key current now, retiring the previous key
+        if it is still live, and the current key overlap seconds later
+        """
+        epoch = self.key_state.epoch + 1
+        action = start_action(
+            action_type=u"mix key rotation",
+            epoch=epoch,
+        )
+        with action.context():
+            if self.key_state.previous_epoch is not None:
+                self.retire_previous()
+            self.precompute()
+            public_key, private_key, table = self._next
+            self._next = None
+            self.next_public_key = None
+            self.key_state.rotate(epoch, public_key, private_key)
+            if self.replay_cache is not None:
+                self.replay_cache.rotate(epoch, table=table)
+            if self.pki is not None:
+                self.pki.rotate(self.node_id, public_key, b"")
+            if "retire" in self._calls:
+                self._calls.pop("retire").cancel()
+            self._calls["retire"] = self.reactor.callLater(self.overlap, self._retire_call)
+
+    def retire_previous(self):
+        """
+        retire the previous key and forget the replay tags of its epoch
+        """
+        previous_epoch = self.key_state.previous_epoch
+        if previous_epoch is None:
+            return
+        action = start_action(
+            action_type=u"mix key retirement",
+            epoch=previous_epoch,
+        )
+        with action.context():
+            self.key_state.retire_previous()
+            if self.replay_cache is not None and previous_epoch in self.replay_cache.epochs:
+                self.replay_cache.drop_epoch(previous_epoch)
@@ -0,0 +1,235 @@
+"""
+counters, gauges and histograms for mix nodes and clients
+
+Metrics are plain python objects whose updates are a method call and
+an addition, a few hundred nanoseconds, so they can be updated for
+every packet. They are registered in a MetricsRegistry, by default
+default_registry, which renders them in the Prometheus text exposition
+format. MetricsResource serves a registry over http and listen_metrics
+starts a local endpoint for it.
+"""
+
+from bisect import bisect_left
+
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+REFILL_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labels, extra=()):
+    pairs = sorted(labels.items()) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter(object):
+    """
+    i am a monotonically increasing count
+    """
+    metric_type = "counter"
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name):
+        yield name + _format_labels(self.labels), self.value
+
+
+class Gauge(object):
+    """
+    i am a value which can go up and down. if i am given a function
+    my value is whatever it returns when i am rendered, so i cost
+    nothing to keep up to date.
+    """
+    metric_type = "gauge"
+
+    def __init__(self, labels, function=None):
+        self.labels = labels
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self, name):
+        value = self.value if self.function is None else self.function()
+        yield name + _format_labels(self.labels), value
+
+
+class Histogram(object):
+    """
+    i count observations in fixed buckets given by their upper bounds
+    """
+    metric_type = "histogram"
+
+    def __init__(self, labels, buckets=DEFAULT_BUCKETS):
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            yield name + "_bucket" + _format_labels(self.labels, [("le", _format_value(bound))]), cumulative
+        yield name + "_sum" + _format_labels(self.labels), self.sum
+        yield name + "_count" + _format_labels(self.labels), self.count
+
+
+class MetricsRegistry(object):
+    """
+    i hold metrics by name and label set. asking me for a metric
+    which exists returns it, so modules can share metrics by name.
+    """
+
+    def __init__(self):
+        self._families = {}  # name -> (metric class, help, {label items: metric})
+
+    def _get(self, metric_class, name, help, labels, **kwargs):
+        labels = labels or {}
+        family = self._families.setdefault(name, (metric_class, help, {}))
+        if family[0] is not metric_class:
+            raise ValueError("%s is already registered as a %s" % (name, family[0].metric_type))
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = metric_class(labels, **kwargs)
+        return metric
+
+    def counter(self, name, help, labels=None):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=None, function=None):
+        return self._get(Gauge, name, help, labels, function=function)
+
+    def histogram(self, name, help, labels=None, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        """
+        return every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for name in sorted(self._families):
+            metric_class, help, metrics = self._families[name]
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, metric_class.metric_type))
+            for key in sorted(metrics):
+                for sample_name, value in metrics[key].samples(name):
+                    lines.append("%s %s" % (sample_name, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+default_registry = MetricsRegistry()
+
+
+class MetricsResource(Resource):
+    """
+    i serve a MetricsRegistry in the Prometheus text format
+    """
+    isLeaf = True
+
+    def __init__(self, registry=default_registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")
+        return self.registry.render().encode("utf-8")
+
+
+def listen_metrics(reactor, port=9100, interface="127.0.0.1", registry=default_registry):
+    """
+    serve registry over http on the given local interface and
+    port, returns the listening port
+    """
+    return reactor.listenTCP(port, Site(MetricsResource(registry)), interface=interface)
+
+
+# the metrics updated by txmix itself
+
+PACKETS_RECEIVED = default_registry.counter(
+    "txmix_mix_packets_received_total", "sphinx packets received by mix protocols")
+PACKETS_SENT = default_registry.counter(
+    "txmix_mix_packets_sent_total", "unwrapped packets proxied to their next hop or client")
+PACKET_ERRORS = default_registry.counter(
+    "txmix_mix_packet_errors_total", "sphinx packets which failed to unwrap")
+REPLAYS = default_registry.counter(
+    "txmix_mix_replays_total", "sphinx packets rejected as replays")
+REPLAY_CACHE_FULL = default_registry.counter(
+    "txmix_mix_replay_cache_full_total", "sphinx packets dropped because the replay cache was full")
+UNWRAP_POOL_FULL = default_registry.counter(
+    "txmix_mix_unwrap_pool_full_total", "sphinx packets dropped because the unwrap pool was full")
+SEND_ERRORS = default_registry.counter(
+    "txmix_mix_send_errors_total", "unwrapped packets which failed to be proxied")
+UNWRAP_SECONDS = default_registry.histogram(
+    "txmix_mix_unwrap_seconds", "time taken to unwrap a sphinx packet")
+RECEIVED_BATCH_SIZE = default_registry.histogram(
+    "txmix_mix_received_batch_size", "packets per received batch", buckets=BATCH_SIZE_BUCKETS)
+SENT_BATCH_SIZE = default_registry.histogram(
+    "txmix_mix_sent_batch_size", "messages per batch released by mix nodes", buckets=BATCH_SIZE_BUCKETS)
+QUEUED_MESSAGES = default_registry.gauge(
+    "txmix_mix_queued_messages", "messages held by mix nodes waiting to be sent")
+CLIENT_MESSAGES_SENT = default_registry.counter(
+    "txmix_client_messages_sent_total", "messages sent by mix clients")
+CLIENT_MESSAGES_RECEIVED = default_registry.counter(
+    "txmix_client_messages_received_total", "messages received by mix clients")
+
+
+def transport_metrics(transport_name):
+    """
+    return a 3-tuple of the datagrams received, datagrams sent
+    and send failures counters of a transport
+    """
+    labels = {"transport": transport_name}
+    return (
+        default_registry.counter("txmix_transport_received_total", "datagrams received by transports", labels),
+        default_registry.counter("txmix_transport_sent_total", "datagrams sent by transports", labels),
+        default_registry.counter("txmix_transport_send_failures_total", "datagrams transports failed to send", labels),
+    )
+
+
+def precompute_pool_metrics(pool_name):
+    """
+    return a 4-tuple of the hits and misses counters and the item
+    build and refill time histograms of a client's precompute pool
+    """
+    labels = {"pool": pool_name}
+    return (
+        default_registry.counter("txmix_client_pool_hits_total", "items taken from client precompute pools", labels),
+        default_registry.counter("txmix_client_pool_misses_total", "takes from empty client precompute pools", labels),
+        default_registry.histogram("txmix_client_pool_build_seconds", "time taken to build one pooled item", labels),
+        default_registry.histogram("txmix_client_pool_refill_seconds",
+                                   "time taken to refill a pool to its high watermark", labels,
+                                   buckets=REFILL_BUCKETS),
+    )
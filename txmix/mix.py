@@ -1,22 +1,78 @@
 
 import attr
+import math
+import time
+import collections
 import types
 import random
 
-from eliot import start_action
+from eliot import start_action, write_failure
 from eliot.twisted import DeferredContext
 
-from twisted.internet.interfaces import IReactorCore
+from twisted.internet.interfaces import IReactorTime
 from twisted.internet import reactor, defer
 from twisted.internet.task import deferLater
 
-from sphinxmixcrypto import sphinx_packet_unwrap, SphinxParams, SphinxPacket
-from sphinxmixcrypto import IPacketReplayCache, IKeyState, IMixPKI, UnwrappedMessage
-
-from txmix.interfaces import IMixTransport
+from sphinxmixcrypto import SphinxParams, SphinxPacket
+from sphinxmixcrypto import IPacketReplayCache, IKeyState, IMixPKI, UnwrappedMessage, ReplayError
+from sphinxmixcrypto import HeaderAlphaGroupMismatchError, IncorrectMACError, InvalidProcessDestinationError
+from sphinxmixcrypto import InvalidMessageTypeError, SphinxBodySizeMismatchError
+
+from txmix.interfaces import IMixTransport, IPacketUnwrapper, IBatchPacketReplayCache
+from txmix.unwrap import unwrap_raw_packet, unwrap_packet, UnwrapPoolFullError, UnwrapWorkerError
+from txmix.replay_cache import ReplayCacheFullError
+from txmix.scheduler import TimerWheel, HeapScheduler
+from txmix.admission import AdmissionQueue, message_size
+from txmix.instrumentation import start_packet_action, finish_packet_action
+from txmix import metrics
+from txmix.framing import sphinx_packet_parts, client_packet_parts, send_parts
 from txmix.utils import is_16bytes
 
 
+# errors raised while decoding or unwrapping a packet that
+# should not prevent the rest of a batch from being unwrapped
+PACKET_ERRORS = (
+    AssertionError,
+    HeaderAlphaGroupMismatchError,
+    IncorrectMACError,
+    InvalidProcessDestinationError,
+    InvalidMessageTypeError,
+    SphinxBodySizeMismatchError,
+)
+
+# errors for which a packet given to an unwrapper is dropped,
+# each of them is counted where it is raised
+DROPPED_PACKET_ERRORS = PACKET_ERRORS + (
+    ReplayError,
+    ReplayCacheFullError,
+    UnwrapPoolFullError,
+    UnwrapWorkerError,
+)
+
+
+def replay_test_and_set(replay_cache, tags):
+    """
+    mark the tags as seen in one round trip if the replay cache
+    supports it, returns a list which is True for replays, False
+    for new tags and None for new tags which did not fit because
+    the replay cache is full
+    """
+    if IBatchPacketReplayCache.providedBy(replay_cache):
+        return replay_cache.test_and_set(tags)
+    seen = []
+    for tag in tags:
+        if replay_cache.has_seen(tag):
+            seen.append(True)
+            continue
+        try:
+            replay_cache.set_seen(tag)
+        except ReplayCacheFullError:
+            seen.append(None)
+        else:
+            seen.append(False)
+    return seen
+
+
 @attr.s
 class MixProtocol(object):
     """
@@ -29,6 +85,15 @@ class MixProtocol(object):
     params = attr.ib(validator=attr.validators.instance_of(SphinxParams))
     pki = attr.ib(validator=attr.validators.provides(IMixPKI))
     packet_received_handler = attr.ib(validator=attr.validators.instance_of(types.FunctionType))
+    unwrapper = attr.ib(validator=attr.validators.optional(attr.validators.provides(IPacketUnwrapper)), default=None)
+    batch_received_handler = attr.ib(validator=attr.validators.optional(attr.validators.instance_of(types.FunctionType)), default=None)
+
+    @property
+    def frame_size(self):
+        """
+        the size of every packet i receive
+        """
+        return self.params.get_sphinx_forward_size()
 
     def make_connection(self, transport):
         """
@@ -38,6 +103,8 @@ class MixProtocol(object):
         transport is started
         """
         assert IMixTransport.providedBy(transport)
+        if self.unwrapper is not None:
+            self.unwrapper.start()
         transport.register_protocol(self)
         d = transport.start()
         self.transport = transport
@@ -46,22 +113,147 @@ class MixProtocol(object):
     def received(self, raw_sphinx_packet):
         """
         receive a raw_packet, decode it and unwrap/decrypt it
-        and return the results
+        and return the results.
+        if i have an unwrapper then the unwrap happens elsewhere
+        and i return a deferred which fires after the unwrapped
+        packet has been passed to my packet_received_handler, or
+        after the packet has been dropped.
+        """
+        metrics.PACKETS_RECEIVED.inc()
+        if self.unwrapper is not None:
+            return self._unwrapper_received(raw_sphinx_packet)
+        action = start_packet_action(u"mix packet unwrap")
+        with action.context():
+            start = time.time()
+            try:
+                sphinx_packet = SphinxPacket.from_raw_bytes(self.params, raw_sphinx_packet)
+                unwrapped_packet = unwrap_packet(self.params, self.replay_cache, self.key_state, sphinx_packet)
+            except ReplayError:
+                metrics.REPLAYS.inc()
+                raise
+            except ReplayCacheFullError:
+                metrics.REPLAY_CACHE_FULL.inc()
+                raise
+            except PACKET_ERRORS:
+                metrics.PACKET_ERRORS.inc()
+                raise
+            metrics.UNWRAP_SECONDS.observe(time.time() - start)
+        self.packet_received_handler(unwrapped_packet)
+
+    def _unwrapper_received(self, raw_sphinx_packet):
+        action = start_packet_action(u"mix packet unwrapper unwrap")
+        with action.context():
+            start = time.time()
+            d = self.unwrapper.unwrap(self.params, self.key_state, raw_sphinx_packet)
+            d.addCallbacks(lambda result: self._unwrapped(start, result), self._unwrap_failed)
+            d.addCallback(self._check_replay)
+            d.addCallback(self.packet_received_handler)
+            d = finish_packet_action(action, d)
+            d.addErrback(self._dropped)
+            return d
+
+    def _unwrapped(self, start, result):
+        metrics.UNWRAP_SECONDS.observe(time.time() - start)
+        return result
+
+    def _unwrap_failed(self, failure):
+        if not failure.check(UnwrapPoolFullError):
+            metrics.PACKET_ERRORS.inc()
+        return failure
+
+    def _dropped(self, failure):
+        """
+        end the chain of a packet given to my unwrapper. packets which
+        failed to unwrap or were replays are already counted, and are
+        dropped without a traceback. any other failure is logged.
+        """
+        if not failure.check(*DROPPED_PACKET_ERRORS):
+            write_failure(failure)
+
+    def _check_replay(self, unwrap_result):
+        """
+        replay tags are checked and set here on the reactor thread
+        so that concurrent unwraps of the same packet cannot both succeed
+        """
+        tag, unwrapped_packet = unwrap_result
+        if self.replay_cache.has_seen(tag):
+            metrics.REPLAYS.inc()
+            raise ReplayError()
+        try:
+            self.replay_cache.set_seen(tag)
+        except ReplayCacheFullError:
+            metrics.REPLAY_CACHE_FULL.inc()
+            raise
+        return unwrapped_packet
+
+    def received_batch(self, raw_sphinx_packets):
+        """
+        receive a list of raw packets and unwrap them together.
+        replay tags are checked in one round trip to the replay cache
+        and the unwrapped packets are passed in one list to my
+        batch_received_handler, or one by one to my packet_received_handler
+        if i have no batch handler. packets which fail to unwrap or
+        are replays are dropped without affecting the rest of the batch.
+        if i have an unwrapper then i return a deferred which fires
+        after the unwrapped packets are handed off.
         """
         action = start_action(
-            action_type=u"mix packet unwrap",
+            action_type=u"mix packet batch unwrap",
+            batch_size=len(raw_sphinx_packets),
         )
+        metrics.PACKETS_RECEIVED.inc(len(raw_sphinx_packets))
+        metrics.RECEIVED_BATCH_SIZE.observe(len(raw_sphinx_packets))
         with action.context():
-            sphinx_packet = SphinxPacket.from_raw_bytes(self.params, raw_sphinx_packet)
-            unwrapped_packet = sphinx_packet_unwrap(self.params, self.replay_cache, self.key_state, sphinx_packet)
-        self.packet_received_handler(unwrapped_packet)
+            if self.unwrapper is not None:
+                start = time.time()
+                dl = [self.unwrapper.unwrap(self.params, self.key_state, x) for x in raw_sphinx_packets]
+                d = defer.DeferredList(dl, consumeErrors=True)
+                d.addCallback(lambda results: self._deliver_unwrapper_batch(action, start, results))
+                return DeferredContext(d).addActionFinish()
+            unwrap_results = []
+            for raw_sphinx_packet in raw_sphinx_packets:
+                start = time.time()
+                try:
+                    unwrap_results.append(unwrap_raw_packet(self.params, self.key_state, raw_sphinx_packet))
+                except PACKET_ERRORS:
+                    metrics.PACKET_ERRORS.inc()
+                    continue
+                metrics.UNWRAP_SECONDS.observe(time.time() - start)
+            self._deliver_batch(action, unwrap_results)
+
+    def _deliver_unwrapper_batch(self, action, start, results):
+        # the packets were unwrapped concurrently, so each is
+        # given an equal share of the time the batch took
+        elapsed = (time.time() - start) / max(len(results), 1)
+        unwrap_results = []
+        for ok, result in results:
+            if ok:
+                metrics.UNWRAP_SECONDS.observe(elapsed)
+                unwrap_results.append(result)
+            elif not result.check(UnwrapPoolFullError):
+                metrics.PACKET_ERRORS.inc()
+        self._deliver_batch(action, unwrap_results)
+
+    def _deliver_batch(self, action, unwrap_results):
+        seen = replay_test_and_set(self.replay_cache, [tag for tag, _ in unwrap_results])
+        unwrapped_packets = [x for (_, x), replay in zip(unwrap_results, seen) if replay is False]
+        replays = seen.count(True)
+        full = seen.count(None)
+        metrics.REPLAYS.inc(replays)
+        metrics.REPLAY_CACHE_FULL.inc(full)
+        action.addSuccessFields(unwrapped=len(unwrapped_packets), replays=replays, replay_cache_full=full)
+        if self.batch_received_handler is not None:
+            self.batch_received_handler(unwrapped_packets)
+        else:
+            for unwrapped_packet in unwrapped_packets:
+                self.packet_received_handler(unwrapped_packet)
 
     def sphinx_packet_send(self, mix_id, sphinx_packet):
         """
-        given a SphinxPacket object I shall encode it into
-        a raw packet and send it to the mix with mix_id
+        given a SphinxPacket object I shall send its
+        elements as one raw packet to the mix with mix_id
         """
-        return self.send(mix_id, sphinx_packet.get_raw_bytes())
+        return self.send_parts(mix_id, sphinx_packet_parts(sphinx_packet))
 
     def send(self, destination, datagram):
         """
@@ -71,14 +263,21 @@ class MixProtocol(object):
         mix_addr = self.pki.get_mix_addr(self.transport.name, destination)
         return self.transport.send(mix_addr, datagram)
 
+    def send_parts(self, destination, parts):
+        """
+        send the byte strings in parts as one datagram
+        to the mix with the given ID
+        """
+        mix_addr = self.pki.get_mix_addr(self.transport.name, destination)
+        return send_parts(self.transport, mix_addr, parts)
+
     @defer.inlineCallbacks
     def forward_to_client(self, client_id, message_id, client_message):
         """
         forward a ciphertext client message to a client
         """
         client_addr = self.pki.get_client_addr(self.transport.name, client_id)
-        message = bytes(message_id) + bytes(client_message.delta)
-        yield self.transport.send(client_addr, message)
+        yield send_parts(self.transport, client_addr, client_packet_parts(message_id, client_message))
 
     def packet_proxy(self, unwrapped_packet):
         """
@@ -87,21 +286,18 @@ class MixProtocol(object):
         and send the batch out after a random delay.
         """
         assert isinstance(unwrapped_packet, UnwrappedMessage)
+        metrics.PACKETS_SENT.inc()
         if unwrapped_packet.next_hop:
-            action = start_action(
-                action_type=u"proxy unwrapped packet to next hop",
-            )
+            action = start_packet_action(u"proxy unwrapped packet to next hop")
             with action.context():
                 destination, sphinx_packet = unwrapped_packet.next_hop
                 d = self.sphinx_packet_send(destination, sphinx_packet)
-                DeferredContext(d).addActionFinish()
+                finish_packet_action(action, d)
         elif unwrapped_packet.client_hop:
-            action = start_action(
-                action_type=u"proxy unwrapped packet to client hop",
-            )
+            action = start_packet_action(u"proxy unwrapped packet to client hop")
             with action.context():
                 d = self.forward_to_client(*unwrapped_packet.client_hop)
-                DeferredContext(d).addActionFinish()
+                finish_packet_action(action, d)
         elif unwrapped_packet.exit_hop:
             raise UnimplementedError()
         else:
@@ -109,6 +305,50 @@ class MixProtocol(object):
         return d
 
 
+def admit_message(admission_queue, unwrapped_message):
+    """
+    admit an UnwrappedMessage into an AdmissionQueue, returns a
+    2-tuple of its handle, or None if it was rejected, and a list
+    of the (handle, message) 2-tuples dropped to make room for it
+    """
+    size = 0
+    if admission_queue.max_bytes is not None:
+        size = message_size(unwrapped_message)
+    return admission_queue.admit(unwrapped_message, size)
+
+
+def remove_admitted(admission_queue, handles):
+    """
+    remove and return the messages with the given handles
+    which have not been dropped
+    """
+    messages = []
+    for handle in handles:
+        unwrapped_message = admission_queue.remove(handle)
+        if unwrapped_message is not None:
+            messages.append(unwrapped_message)
+    return messages
+
+
+def _proxy_failed(failure):
+    metrics.SEND_ERRORS.inc()
+    write_failure(failure)
+
+
+def proxy_each(protocol, batch):
+    """
+    pass every message of a batch to protocol.packet_proxy, returns
+    a list of deferreds. a message which fails to be sent is logged
+    and counted without stopping the rest of the batch.
+    """
+    dl = []
+    for unwrapped_message in batch:
+        d = defer.maybeDeferred(protocol.packet_proxy, unwrapped_message)
+        d.addErrback(_proxy_failed)
+        dl.append(d)
+    return dl
+
+
 class UnimplementedError(Exception):
     pass
 
@@ -126,6 +366,11 @@ class ThresholdMixNode(object):
     "From a Trickle to a Flood: Active Attacks on Several Mix Types"
     by Andrei Serjantov, Roger Dingledine, and Paul Syverson
     https://www.freehaven.net/anonbib/cache/trickle02.pdf
+
+    every message i hold, whether waiting for the threshold or in a
+    released batch waiting for its delay, is admitted into my
+    admission_queue, which bounds them. messages it drops are
+    removed from my batch or skipped when their batch is sent.
     """
     threshold_count = attr.ib(validator=attr.validators.instance_of(int))
     node_id = attr.ib(validator=is_16bytes)
@@ -134,21 +379,25 @@ class ThresholdMixNode(object):
     params = attr.ib(validator=attr.validators.instance_of(SphinxParams))
     pki = attr.ib(validator=attr.validators.provides(IMixPKI))
     transport = attr.ib(validator=attr.validators.provides(IMixTransport))
-    reactor = attr.ib(validator=attr.validators.provides(IReactorCore), default=reactor)
+    reactor = attr.ib(validator=attr.validators.provides(IReactorTime), default=reactor)
     max_delay = attr.ib(default=600)
+    unwrapper = attr.ib(validator=attr.validators.optional(attr.validators.provides(IPacketUnwrapper)), default=None)
+    admission_queue = attr.ib(validator=attr.validators.instance_of(AdmissionQueue), default=attr.Factory(AdmissionQueue))
 
     def start(self):
         """
         start the mix
         """
         self._sys_rand = random.SystemRandom()
-        self._batch = []  # message batch is a list of 2-tuples [(destination, sphinx_packet)]
+        self._batch = collections.OrderedDict()  # admission handle -> UnwrappedMessage
         self._pending_batch_sends = set()
         self.protocol = MixProtocol(self.replay_cache,
                                     self.key_state,
                                     self.params,
                                     self.pki,
-                                    packet_received_handler=lambda x: self.message_received(x))
+                                    packet_received_handler=lambda x: self.message_received(x),
+                                    unwrapper=self.unwrapper,
+                                    batch_received_handler=lambda x: self.messages_received(x))
         d = self.protocol.make_connection(self.transport)
         self.pki.set(self.node_id, self.key_state.get_public_key(), self.protocol.transport.addr)
         return d
@@ -157,33 +406,58 @@ class ThresholdMixNode(object):
         """
         message is of type UnwrappedMessage
         """
-
-        self._batch.append(unwrapped_message)  # [(destination, sphinx_packet)
+        self._admit(unwrapped_message)
         if len(self._batch) >= self.threshold_count:
-            delay = self._sys_rand.randint(0, self.max_delay)
-            action = start_action(
-                action_type=u"send delayed message batch",
-                delay=delay,
-            )
-            with action.context():
-                released = self._batch
-                self._batch = []
-                random.shuffle(released)
-                d = deferLater(self.reactor, delay, self.batch_send, released)
-                DeferredContext(d).addActionFinish()
-                self._pending_batch_sends.add(d)
+            self._release_batch()
+
+    def messages_received(self, unwrapped_messages):
+        """
+        receive a list of UnwrappedMessage, a batch is
+        released for every threshold_count messages
+        """
+        for unwrapped_message in unwrapped_messages:
+            self._admit(unwrapped_message)
+        while len(self._batch) >= self.threshold_count:
+            self._release_batch()
+
+    def _admit(self, unwrapped_message):
+        handle, dropped = admit_message(self.admission_queue, unwrapped_message)
+        for dropped_handle, _ in dropped:
+            self._batch.pop(dropped_handle, None)
+        if handle is not None:
+            self._batch[handle] = unwrapped_message
+
+    def _release_batch(self):
+        """
+        shuffle threshold_count messages and send them after a random delay
+        """
+        delay = self._sys_rand.randint(0, self.max_delay)
+        action = start_action(
+            action_type=u"send delayed message batch",
+            delay=delay,
+        )
+        with action.context():
+            released = [self._batch.popitem(last=False)[0] for _ in range(self.threshold_count)]
+            random.shuffle(released)
+            d = deferLater(self.reactor, delay, self._send_released, released)
+            DeferredContext(d).addActionFinish()
+            self._pending_batch_sends.add(d)
+
+            def _remove(res, d=d):
+                self._pending_batch_sends.remove(d)
+                return res
 
-                def _remove(res, d=d):
-                    self._pending_batch_sends.remove(d)
-                    return res
+            d.addBoth(_remove)
 
-                d.addBoth(_remove)
+    def _send_released(self, handles):
+        return self.batch_send(remove_admitted(self.admission_queue, handles))
 
     @defer.inlineCallbacks
     def batch_send(self, batch):
         """
         send a batch of mix net messages to their respective destinations
         """
+        metrics.SENT_BATCH_SIZE.observe(len(batch))
         dl = []
         for unwrapped_message in batch:
             dl.append(self.protocol.packet_proxy(unwrapped_message))
@@ -201,6 +475,13 @@ class ContinuousTimeMixNode(object):
     you can read more about me in:
     "The Traffic Analysis of Continuous-Time Mixes" by George Danezis
     https://www.freehaven.net/anonbib/cache/danezis:pet2004.pdf
+
+    if timer_wheel_tick is set my delayed messages are held in a
+    TimerWheel with ticks of that many seconds instead of each having
+    its own reactor timer, and the messages due in a tick are sent together.
+
+    every message i hold is admitted into my admission_queue, which
+    bounds them. the sends of messages it drops are cancelled.
     """
     node_id = attr.ib(validator=is_16bytes)
     max_delay = attr.ib(validator=attr.validators.instance_of(int))
@@ -209,19 +490,29 @@ class ContinuousTimeMixNode(object):
     key_state = attr.ib(validator=attr.validators.provides(IKeyState))
     params = attr.ib(validator=attr.validators.instance_of(SphinxParams))
     pki = attr.ib(validator=attr.validators.provides(IMixPKI))
-    reactor = attr.ib(validator=attr.validators.provides(IReactorCore), default=reactor)
+    reactor = attr.ib(validator=attr.validators.provides(IReactorTime), default=reactor)
+    unwrapper = attr.ib(validator=attr.validators.optional(attr.validators.provides(IPacketUnwrapper)), default=None)
+    timer_wheel_tick = attr.ib(validator=attr.validators.optional(attr.validators.instance_of((int, float))), default=None)
+    admission_queue = attr.ib(validator=attr.validators.instance_of(AdmissionQueue), default=attr.Factory(AdmissionQueue))
 
     def start(self):
         """
         start the mix
         """
         self._sys_rand = random.SystemRandom()
-        self._pending_sends = set()
+        self._pending_sends = {}  # admission handle -> deferred
+        self._timer_wheel = None
+        if self.timer_wheel_tick is not None:
+            slot_count = int(math.ceil(self.max_delay / float(self.timer_wheel_tick))) + 2
+            self._timer_wheel = TimerWheel(self.reactor, self.timer_wheel_tick, slot_count,
+                                           lambda x: self.batch_send(remove_admitted(self.admission_queue, x)))
         self.protocol = MixProtocol(self.replay_cache,
                                     self.key_state,
                                     self.params,
                                     self.pki,
-                                    packet_received_handler=lambda x: self.message_received(x))
+                                    packet_received_handler=lambda x: self.message_received(x),
+                                    unwrapper=self.unwrapper,
+                                    batch_received_handler=lambda x: self.messages_received(x))
         d = self.protocol.make_connection(self.transport)
         self.pki.set(self.node_id, self.key_state.get_public_key(), self.protocol.transport.addr)
         return d
@@ -230,19 +521,112 @@ class ContinuousTimeMixNode(object):
         """
         message is of type UnwrappedMessage
         """
-
+        handle, dropped = admit_message(self.admission_queue, unwrapped_message)
+        for dropped_handle, _ in dropped:
+            d = self._pending_sends.pop(dropped_handle, None)
+            if d is not None:
+                d.cancel()
+        if handle is None:
+            return
         delay = self._sys_rand.randint(0, self.max_delay)
-        action = start_action(
-            action_type=u"send delayed message",
-            delay=delay,
-        )
+        if self._timer_wheel is not None:
+            self._timer_wheel.schedule(delay, handle)
+            return
+        action = start_packet_action(u"send delayed message", delay=delay)
         with action.context():
-            d = deferLater(self.reactor, delay, self.protocol.packet_proxy, unwrapped_message)
-            DeferredContext(d).addActionFinish()
-            self._pending_sends.add(d)
+            d = deferLater(self.reactor, delay, self._send_admitted, handle)
+            finish_packet_action(action, d)
+            self._pending_sends[handle] = d
 
-            def _remove(res, d=d):
-                self._pending_sends.remove(d)
+            def _remove(res, handle=handle):
+                self._pending_sends.pop(handle, None)
                 return res
 
             d.addBoth(_remove)
+            d.addErrback(lambda f: f.trap(defer.CancelledError))
+
+    def _send_admitted(self, handle):
+        unwrapped_message = self.admission_queue.remove(handle)
+        if unwrapped_message is not None:
+            return self.protocol.packet_proxy(unwrapped_message)
+
+    def messages_received(self, unwrapped_messages):
+        """
+        receive a list of UnwrappedMessage
+        """
+        for unwrapped_message in unwrapped_messages:
+            self.message_received(unwrapped_message)
+
+    def batch_send(self, batch):
+        """
+        send the messages released together by my timer wheel
+        """
+        metrics.SENT_BATCH_SIZE.observe(len(batch))
+        proxy_each(self.protocol, batch)
+
+
+@attr.s
+class StopAndGoMixNode(object):
+    """
+    i am a stop-and-go mix. i delay each message independently by an
+    exponentially distributed amount of time with mean mean_delay
+    seconds, which makes the time a message leaves me independent of
+    when it arrived. my pending messages are held in a HeapScheduler
+    with a single reactor timer and every message whose time has
+    passed is sent together. they are bounded by my admission_queue.
+
+    you can read more about me in:
+    "Stop-and-Go-MIXes Providing Probabilistic Anonymity in an Open System"
+    by Dogan Kesdogan, Jan Egner and Roland Buschkes
+    """
+    node_id = attr.ib(validator=is_16bytes)
+    mean_delay = attr.ib(validator=attr.validators.instance_of((int, float)))
+    transport = attr.ib(validator=attr.validators.provides(IMixTransport))
+    replay_cache = attr.ib(validator=attr.validators.provides(IPacketReplayCache))
+    key_state = attr.ib(validator=attr.validators.provides(IKeyState))
+    params = attr.ib(validator=attr.validators.instance_of(SphinxParams))
+    pki = attr.ib(validator=attr.validators.provides(IMixPKI))
+    reactor = attr.ib(validator=attr.validators.provides(IReactorTime), default=reactor)
+    unwrapper = attr.ib(validator=attr.validators.optional(attr.validators.provides(IPacketUnwrapper)), default=None)
+    admission_queue = attr.ib(validator=attr.validators.instance_of(AdmissionQueue), default=attr.Factory(AdmissionQueue))
+
+    def start(self):
+        """
+        start the mix
+        """
+        assert self.mean_delay > 0
+        self._sys_rand = random.SystemRandom()
+        self._scheduler = HeapScheduler(self.reactor,
+                                        lambda x: self.batch_send(remove_admitted(self.admission_queue, x)))
+        self.protocol = MixProtocol(self.replay_cache,
+                                    self.key_state,
+                                    self.params,
+                                    self.pki,
+                                    packet_received_handler=lambda x: self.message_received(x),
+                                    unwrapper=self.unwrapper,
+                                    batch_received_handler=lambda x: self.messages_received(x))
+        d = self.protocol.make_connection(self.transport)
+        self.pki.set(self.node_id, self.key_state.get_public_key(), self.protocol.transport.addr)
+        return d
+
+    def message_received(self, unwrapped_message):
+        """
+        message is of type UnwrappedMessage
+        """
+        handle, _ = admit_message(self.admission_queue, unwrapped_message)
+        if handle is not None:
+            self._scheduler.schedule(self._sys_rand.expovariate(1.0 / self.mean_delay), handle)
+
+    def messages_received(self, unwrapped_messages):
+        """
+        receive a list of UnwrappedMessage
+        """
+        for unwrapped_message in unwrapped_messages:
+            self.message_received(unwrapped_message)
+
+    def batch_send(self, batch):
+        """
+        send the messages whose delay has passed
+        """
+        metrics.SENT_BATCH_SIZE.observe(len(batch))
+        proxy_each(self.protocol, batch)
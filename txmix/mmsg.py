@@ -0,0 +1,332 @@
+"""
+I am a ctypes binding of the linux recvmmsg and sendmmsg system
+calls and a twisted UDP port which uses them to read and write
+many datagrams per system call.
+
+Everything here degrades gracefully: `available()` is False on
+platforms without these system calls and MmsgPort then behaves
+exactly like twisted's udp.Port.
+"""
+
+import sys
+import errno
+import socket
+import struct
+import ctypes
+import ctypes.util
+
+from twisted.internet import udp
+from twisted.python import log
+
+from txmix.metrics import transport_metrics
+
+
+SEND_FAILURES = transport_metrics("udp")[2]
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+SOCKADDR_STORAGE_SIZE = 128
+MSG_DONTWAIT = 0x40
+
+_libc = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        _recvmmsg = _libc.recvmmsg
+        _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        _recvmmsg.restype = ctypes.c_int
+        _sendmmsg = _libc.sendmmsg
+        _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+        _sendmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        _libc = None
+
+
+def available():
+    """
+    return True if recvmmsg and sendmmsg can be used
+    """
+    return _libc is not None
+
+
+def _raise_errno():
+    no = ctypes.get_errno()
+    raise socket.error(no, errno.errorcode.get(no, "unknown error"))
+
+
+def decode_sockaddr(raw):
+    """
+    decode a raw AF_INET or AF_INET6 sockaddr into a (host, port) tuple
+    """
+    family = struct.unpack_from("=H", raw)[0]
+    port = struct.unpack_from("!H", raw, 2)[0]
+    if family == socket.AF_INET:
+        return socket.inet_ntop(socket.AF_INET, raw[4:8]), port
+    if family == socket.AF_INET6:
+        return socket.inet_ntop(socket.AF_INET6, raw[8:24]), port
+    return None
+
+
+def encode_sockaddr(addr):
+    """
+    encode a (host, port) tuple, where host is an IP address,
+    into a raw sockaddr
+    """
+    host, port = addr[:2]
+    if ":" in host:
+        return struct.pack("=H", socket.AF_INET6) + struct.pack("!HI", port, 0) + \
+            socket.inet_pton(socket.AF_INET6, host) + struct.pack("=I", 0)
+    return struct.pack("=H", socket.AF_INET) + struct.pack("!H", port) + \
+        socket.inet_pton(socket.AF_INET, host) + b"\x00" * 8
+
+
+class MmsgReceiver(object):
+    """
+    i receive up to batch_size datagrams with one recvmmsg call.
+    my buffers are allocated once and reused for every call.
+    """
+
+    def __init__(self, batch_size=64, max_packet_size=8192):
+        self.batch_size = batch_size
+        self.max_packet_size = max_packet_size
+        self._buffers = [ctypes.create_string_buffer(max_packet_size) for _ in range(batch_size)]
+        self._names = [ctypes.create_string_buffer(SOCKADDR_STORAGE_SIZE) for _ in range(batch_size)]
+        self._iovecs = (iovec * batch_size)()
+        self._headers = (mmsghdr * batch_size)()
+        self._addrs = {}
+        for i in range(batch_size):
+            self._iovecs[i].iov_base = ctypes.addressof(self._buffers[i])
+            self._iovecs[i].iov_len = max_packet_size
+            header = self._headers[i].msg_hdr
+            header.msg_name = ctypes.addressof(self._names[i])
+            header.msg_iov = ctypes.pointer(self._iovecs[i])
+            header.msg_iovlen = 1
+
+    def recv(self, fd):
+        """
+        return a list of (datagram, (host, port)) 2-tuples. raises
+        socket.error, with EAGAIN when nothing is waiting to be read.
+        """
+        for i in range(self.batch_size):
+            self._headers[i].msg_hdr.msg_namelen = SOCKADDR_STORAGE_SIZE
+        count = _recvmmsg(fd, self._headers, self.batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            _raise_errno()
+        datagrams = []
+        addrs = self._addrs
+        for i in range(count):
+            header = self._headers[i]
+            data = ctypes.string_at(self._buffers[i], header.msg_len)
+            name = ctypes.string_at(self._names[i], header.msg_hdr.msg_namelen)
+            addr = addrs.get(name)
+            if addr is None:
+                if len(addrs) > 4096:
+                    addrs.clear()
+                addr = addrs[name] = decode_sockaddr(name)
+            datagrams.append((data, addr))
+        return datagrams
+
+
+class send_iovec(ctypes.Structure):
+    """
+    an iovec whose base is set directly from a byte string,
+    which ctypes keeps alive for as long as the iovec holds it
+    """
+    _fields_ = [
+        ("iov_base", ctypes.c_char_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class MmsgSender(object):
+    """
+    i send many datagrams with one sendmmsg call. each datagram
+    is a list of byte strings which are gathered by the kernel,
+    so they never need to be joined. my headers and iovecs are
+    allocated once, with room for max_parts parts per datagram.
+    """
+
+    def __init__(self, batch_size=64, max_parts=8):
+        self.batch_size = batch_size
+        self.max_parts = max_parts
+        self._sockaddrs = {}
+        self._iovecs = (send_iovec * (batch_size * max_parts))()
+        self._headers = (mmsghdr * batch_size)()
+        iovec_pointer = ctypes.POINTER(iovec)
+        for i in range(batch_size):
+            self._headers[i].msg_hdr.msg_iov = ctypes.cast(ctypes.byref(self._iovecs, i * max_parts * ctypes.sizeof(send_iovec)),
+                                                           iovec_pointer)
+
+    def _sockaddr(self, addr):
+        sockaddr = self._sockaddrs.get(addr)
+        if sockaddr is None:
+            if len(self._sockaddrs) > 4096:
+                self._sockaddrs.clear()
+            raw = encode_sockaddr(addr)
+            sockaddr = (ctypes.create_string_buffer(raw), len(raw))
+            self._sockaddrs[addr] = sockaddr
+        return sockaddr
+
+    def send(self, fd, datagrams):
+        """
+        send a list of (parts, (host, port)) 2-tuples, where parts is
+        a list of byte strings, and return the number that were sent.
+        raises socket.error if not even the first datagram could be sent.
+        """
+        headers = self._headers
+        iovecs = self._iovecs
+        max_parts = self.max_parts
+        sent = 0
+        while sent < len(datagrams):
+            batch = datagrams[sent:sent + self.batch_size]
+            for i, (parts, addr) in enumerate(batch):
+                if len(parts) > max_parts:
+                    parts = [b"".join(parts)]
+                first = i * max_parts
+                for j, part in enumerate(parts):
+                    part_iovec = iovecs[first + j]
+                    part_iovec.iov_base = part
+                    part_iovec.iov_len = len(part)
+                sockaddr, sockaddr_len = self._sockaddr(addr)
+                header = headers[i].msg_hdr
+                header.msg_name = ctypes.addressof(sockaddr)
+                header.msg_namelen = sockaddr_len
+                header.msg_iovlen = len(parts)
+            count = _sendmmsg(fd, headers, len(batch), MSG_DONTWAIT)
+            if count < 0:
+                if sent == 0:
+                    _raise_errno()
+                break
+            sent += count
+            if count < len(batch):
+                break
+        return sent
+
+
+_sockErrReadIgnore = (errno.EAGAIN, errno.EINTR, errno.EWOULDBLOCK)
+
+
+class MmsgPort(udp.Port):
+    """
+    i am a twisted UDP port which reads every waiting datagram
+    with recvmmsg and passes them to my protocol's datagramsReceived
+    method as one list. datagrams passed to write_batched during a
+    reactor turn are sent together with sendmmsg at its end.
+    """
+
+    def __init__(self, port, proto, interface='', maxPacketSize=8192, reactor=None, batch_size=64):
+        udp.Port.__init__(self, port, proto, interface, maxPacketSize, reactor)
+        self.batch_size = batch_size
+        self._use_mmsg = available()
+        if self._use_mmsg:
+            self._receiver = MmsgReceiver(batch_size, maxPacketSize)
+            self._sender = MmsgSender(batch_size)
+        self._outgoing = []
+        self._flush_call = None
+        self.send_drops = 0
+
+    def doRead(self):
+        if not self._use_mmsg:
+            return udp.Port.doRead(self)
+        read = 0
+        while read < self.maxThroughput:
+            try:
+                datagrams = self._receiver.recv(self.fileno())
+            except socket.error as se:
+                if se.args[0] in _sockErrReadIgnore:
+                    return
+                if se.args[0] == errno.ENOSYS:
+                    self._use_mmsg = False
+                    return udp.Port.doRead(self)
+                if se.args[0] == errno.ECONNREFUSED:
+                    return
+                raise
+            if not datagrams:
+                return
+            for data, _ in datagrams:
+                read += len(data)
+            try:
+                self.protocol.datagramsReceived(datagrams)
+            except Exception:
+                log.err()
+            if len(datagrams) < self.batch_size:
+                return
+
+    def write_batched(self, parts, addr):
+        """
+        queue a datagram, a list of byte strings, to be sent to addr
+        at the end of this reactor turn
+        """
+        if not self._use_mmsg:
+            return self.write(b"".join(parts), addr)
+        self._outgoing.append((parts, addr))
+        if self._flush_call is None:
+            self._flush_call = self.reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """
+        send all queued datagrams. datagrams the kernel refuses
+        because the socket buffer is full are dropped and counted,
+        as is a datagram which fails to send for any other reason,
+        which is also logged, before the rest are sent.
+        """
+        self._flush_call = None
+        outgoing = self._outgoing
+        self._outgoing = []
+        while outgoing:
+            try:
+                sent = self._sender.send(self.fileno(), outgoing)
+            except socket.error as se:
+                if se.args[0] == errno.EINTR:
+                    continue
+                if se.args[0] == errno.ENOSYS:
+                    self._use_mmsg = False
+                    for parts, addr in outgoing:
+                        self.write(b"".join(parts), addr)
+                    return
+                if se.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._dropped(len(outgoing))
+                    return
+                if se.args[0] != errno.ECONNREFUSED:
+                    log.msg("dropped a datagram to %r: %s" % (outgoing[0][1], se))
+                # the error is for the first datagram, or is a
+                # stale icmp error from an earlier send
+                sent = 1
+                self._dropped(1)
+            outgoing = outgoing[sent:]
+
+    def _dropped(self, count):
+        self.send_drops += count
+        SEND_FAILURES.inc(count)
+
+    def connectionLost(self, reason=None):
+        if self._flush_call is not None:
+            self._flush_call.cancel()
+            self._flush_call = None
+        self._outgoing = []
+        udp.Port.connectionLost(self, reason)
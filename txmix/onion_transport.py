@@ -12,22 +12,32 @@ transport does not:
 
 import attr
 import types
+import struct
 
 from eliot import start_action
 from eliot.twisted import DeferredContext
 
 from zope.interface import implementer
 
-from twisted.internet.protocol import Factory
+from twisted.internet.protocol import Factory, Protocol
 from twisted.internet import endpoints
-from twisted.internet.interfaces import IReactorCore, IProtocolFactory
-from twisted.protocols.basic import Int32StringReceiver
+from twisted.internet.interfaces import IReactorCore, IReactorTime, IProtocolFactory, IPushProducer
+from twisted.protocols.basic import Int32StringReceiver, StringTooLongError
 from twisted.internet import defer
 from twisted.internet.error import ConnectionDone
 
 import txtorcon
 
-from txmix import IMixTransport
+from txmix import IGatherTransport
+from txmix.instrumentation import start_packet_action, finish_packet_action
+from txmix.metrics import transport_metrics, default_registry
+
+
+DATAGRAMS_RECEIVED, DATAGRAMS_SENT, SEND_FAILURES = transport_metrics("onion")
+REJECTED_FRAMES = default_registry.counter(
+    "txmix_transport_rejected_frames_total", "frames of the wrong size rejected by transports", {"transport": "onion"})
+
+FRAME_PREFIX = struct.Struct("!I")
 
 
 @attr.s()
@@ -82,6 +92,13 @@ class OnionTransportConnectionFailure(Exception):
     """
 
 
+class SendQueueFullError(Exception):
+    """
+    a stream's write buffer is full and it has
+    queued as many frames as it may until it drains
+    """
+
+
 @attr.s()
 class OnionDatagramProxy(object, Int32StringReceiver):
     """
@@ -100,24 +117,370 @@ class OnionDatagramProxy(object, Int32StringReceiver):
             pass  # XXX todo: log an error
 
 
+class SphinxFrameReceiver(Protocol):
+    """
+    i proxy datagrams of exactly frame_size bytes from a stream to
+    frames_received_handler, which is called once per dataReceived
+    with a list of every frame it completed.
+
+    frames carry the same length prefix as Int32StringReceiver's.
+    a prefix giving any length other than frame_size loses the
+    connection before anything is allocated for the frame. a frame
+    split across reads is gathered in a buffer allocated once per
+    connection, and a frame within one read is sliced out of it.
+    """
+
+    def __init__(self, frame_size, frames_received_handler):
+        self.frame_size = frame_size
+        self.frames_received_handler = frames_received_handler
+        self.rejected = False
+        self._record_size = FRAME_PREFIX.size + frame_size
+        self._record = bytearray(self._record_size)  # the prefix and frame split across reads
+        self._buffer = memoryview(self._record)
+        self._buffered = 0
+
+    def dataReceived(self, data):
+        if self.rejected:
+            return
+        frame_size = self.frame_size
+        record_size = self._record_size
+        frames = []
+        offset = 0
+        end = len(data)
+        buffered = self._buffered
+        if buffered:
+            # finish the frame split across reads
+            taken = min(record_size - buffered, end)
+            self._buffer[buffered:buffered + taken] = memoryview(data)[:taken]
+            self._buffered = buffered + taken
+            if buffered < FRAME_PREFIX.size <= self._buffered and not self._check_length(self._record, 0):
+                return
+            if self._buffered < record_size:
+                return
+            frames.append(self._buffer[FRAME_PREFIX.size:].tobytes())
+            self._buffered = 0
+            offset = taken
+        # whole frames are sliced straight out of data
+        while end - offset >= record_size:
+            length = FRAME_PREFIX.unpack_from(data, offset)[0]
+            if length != frame_size:
+                self.frame_rejected(length)
+                break
+            frames.append(data[offset + FRAME_PREFIX.size:offset + record_size])
+            offset += record_size
+        else:
+            if offset < end:
+                taken = end - offset
+                self._buffer[:taken] = memoryview(data)[offset:]
+                self._buffered = taken
+                if taken >= FRAME_PREFIX.size:
+                    self._check_length(data, offset)
+        if frames:
+            self.frames_received_handler(frames)
+
+    def _check_length(self, data, offset):
+        length = FRAME_PREFIX.unpack_from(data, offset)[0]
+        if length == self.frame_size:
+            return True
+        self.frame_rejected(length)
+        return False
+
+    def frame_rejected(self, length):
+        """
+        called with the length of a frame which is not frame_size bytes
+        """
+        REJECTED_FRAMES.inc()
+        self.rejected = True
+        self.transport.loseConnection()
+
+
 @implementer(IProtocolFactory)
 @attr.s()
 class OnionDatagramProxyFactory(object, Factory):
     """
-    proxy datagrams to received_handler
+    proxy datagrams to received_handler. if frame_size is given then
+    every datagram must be frame_size bytes long and those read
+    together from a stream are passed in one list to
+    batch_received_handler, or one by one to received_handler if
+    there is no batch handler.
     """
     received_handler = attr.ib(validator=attr.validators.instance_of(types.FunctionType))
+    frame_size = attr.ib(validator=attr.validators.optional(attr.validators.instance_of(int)), default=None)
+    batch_received_handler = attr.ib(validator=attr.validators.optional(attr.validators.instance_of(types.FunctionType)),
+                                     default=None)
+
+    def _frames_received(self, frames):
+        if self.batch_received_handler is not None:
+            self.batch_received_handler(frames)
+        else:
+            for frame in frames:
+                self.received_handler(frame)
 
     # IProtocolFactory methods
     def buildProtocol(self, addr):
+        if self.frame_size is not None:
+            return SphinxFrameReceiver(self.frame_size, self._frames_received)
         return OnionDatagramProxy(lambda x: self.received_handler(x))
 
 
-@implementer(IMixTransport)
+@implementer(IPushProducer)
+@attr.s()
+class OnionSendProtocol(object, Protocol):
+    """
+    i am a long lived outbound stream to a remote mix.
+    messages are sent as successive length prefixed frames.
+    frames queued during one reactor turn, or within flush_delay
+    seconds, are coalesced into a single writeSequence call,
+    which is given the parts of each frame without joining them.
+    i register myself as a producer with my transport so that
+    my pool can tell when my write buffer is full. while it is
+    full i hold my frames, up to max_paused_bytes of them, and
+    write them once it drains.
+    """
+    connection_lost_handler = attr.ib(validator=attr.validators.instance_of(types.FunctionType))
+    reactor = attr.ib(validator=attr.validators.provides(IReactorTime))
+    flush_delay = attr.ib(default=0)
+    max_queued_bytes = attr.ib(validator=attr.validators.instance_of(int), default=65536)
+    max_paused_bytes = attr.ib(validator=attr.validators.instance_of(int), default=1048576)
+
+    paused = False
+    idle_call = None
+    _queue = None
+    _flush_call = None
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+
+    def connectionLost(self, reason):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        waiters = self._waiters if self._queue is not None else []
+        self._queue = None
+        for d in waiters:
+            d.errback(reason)
+        self.connection_lost_handler(self)
+
+    def queue_frame(self, frame):
+        """
+        queue a frame to be written by the next flush
+        """
+        return self.queue_frame_parts([frame])
+
+    def queue_frame_parts(self, parts):
+        """
+        queue a frame, given as a list of byte strings, to be
+        written by the next flush. returns a deferred which fires
+        once the frame is written to my transport, or fails if my
+        connection is lost first or my write buffer is full and
+        max_paused_bytes are already queued.
+        """
+        length = sum(len(part) for part in parts)
+        if length >= 2 ** (8 * FRAME_PREFIX.size):
+            raise StringTooLongError(
+                "Try to send %s bytes whereas maximum is %s" % (
+                    length, 2 ** (8 * FRAME_PREFIX.size)))
+        queued_bytes = self._queued_bytes if self._queue is not None else 0
+        if self.paused and queued_bytes + length > self.max_paused_bytes:
+            return defer.fail(SendQueueFullError())
+        if self._queue is None:
+            self._queue = []
+            self._waiters = []
+            self._queued_bytes = 0
+        d = defer.Deferred()
+        self._queue.append(FRAME_PREFIX.pack(length))
+        self._queue.extend(parts)
+        self._waiters.append(d)
+        self._queued_bytes += length
+        if not self.paused:
+            if self._queued_bytes >= self.max_queued_bytes:
+                self.flush()
+            elif self._flush_call is None:
+                self._flush_call = self.reactor.callLater(self.flush_delay, self.flush)
+        return d
+
+    def flush(self):
+        """
+        write all queued frames unless my write buffer is full
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if self._queue is None or self.paused:
+            return
+        queue, waiters = self._queue, self._waiters
+        self._queue = None
+        self._waiters = None
+        self.transport.writeSequence(queue)
+        for d in waiters:
+            d.callback(None)
+
+    # IPushProducer methods
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.flush()
+
+    def stopProducing(self):
+        self.paused = True
+
+
+class StreamConnectionPool(object):
+    """
+    i keep long lived outbound streams to other mixes so that
+    messages to the same next hop share a stream instead of each
+    paying for a new one. a peer gets another stream, up to
+    max_connections_per_peer, only when all of its existing streams
+    have full write buffers. streams unused for idle_timeout seconds
+    are closed and lost streams are reopened on the next send.
+    frames are coalesced and held by each stream as described by
+    flush_delay, max_queued_bytes and max_paused_bytes. once i am
+    closed my connection attempts are cancelled and sends fail.
+    """
+
+    def __init__(self, reactor, endpoint_factory, max_connections_per_peer=1, idle_timeout=300, connect_retries=1,
+                 flush_delay=0, max_queued_bytes=65536, max_paused_bytes=1048576):
+        assert IReactorTime.providedBy(reactor)
+        assert max_connections_per_peer >= 1
+        self.reactor = reactor
+        self.endpoint_factory = endpoint_factory
+        self.max_connections_per_peer = max_connections_per_peer
+        self.idle_timeout = idle_timeout
+        self.connect_retries = connect_retries
+        self.flush_delay = flush_delay
+        self.max_queued_bytes = max_queued_bytes
+        self.max_paused_bytes = max_paused_bytes
+        self._connections = {}  # addr -> [OnionSendProtocol]
+        self._pending = {}  # addr -> [Deferred] waiting for a connection attempt
+        self._connecting = {}  # addr -> Deferred of the connection attempt
+        self._round_robin = {}  # addr -> int
+        self.closed = False
+
+    def connections(self, addr):
+        """
+        return the list of open streams to addr
+        """
+        return list(self._connections.get(addr, []))
+
+    def send(self, addr, message):
+        """
+        send message as one frame on a stream to addr, returns
+        a deferred which fires once the frame is written to it
+        """
+        return self.send_parts(addr, [message])
+
+    def send_parts(self, addr, parts):
+        """
+        send the byte strings in parts as one frame on a stream
+        to addr, returns a deferred which fires once it is written
+        """
+        d = self._get_connection(addr)
+        d.addCallback(lambda protocol: self._send(protocol, parts))
+        return d
+
+    def _send(self, protocol, parts):
+        if protocol.idle_call.active():
+            protocol.idle_call.reset(self.idle_timeout)
+        return protocol.queue_frame_parts(parts)
+
+    def _get_connection(self, addr):
+        if self.closed:
+            return defer.fail(defer.CancelledError("the stream connection pool is closed"))
+        connections = self._connections.get(addr, [])
+        ready = [x for x in connections if not x.paused]
+        if addr in self._pending:
+            if not ready:
+                d = defer.Deferred()
+                self._pending[addr].append(d)
+                return d
+        elif not ready and len(connections) < self.max_connections_per_peer:
+            return self._connect(addr)
+        if not ready:
+            ready = connections
+        i = self._round_robin.get(addr, 0) % len(ready)
+        self._round_robin[addr] = i + 1
+        return defer.succeed(ready[i])
+
+    def _connect(self, addr):
+        waiters = [defer.Deferred()]
+        self._pending[addr] = waiters
+        action = start_action(
+            action_type=u"stream-connection-pool:connect",
+            destination=addr,
+        )
+        with action.context():
+            d = self._connect_with_retries(addr, self.connect_retries)
+            self._connecting[addr] = d
+            DeferredContext(d).addActionFinish()
+
+        def _connected(protocol):
+            del self._pending[addr]
+            del self._connecting[addr]
+            if self.closed:
+                protocol.transport.loseConnection()
+                return _notify_failed(defer.CancelledError("the stream connection pool is closed"))
+            protocol.idle_call = self.reactor.callLater(self.idle_timeout, protocol.transport.loseConnection)
+            self._connections.setdefault(addr, []).append(protocol)
+            for waiter in waiters:
+                waiter.callback(protocol)
+
+        def _notify_failed(failure):
+            for waiter in waiters:
+                waiter.errback(failure)
+
+        def _failed(failure):
+            del self._pending[addr]
+            del self._connecting[addr]
+            _notify_failed(failure)
+
+        d.addCallbacks(_connected, _failed)
+        return waiters[0]
+
+    def _connect_with_retries(self, addr, retries):
+        protocol = OnionSendProtocol(lambda x: self._connection_lost(addr, x),
+                                     self.reactor,
+                                     flush_delay=self.flush_delay,
+                                     max_queued_bytes=self.max_queued_bytes,
+                                     max_paused_bytes=self.max_paused_bytes)
+        d = endpoints.connectProtocol(self.endpoint_factory(addr), protocol)
+        if retries > 0:
+            def _retry(failure):
+                if self.closed:
+                    return failure
+                return self._connect_with_retries(addr, retries - 1)
+            d.addErrback(_retry)
+        return d
+
+    def _connection_lost(self, addr, protocol):
+        if protocol.idle_call is not None and protocol.idle_call.active():
+            protocol.idle_call.cancel()
+        connections = self._connections.get(addr, [])
+        if protocol in connections:
+            connections.remove(protocol)
+        if not connections:
+            self._connections.pop(addr, None)
+            self._round_robin.pop(addr, None)
+
+    def close(self):
+        """
+        cancel my connection attempts and close all of my streams
+        """
+        self.closed = True
+        for d in list(self._connecting.values()):
+            d.cancel()
+        for connections in list(self._connections.values()):
+            for protocol in list(connections):
+                protocol.transport.loseConnection()
+
+
+@implementer(IGatherTransport)
 @attr.s()
 class OnionTransport(object):
     """
-    implements the IMixTransport interface using Tor as the transport.
+    implements the IGatherTransport interface using Tor as the transport.
     A Tor onion service is used for receiving messages.
     """
     name = "onion"
@@ -136,6 +499,17 @@ class OnionTransport(object):
     onion_tcp_interface_ip = attr.ib(validator=attr.validators.instance_of(str), default="")
     onion_tcp_port = attr.ib(validator=attr.validators.instance_of(int), default=0)
 
+    # outbound streams are pooled per destination and
+    # frames to the same destination are coalesced
+    max_connections_per_peer = attr.ib(validator=attr.validators.instance_of(int), default=1)
+    idle_timeout = attr.ib(default=300)
+    flush_delay = attr.ib(default=0)
+
+    # the size of every datagram received, or None for the size given
+    # by my protocol's frame_size attribute. a protocol without one
+    # can be sent datagrams of any size.
+    frame_size = attr.ib(validator=attr.validators.optional(attr.validators.instance_of(int)), default=None)
+
     @property
     def addr(self):
         return self.onion_host, self.onion_port
@@ -166,6 +540,11 @@ class OnionTransport(object):
         # save a TorConfig so we can later use it to send messages
         self.torconfig = txtorcon.TorConfig(control=self.tor.protocol)
         yield self.torconfig.post_bootstrap
+        self.connection_pool = StreamConnectionPool(self.reactor,
+                                                    lambda addr: self.tor.stream_via(*addr),
+                                                    max_connections_per_peer=self.max_connections_per_peer,
+                                                    idle_timeout=self.idle_timeout,
+                                                    flush_delay=self.flush_delay)
 
         hs_strings = []
         if len(self.onion_unix_socket) == 0:
@@ -173,7 +552,12 @@ class OnionTransport(object):
         else:
             local_socket_endpoint_desc = "unix:%s" % self.onion_unix_socket
         onion_service_endpoint = endpoints.serverFromString(self.reactor, local_socket_endpoint_desc)
-        datagram_proxy_factory = OnionDatagramProxyFactory(received_handler=lambda x: self.datagram_received(x))
+        frame_size = self.frame_size
+        if frame_size is None:
+            frame_size = getattr(self.mix_protocol, "frame_size", None)
+        datagram_proxy_factory = OnionDatagramProxyFactory(received_handler=lambda x: self.datagram_received(x),
+                                                           frame_size=frame_size,
+                                                           batch_received_handler=lambda x: self.datagrams_received(x))
         yield onion_service_endpoint.listen(datagram_proxy_factory)
         if len(self.onion_unix_socket) == 0:
             hs_strings.append("%s %s:%s" % (self.onion_port, self.onion_tcp_interface_ip, self.onion_tcp_port))
@@ -183,33 +567,50 @@ class OnionTransport(object):
         yield hs.add_to_tor(self.tor.protocol)
 
     def send(self, addr, message):
-        action = start_action(
-            action_type=u"onion-transport:send",
-            destination=addr,
-            message_size=len(message),
-        )
+        return self.send_parts(addr, [message])
+
+    def send_parts(self, addr, parts):
+        action = start_packet_action(u"onion-transport:send", destination=addr,
+                                     message_size=sum(len(part) for part in parts))
         with action.context():
-            d = self.do_send(addr, message)
-            return DeferredContext(d).addActionFinish()
+            d = self.do_send(addr, parts)
+            d.addCallbacks(self._sent, self._send_failed)
+            return finish_packet_action(action, d)
 
-    @defer.inlineCallbacks
-    def do_send(self, addr, message):
+    def _sent(self, result):
+        DATAGRAMS_SENT.inc()
+        return result
+
+    def _send_failed(self, failure):
+        SEND_FAILURES.inc()
+        return failure
+
+    def do_send(self, addr, parts):
         """
-        send message to addr
+        send the byte strings in parts as one message to addr
         where addr is a 2-tuple of type: (onion host, onion port)
         """
-        onion_host, onion_port = addr
-        tor_endpoint = self.tor.stream_via(onion_host, onion_port)
-        send_message_protocol = Int32StringReceiver()
-        self.remote_mix_protocol = yield endpoints.connectProtocol(tor_endpoint, send_message_protocol)
-        self.remote_mix_protocol.sendString(message)
-        self.remote_mix_protocol.transport.loseConnection()
+        return self.connection_pool.send_parts(addr, parts)
 
     # Protocol parent method overwriting
 
     def datagram_received(self, data):
+        DATAGRAMS_RECEIVED.inc()
         self.mix_protocol.received(data)
 
+    def datagrams_received(self, datagrams):
+        """
+        receive the datagrams read together from one stream,
+        in one batch if my protocol has a received_batch method
+        """
+        DATAGRAMS_RECEIVED.inc(len(datagrams))
+        received_batch = getattr(self.mix_protocol, "received_batch", None)
+        if received_batch is not None:
+            received_batch(datagrams)
+        else:
+            for datagram in datagrams:
+                self.mix_protocol.received(datagram)
+
     def connectionLost(self, reason):
         """
         Called when the connection is shut down.
@@ -0,0 +1,191 @@
+"""
+a versioned pki built from consensus documents
+
+A consensus document lists every mix node with its public key and
+its address on each transport, and carries the version of the
+consensus it describes:
+
+    {"version": 7,
+     "nodes": [{"id": "<hex node id>",
+                "public_key": "<hex public key>",
+                "addrs": {"udp": ["10.0.0.1", 9000], "onion": ["abc.onion", 9000]}}]}
+
+A diff names the consensus version it applies to and the version it
+produces, lists the node IDs to remove and the nodes to add or
+replace, given like those of a document:
+
+    {"from_version": 7, "version": 8, "remove": ["<hex node id>"], "nodes": [...]}
+
+Addresses given as JSON lists are turned into tuples.
+
+A key rotated by a mix itself is staged until the next consensus
+document or diff is applied, as that is when the rest of the network
+learns it too.
+"""
+
+import json
+import binascii
+
+import attr
+from zope.interface import implementer
+
+from sphinxmixcrypto import IMixPKI
+
+from txmix.utils import is_16bytes, is_32bytes
+
+
+class ConsensusVersionError(Exception):
+    """
+    a consensus diff does not apply to the current consensus version
+    """
+
+
+def _decode_addr(addr):
+    if isinstance(addr, list):
+        return tuple(addr)
+    return addr
+
+
+@attr.s(slots=True, frozen=True)
+class NodeRecord(object):
+    """
+    i am everything a pki knows about a mix node: its public key and
+    its address on each transport. an address for the transport
+    name None is used for transports without an address of their own.
+    """
+    node_id = attr.ib(validator=is_16bytes)
+    public_key = attr.ib(validator=is_32bytes)
+    addrs = attr.ib(validator=attr.validators.instance_of(dict))
+
+    @classmethod
+    def from_dict(cls, node):
+        addrs = dict((name, _decode_addr(addr)) for name, addr in node["addrs"].items())
+        return cls(binascii.unhexlify(node["id"]), binascii.unhexlify(node["public_key"]), addrs)
+
+    def addr(self, transport_name):
+        if transport_name in self.addrs:
+            return self.addrs[transport_name]
+        return self.addrs[None]
+
+
+@implementer(IMixPKI)
+class ConsensusPKI(object):
+    """
+    i am a pki holding one NodeRecord per mix node, loaded from a
+    consensus document and kept up to date with consensus diffs,
+    which only touch the records they name.
+
+    my version increases whenever my mix nodes or their keys or
+    addresses change, so that data derived from them can be cached
+    until it does. consensus_version is the version of the last
+    consensus document or diff applied.
+
+    keys given to rotate are staged and replace the keys of their
+    mix nodes when the next consensus document or diff is applied,
+    unless it changes those keys itself.
+    """
+
+    def __init__(self, consensus=None):
+        self._records = {}
+        self._client_addrs = {}  # (transport name, client ID) -> addr
+        self._identities = None
+        self._staged_keys = {}  # node ID -> (public key, new public key)
+        self.version = 0
+        self.consensus_version = None
+        if consensus is not None:
+            self.load(consensus)
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(json.loads(text))
+
+    def __len__(self):
+        return len(self._records)
+
+    def _changed(self):
+        self.version += 1
+        self._identities = None
+
+    def _apply_staged_keys(self):
+        for node_id, (public_key, new_public_key) in self._staged_keys.items():
+            record = self._records.get(node_id)
+            if record is not None and record.public_key == public_key:
+                self._records[node_id] = NodeRecord(node_id, new_public_key, record.addrs)
+        self._staged_keys = {}
+
+    def load(self, consensus):
+        """
+        replace every mix node with those of a consensus document
+        """
+        records = {}
+        for node in consensus["nodes"]:
+            record = NodeRecord.from_dict(node)
+            records[record.node_id] = record
+        self._records = records
+        self._apply_staged_keys()
+        self.consensus_version = consensus["version"]
+        self._changed()
+
+    def apply_diff(self, diff):
+        """
+        apply a consensus diff, raises ConsensusVersionError if it
+        is not a diff from my consensus version
+        """
+        if diff["from_version"] != self.consensus_version:
+            raise ConsensusVersionError("diff from version %r does not apply to version %r" % (
+                diff["from_version"], self.consensus_version))
+        records = [NodeRecord.from_dict(node) for node in diff.get("nodes", ())]
+        for node_id in diff.get("remove", ()):
+            self._records.pop(binascii.unhexlify(node_id), None)
+        for record in records:
+            self._records[record.node_id] = record
+        self._apply_staged_keys()
+        self.consensus_version = diff["version"]
+        self._changed()
+
+    def record(self, node_id):
+        return self._records[node_id]
+
+    def staged_key(self, node_id):
+        """
+        return the key staged for a mix node by rotate, or None
+        """
+        staged = self._staged_keys.get(node_id)
+        if staged is None:
+            return None
+        return staged[1]
+
+    # IMixPKI
+
+    def set(self, node_id, pub_key, addr):
+        assert node_id not in self._records
+        self._records[node_id] = NodeRecord(node_id, pub_key, {None: addr})
+        self._changed()
+
+    def get(self, node_id):
+        return self._records[node_id].public_key
+
+    def identities(self):
+        """
+        return a tuple of the node IDs, which is shared by
+        every caller until my mix nodes change
+        """
+        if self._identities is None:
+            self._identities = tuple(self._records)
+        return self._identities
+
+    def set_client_addr(self, transport_name, client_id, addr):
+        self._client_addrs[(transport_name, client_id)] = addr
+
+    def get_client_addr(self, transport_name, client_id):
+        return self._client_addrs[(transport_name, client_id)]
+
+    def get_mix_addr(self, transport_name, node_id):
+        return self._records[node_id].addr(transport_name)
+
+    def rotate(self, node_id, new_pub_key, signature):
+        """
+        stage a new key for a mix node, which is used once the next
+        consensus document or diff is applied
+        """
+        self._staged_keys[node_id] = (self._records[node_id].public_key, new_pub_key)
@@ -0,0 +1,230 @@
+"""
+sphinx headers and reply blocks built ahead of the messages they carry
+
+A forward sphinx header and the per hop secrets its payload is
+encrypted with depend only on the route, so a client can build them
+while it is idle. Sending a message with a PrecomputedHeader then only
+costs the Lioness encryption of the payload. A HeaderPool keeps a
+number of them ready for routes from a route factory, and a
+ReplyBlockPool does the same for reply blocks.
+"""
+
+import attr
+import time
+import collections
+
+from sphinxmixcrypto import SphinxPacket, SphinxHeader, SphinxBody, SphinxLioness, SphinxParams
+from sphinxmixcrypto import destination_encode, add_padding, SECURITY_PARAMETER
+
+from txmix.header import create_header
+from txmix.metrics import precompute_pool_metrics
+
+
+@attr.s
+class PrecomputedHeader(object):
+    """
+    i am a forward sphinx header for a route and the secrets shared
+    with each of its hops. i must be used for one message only,
+    otherwise the messages sent with me could be linked to each
+    other and would be dropped as replays.
+    """
+    route = attr.ib(validator=attr.validators.instance_of(list))
+    header = attr.ib(validator=attr.validators.instance_of(SphinxHeader))
+    secrets = attr.ib(validator=attr.validators.instance_of(list))
+
+    @classmethod
+    def build(cls, params, route, pki, rand_reader):
+        """
+        build a header for route, looking up the public keys of its
+        hops in pki
+        """
+        header, secrets = create_header(params, route, pki, b"\x00", b"\x00" * SECURITY_PARAMETER, rand_reader)
+        return cls(route, header, secrets)
+
+    def compose_forward_message(self, params, message, dest=None):
+        """
+        return a SphinxPacket carrying message to dest, by default
+        the last hop of my route, like SphinxPacket.forward_message
+        """
+        assert isinstance(params, SphinxParams)
+        if dest is None:
+            dest = self.route[-1]
+        assert len(dest) < 128 and len(dest) > 0
+        assert SECURITY_PARAMETER + 1 + len(dest) + len(message) < params.payload_size
+        body = (b"\x00" * SECURITY_PARAMETER) + bytes(destination_encode(dest)) + bytes(message)
+        delta = add_padding(body, params.payload_size)
+        block_cipher = SphinxLioness()
+        for secret in reversed(self.secrets[:len(self.route)]):
+            delta = block_cipher.encrypt(block_cipher.create_block_cipher_key(secret), delta)
+        return SphinxPacket(self.header, SphinxBody(delta))
+
+
+class RefillingPool(object):
+    """
+    i hold items which are expensive to build and are each handed
+    out once. when fewer than low_watermark remain i build more in
+    the background, one per reactor turn so that other work runs in
+    between, until i hold high_watermark. if max_age is set i drop
+    items older than that many seconds and replace them.
+
+    take returns an item in O(1), or None when i am empty. hits,
+    misses, the time each item took to build and the time each
+    refill took to reach the high watermark are counted in the
+    metrics of my pool_name.
+    """
+    pool_name = None
+
+    def __init__(self, reactor, low_watermark, high_watermark, max_age=None):
+        assert 0 <= low_watermark < high_watermark or 0 < low_watermark == high_watermark
+        assert max_age is None or max_age > 0
+        self.reactor = reactor
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.max_age = max_age
+        self._items = collections.deque()  # (creation time, item)
+        self._refill_call = None
+        self._refill_started = None
+        self._expire_call = None
+        self.running = False
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._hits_counter, self._misses_counter, self._build_seconds, self._refill_seconds = \
+            precompute_pool_metrics(self.pool_name)
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def hit_rate(self):
+        takes = self.hits + self.misses
+        return float(self.hits) / takes if takes else 0.0
+
+    def build(self):
+        """
+        return a new item
+        """
+        raise NotImplementedError
+
+    def start(self):
+        self.running = True
+        self._refill_started = time.time()
+        self._schedule_refill()
+
+    def stop(self):
+        """
+        stop refilling and forget every item
+        """
+        self.running = False
+        for call in (self._refill_call, self._expire_call):
+            if call is not None:
+                call.cancel()
+        self._refill_call = self._expire_call = None
+        self._refill_started = None
+        self._items.clear()
+
+    def take(self):
+        """
+        remove and return the oldest unexpired item, or None if i
+        have none, in which case the caller builds its own
+        """
+        self._expire()
+        if not self._items:
+            self.misses += 1
+            self._misses_counter.inc()
+            self._start_refill()
+            return None
+        self.hits += 1
+        self._hits_counter.inc()
+        item = self._items.popleft()[1]
+        if len(self._items) < self.low_watermark:
+            self._start_refill()
+        return item
+
+    def _start_refill(self):
+        if self._refill_started is None:
+            self._refill_started = time.time()
+        self._schedule_refill()
+
+    def _schedule_refill(self):
+        if self.running and self._refill_call is None and self._refill_started is not None:
+            self._refill_call = self.reactor.callLater(0, self._refill)
+
+    def _refill(self):
+        self._refill_call = None
+        start = time.time()
+        item = self.build()
+        self._build_seconds.observe(time.time() - start)
+        self._items.append((self.reactor.seconds(), item))
+        if len(self._items) >= self.high_watermark:
+            self._refill_seconds.observe(time.time() - self._refill_started)
+            self._refill_started = None
+        self._schedule_expire()
+        self._schedule_refill()
+
+    def _schedule_expire(self):
+        if self.max_age is not None and self._expire_call is None and self._items:
+            delay = max(0, self._items[0][0] + self.max_age - self.reactor.seconds())
+            self._expire_call = self.reactor.callLater(delay, self._expired)
+
+    def _expired(self):
+        self._expire_call = None
+        self._expire()
+        self._schedule_expire()
+        if len(self._items) < self.low_watermark:
+            self._start_refill()
+
+    def _expire(self):
+        if self.max_age is None:
+            return
+        cutoff = self.reactor.seconds() - self.max_age
+        while self._items and self._items[0][0] <= cutoff:
+            self._items.popleft()
+            self.expired += 1
+
+
+class HeaderPool(RefillingPool):
+    """
+    i keep up to depth PrecomputedHeaders for routes from a route
+    factory and replace any which are older than max_age seconds,
+    since they may have been built with keys the pki no longer has.
+    """
+    pool_name = "header"
+
+    def __init__(self, params, pki, route_factory, rand_reader, reactor, depth=16, max_age=600):
+        RefillingPool.__init__(self, reactor, depth, depth, max_age)
+        self.params = params
+        self.pki = pki
+        self.route_factory = route_factory
+        self.rand_reader = rand_reader
+
+    def build(self):
+        return PrecomputedHeader.build(self.params, self.route_factory.build_route(), self.pki, self.rand_reader)
+
+
+class ReplyBlockPool(RefillingPool):
+    """
+    i keep between low_watermark and high_watermark reply blocks
+    created by a ClientProtocol for routes from a route factory.
+    their decryption tokens are registered with the protocol when
+    they are taken, not when they are built, so that a reply block
+    which waited in the pool longer than the protocol's token_ttl
+    can still be replied to.
+    """
+    pool_name = "reply_block"
+
+    def __init__(self, protocol, route_factory, reactor, low_watermark=8, high_watermark=32, max_age=None):
+        RefillingPool.__init__(self, reactor, low_watermark, high_watermark, max_age)
+        self.protocol = protocol
+        self.route_factory = route_factory
+
+    def build(self):
+        return self.protocol.compose_reply_block(self.route_factory.build_route())
+
+    def take(self):
+        item = RefillingPool.take(self)
+        if item is None:
+            return None
+        message_id, secrets, reply_block = item
+        self.protocol.add_decryption_token(message_id, secrets)
+        return reply_block
@@ -0,0 +1,437 @@
+"""
+bounded replay caches for mix nodes
+
+Sphinx replay tags are 32 byte hash digests so I store them as
+fixed width entries in a flat open addressing hash table instead
+of as dictionary keys. This costs about a third of the memory
+of PacketReplayCacheDict and never needs to resize. When a table is
+full new tags are refused with ReplayCacheFullError, dropping the
+packet, rather than forgetting old tags and allowing replays.
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+import collections
+
+from zope.interface import implementer
+from twisted.internet import reactor as default_reactor
+
+from sphinxmixcrypto import ReplayError
+
+from txmix.interfaces import IBatchPacketReplayCache
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+
+TAG_SIZE = 32
+EMPTY_SLOT = b"\x00" * TAG_SIZE
+MAX_LOAD_FACTOR = 0.75
+
+
+class ReplayCacheFullError(Exception):
+    """
+    the replay cache has reached its capacity
+    """
+
+
+class ReplayCacheFileError(Exception):
+    """
+    the replay cache file is not usable
+    """
+
+
+def table_slot_count(capacity):
+    """
+    return the number of table slots needed to hold
+    capacity tags without exceeding MAX_LOAD_FACTOR
+    """
+    return int(capacity / MAX_LOAD_FACTOR) + 1
+
+
+@implementer(IBatchPacketReplayCache)
+class ReplayTagTable(object):
+    """
+    i am a fixed capacity replay cache. i keep my tags in a
+    writable buffer of 32 byte slots, starting at base, using
+    linear probing. the tags are uniformly distributed hashes
+    so the first 8 bytes of a tag are used directly as its hash.
+    slots are compared in place with find so lookups never copy.
+    """
+
+    def __init__(self, capacity, table=None, base=0):
+        self.capacity = capacity
+        self.slot_count = table_slot_count(capacity)
+        if table is None:
+            table = bytearray(base + self.slot_count * TAG_SIZE)
+        assert len(table) >= base + self.slot_count * TAG_SIZE
+        self._table = table
+        self._base = base
+        self._end = base + self.slot_count * TAG_SIZE
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _probe(self, tag):
+        """
+        return a 2-tuple of the offset of the slot holding tag,
+        or the empty slot where it belongs, and whether it was found
+        """
+        assert len(tag) == TAG_SIZE
+        table = self._table
+        offset = self._base + (struct.unpack_from("<Q", tag)[0] % self.slot_count) * TAG_SIZE
+        while True:
+            slot_end = offset + TAG_SIZE
+            if table.find(tag, offset, slot_end) == offset:
+                return offset, True
+            if table.find(EMPTY_SLOT, offset, slot_end) == offset:
+                return offset, False
+            offset = slot_end
+            if offset == self._end:
+                offset = self._base
+
+    def _insert(self, offset, tag):
+        if self.count >= self.capacity:
+            raise ReplayCacheFullError()
+        self._table[offset:offset + TAG_SIZE] = tag
+        self.count += 1
+
+    def tags(self):
+        """
+        yield every tag in the table
+        """
+        return self._slot_tags(self._base, self._end)
+
+    def _slot_tags(self, start, end):
+        for offset in range(start, end, TAG_SIZE):
+            if self._table.find(EMPTY_SLOT, offset, offset + TAG_SIZE) != offset:
+                yield bytes(self._table[offset:offset + TAG_SIZE])
+
+    def has_seen(self, tag):
+        return self._probe(tag)[1]
+
+    def set_seen(self, tag):
+        offset, found = self._probe(tag)
+        if not found:
+            self._insert(offset, tag)
+
+    def test_and_set(self, tags):
+        seen = []
+        for tag in tags:
+            offset, found = self._probe(tag)
+            if not found:
+                try:
+                    self._insert(offset, tag)
+                except ReplayCacheFullError:
+                    found = None
+            seen.append(found)
+        return seen
+
+    def flush(self):
+        chunk = 1 << 20
+        for offset in range(self._base, self._end, chunk):
+            end = min(offset + chunk, self._end)
+            self._table[offset:end] = b"\x00" * (end - offset)
+        self.count = 0
+
+
+@implementer(IBatchPacketReplayCache)
+class EpochReplayCache(object):
+    """
+    i am a replay cache partitioned by key epoch. each epoch has
+    its own ReplayTagTable of the given capacity. new tags are set
+    in the current epoch and all live epochs are checked for replays.
+    when a mix key is retired its epoch can be dropped all at once.
+    """
+
+    def __init__(self, capacity, epoch=0, max_epochs=2):
+        assert max_epochs >= 1
+        self.capacity = capacity
+        self.max_epochs = max_epochs
+        self._tables = collections.OrderedDict()
+        self.rotate(epoch)
+
+    @property
+    def epochs(self):
+        return list(self._tables.keys())
+
+    def epoch(self, epoch):
+        """
+        return the ReplayTagTable for the given epoch
+        """
+        return self._tables[epoch]
+
+    def new_table(self):
+        """
+        return an empty ReplayTagTable for rotate. its slots are
+        in an anonymous memory map, which the kernel zeroes a page
+        at a time as it is first written, so it costs nothing to make.
+        """
+        return ReplayTagTable(self.capacity, mmap.mmap(-1, table_slot_count(self.capacity) * TAG_SIZE))
+
+    def rotate(self, epoch, table=None):
+        """
+        start a new current epoch, with table if it is given, a
+        ReplayTagTable from new_table. the oldest epochs are dropped
+        to stay within max_epochs.
+        """
+        assert epoch not in self._tables
+        if table is None:
+            table = ReplayTagTable(self.capacity)
+        assert table.capacity == self.capacity and len(table) == 0
+        self._tables[epoch] = table
+        self.current_epoch = epoch
+        self._current = self._tables[epoch]
+        while len(self._tables) > self.max_epochs:
+            self._tables.popitem(last=False)
+
+    def drop_epoch(self, epoch):
+        """
+        forget every tag of the given epoch
+        """
+        assert epoch != self.current_epoch
+        del self._tables[epoch]
+
+    def has_seen(self, tag):
+        for table in self._tables.values():
+            if table.has_seen(tag):
+                return True
+        return False
+
+    def set_seen(self, tag):
+        self._current.set_seen(tag)
+
+    def test_and_set(self, tags):
+        if len(self._tables) == 1:
+            return self._current.test_and_set(tags)
+        seen = []
+        for tag in tags:
+            if self.has_seen(tag):
+                seen.append(True)
+                continue
+            try:
+                self._current.set_seen(tag)
+            except ReplayCacheFullError:
+                seen.append(None)
+            else:
+                seen.append(False)
+        return seen
+
+    def flush(self):
+        for table in self._tables.values():
+            table.flush()
+
+
+# the replay cache file starts with a fixed size header
+# followed by the slots of a ReplayTagTable
+MMAP_MAGIC = b"TXMIXRC1"
+MMAP_HEADER = struct.Struct("<8sQQ")  # magic, capacity, count
+MMAP_HEADER_SIZE = 64
+MMAP_COUNT_OFFSET = 16
+
+
+def _create_replay_cache_file(path, capacity):
+    """
+    create a new empty replay cache file. it is sparse until
+    slots are written so even very large files are created instantly.
+    """
+    size = MMAP_HEADER_SIZE + table_slot_count(capacity) * TAG_SIZE
+    with open(path, "wb") as f:
+        f.write(MMAP_HEADER.pack(MMAP_MAGIC, capacity, 0))
+        f.truncate(size)
+
+
+@implementer(IBatchPacketReplayCache)
+class MmapReplayCache(ReplayTagTable):
+    """
+    i am a replay cache kept in a memory mapped file so that a mix
+    can restart without losing its replay state or rotating keys.
+    the file is the hash table itself: loading it only maps it, no
+    matter how many tags it holds. slots are only ever written once,
+    from empty to a tag, so a crash can at worst lose the most recent
+    tags that the kernel had not yet written back. capacity is only
+    used when the file is created.
+
+    when i hold high_water of my capacity and max_capacity allows it,
+    i compact my tags into a new file twice as large, which then
+    replaces the old one. the copy is made compact_batch slots per
+    reactor turn so that it never pauses the reactor for long. tags
+    set meanwhile go into both files, or only into the new one once
+    the old one is full, and both are checked for replays.
+    """
+
+    def __init__(self, path, capacity, max_capacity=None, reactor=None, high_water=0.75, compact_batch=4096):
+        assert 0 < high_water <= 1 and compact_batch > 0
+        self.path = path
+        self.max_capacity = capacity if max_capacity is None else max_capacity
+        self.reactor = default_reactor if reactor is None else reactor
+        self.high_water = high_water
+        self.compact_batch = compact_batch
+        self._compacting = None
+        self._compact_call = None
+        if not os.path.exists(path):
+            _create_replay_cache_file(path, capacity)
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "r+b")
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        if len(self._mmap) < MMAP_HEADER_SIZE:
+            raise ReplayCacheFileError("%s is too short" % self.path)
+        magic, capacity, count = MMAP_HEADER.unpack_from(self._mmap)
+        if magic != MMAP_MAGIC:
+            raise ReplayCacheFileError("%s is not a replay cache file" % self.path)
+        ReplayTagTable.__init__(self, capacity, table=self._mmap, base=MMAP_HEADER_SIZE)
+        self.count = count
+
+    @property
+    def compacting(self):
+        """
+        whether a compaction is in progress
+        """
+        return self._compacting is not None
+
+    def _probe(self, tag):
+        offset, found = ReplayTagTable._probe(self, tag)
+        if not found and self._compacting is not None and self._compacting.has_seen(tag):
+            found = True
+        return offset, found
+
+    def _insert(self, offset, tag):
+        if self._compacting is not None:
+            self._compacting.set_seen(tag)
+            if self.count >= self.capacity:
+                return
+        ReplayTagTable._insert(self, offset, tag)
+        struct.pack_into("<Q", self._mmap, MMAP_COUNT_OFFSET, self.count)
+        if self._compacting is None and self.capacity < self.max_capacity:
+            if self.count >= self.high_water * self.capacity:
+                self._start_compaction(min(self.capacity * 2, self.max_capacity))
+
+    def flush(self):
+        self._discard_compaction()
+        ReplayTagTable.flush(self)
+        struct.pack_into("<Q", self._mmap, MMAP_COUNT_OFFSET, 0)
+
+    def _start_compaction(self, capacity):
+        new_path = self.path + ".compact"
+        if os.path.exists(new_path):
+            os.remove(new_path)
+        self._compacting = MmapReplayCache(new_path, capacity)
+        self._compact_offset = self._base
+        self._compact_call = self.reactor.callLater(0, self._compact_step)
+
+    def _compact_step(self):
+        self._compact_call = None
+        end = min(self._compact_offset + self.compact_batch * TAG_SIZE, self._end)
+        self._compacting.test_and_set(self._slot_tags(self._compact_offset, end))
+        self._compact_offset = end
+        if end < self._end:
+            self._compact_call = self.reactor.callLater(0, self._compact_step)
+        else:
+            self._finish_compaction()
+
+    def _finish_compaction(self):
+        """
+        copy the tags not yet copied and replace my file with the new one
+        """
+        if self._compact_call is not None:
+            self._compact_call.cancel()
+            self._compact_call = None
+        new_table, self._compacting = self._compacting, None
+        new_table.test_and_set(self._slot_tags(self._compact_offset, self._end))
+        new_table.close()
+        self.close()
+        os.rename(new_table.path, self.path)
+        self._open()
+
+    def _discard_compaction(self):
+        if self._compacting is None:
+            return
+        if self._compact_call is not None:
+            self._compact_call.cancel()
+            self._compact_call = None
+        new_table, self._compacting = self._compacting, None
+        new_table.close()
+        os.remove(new_table.path)
+
+    def compact(self, capacity=None):
+        """
+        rewrite my tags into a new file with the given capacity
+        and atomically replace my file with it, all at once.
+        a compaction in progress is finished first.
+        """
+        if self._compacting is not None:
+            self._finish_compaction()
+        if capacity is None:
+            capacity = self.capacity
+        assert capacity >= self.count
+        self._start_compaction(capacity)
+        self._finish_compaction()
+
+    def sync(self):
+        """
+        write dirty pages back to the file
+        """
+        self._mmap.flush()
+
+    def close(self):
+        if self._compacting is not None:
+            self._finish_compaction()
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.close()
+
+
+@implementer(IBatchPacketReplayCache)
+class SharedMmapReplayCache(MmapReplayCache):
+    """
+    i am an MmapReplayCache which several processes can use at once,
+    such as the workers of a sharded mix node. every operation holds
+    an exclusive lock on the file and reloads the tag count from it.
+    set_seen raises ReplayError if another process has set the tag
+    since it was checked with has_seen, so that concurrent unwraps of
+    the same packet in different processes cannot both succeed.
+    i am never compacted because the other processes would keep
+    using the old file.
+    """
+
+    def __init__(self, path, capacity):
+        MmapReplayCache.__init__(self, path, capacity)
+
+    def _locked(self, func, *args):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            self.count = struct.unpack_from("<Q", self._mmap, MMAP_COUNT_OFFSET)[0]
+            return func(*args)
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def __len__(self):
+        return self._locked(lambda: self.count)
+
+    def _set_seen(self, tag):
+        offset, found = self._probe(tag)
+        if found:
+            raise ReplayError()
+        self._insert(offset, tag)
+
+    def has_seen(self, tag):
+        return self._locked(MmapReplayCache.has_seen, self, tag)
+
+    def set_seen(self, tag):
+        self._locked(self._set_seen, tag)
+
+    def test_and_set(self, tags):
+        return self._locked(MmapReplayCache.test_and_set, self, tags)
+
+    def flush(self):
+        self._locked(MmapReplayCache.flush, self)
+
+    def compact(self, capacity=None):
+        raise NotImplementedError("a shared replay cache can not be compacted")
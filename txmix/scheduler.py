@@ -0,0 +1,164 @@
+"""
+schedulers which hold many delayed messages with few reactor timers
+"""
+
+import math
+import heapq
+
+from eliot import start_action
+
+
+class TimerWheel(object):
+    """
+    i am a hashed timer wheel. i hold scheduled items in slot_count
+    slots of tick seconds each and use one reactor timer, which fires
+    once per tick while anything is pending, to pass every item due in
+    that tick to my release_handler as one list. a delay is rounded up
+    to the next tick so items are never released early. when every
+    delay is less than slot_count ticks each slot only ever holds
+    items due at the same tick.
+    """
+
+    def __init__(self, reactor, tick, slot_count, release_handler):
+        assert tick > 0 and slot_count > 0
+        self.reactor = reactor
+        self.tick = tick
+        self.slot_count = slot_count
+        self.release_handler = release_handler
+        self._slots = [[] for _ in range(slot_count)]
+        self._pending = 0
+        self._call = None
+        self._last_tick = self._current_tick()
+
+    def __len__(self):
+        return self._pending
+
+    def _current_tick(self):
+        return int(math.floor(self.reactor.seconds() / self.tick))
+
+    def schedule(self, delay, item):
+        """
+        release item after at least delay seconds
+        """
+        if self._pending == 0:
+            self._last_tick = self._current_tick()
+        due_tick = int(math.ceil((self.reactor.seconds() + delay) / self.tick))
+        if due_tick <= self._last_tick:
+            due_tick = self._last_tick + 1
+        self._slots[due_tick % self.slot_count].append((due_tick, item))
+        self._pending += 1
+        if self._call is None:
+            self._call = self.reactor.callLater(self._next_tick_delay(), self._advance)
+
+    def _next_tick_delay(self):
+        return max(0, (self._last_tick + 1) * self.tick - self.reactor.seconds())
+
+    def _advance(self):
+        """
+        release the items of every tick which has passed
+        since i last advanced
+        """
+        self._call = None
+        now_tick = self._current_tick()
+        released = []
+        # after a long stall every slot is visited only once
+        first_tick = max(self._last_tick + 1, now_tick - self.slot_count + 1)
+        for tick in range(first_tick, now_tick + 1):
+            index = tick % self.slot_count
+            slot = self._slots[index]
+            if not slot:
+                continue
+            remaining = [x for x in slot if x[0] > now_tick]
+            if len(remaining) == len(slot):
+                continue
+            released.extend(item for due_tick, item in slot if due_tick <= now_tick)
+            self._slots[index] = remaining
+        self._last_tick = max(self._last_tick, now_tick)
+        self._pending -= len(released)
+        if self._pending > 0:
+            self._call = self.reactor.callLater(self._next_tick_delay(), self._advance)
+        if released:
+            action = start_action(
+                action_type=u"timer wheel release",
+                count=len(released),
+            )
+            with action:
+                self.release_handler(released)
+
+    def stop(self):
+        """
+        cancel my reactor timer and return every pending item
+        """
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        pending = [item for slot in self._slots for _, item in slot]
+        self._slots = [[] for _ in range(self.slot_count)]
+        self._pending = 0
+        return pending
+
+
+class HeapScheduler(object):
+    """
+    i hold scheduled items in one min-heap ordered by release time
+    and keep a single reactor timer set for the earliest of them.
+    when it fires every item whose release time has passed is passed
+    to my release_handler as one list, so i never fall behind the
+    clock however many items come due at once.
+    """
+
+    def __init__(self, reactor, release_handler):
+        self.reactor = reactor
+        self.release_handler = release_handler
+        self._heap = []
+        self._sequence = 0
+        self._call = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, delay, item):
+        """
+        release item after delay seconds
+        """
+        release_time = self.reactor.seconds() + delay
+        # the sequence number keeps items from ever being compared
+        heapq.heappush(self._heap, (release_time, self._sequence, item))
+        self._sequence += 1
+        if self._heap[0][1] == self._sequence - 1:
+            self._reschedule()
+
+    def _reschedule(self):
+        delay = max(0, self._heap[0][0] - self.reactor.seconds())
+        if self._call is None:
+            self._call = self.reactor.callLater(delay, self._release)
+        else:
+            self._call.reset(delay)
+
+    def _release(self):
+        self._call = None
+        now = self.reactor.seconds()
+        heap = self._heap
+        released = []
+        while heap and heap[0][0] <= now:
+            released.append(heapq.heappop(heap)[2])
+        if heap:
+            self._reschedule()
+        if released:
+            action = start_action(
+                action_type=u"heap scheduler release",
+                count=len(released),
+            )
+            with action:
+                self.release_handler(released)
+
+    def stop(self):
+        """
+        cancel my reactor timer and return every pending item
+        """
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        pending = [item for _, _, item in sorted(self._heap)]
+        self._heap = []
+        return pending
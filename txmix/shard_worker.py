@@ -0,0 +1,92 @@
+"""
+I am the entry point of a shard worker process started by
+ShardedMixSupervisor. I read my configuration as a line of json
+from stdin, unwrap the packets sent to the node's address and
+write the unwrapped messages to stdout as length prefixed frames.
+Every later line of json on stdin gives me the node's new live keys.
+I exit when my stdin is closed.
+"""
+
+import json
+
+from twisted.internet import reactor, stdio
+from twisted.protocols.basic import LineOnlyReceiver
+
+from sphinxmixcrypto import ReplayError
+
+from txmix.mix import MixProtocol, PACKET_ERRORS
+from txmix.replay_cache import ReplayCacheFullError
+from txmix.sharding import load_worker_config, unwrapped_message_parts, frame_parts, encode_frame, READY_FRAME
+from txmix.udp_transport import UDPTransport
+from txmix.utils import DummyPKI
+
+
+class SupervisorProtocol(LineOnlyReceiver):
+    """
+    i am the worker's end of the pipe to the supervisor. the first
+    line i receive is passed to config_received, which returns the
+    worker's key state, and the following ones update its keys.
+    """
+    delimiter = b"\n"
+
+    def __init__(self, config_received):
+        self.config_received = config_received
+        self.key_state = None
+
+    def lineReceived(self, line):
+        if self.key_state is None:
+            self.key_state = self.config_received(line)
+        else:
+            self.key_state.update(json.loads(line))
+
+    def send_messages(self, unwrapped_messages):
+        sequence = []
+        for unwrapped_message in unwrapped_messages:
+            sequence.extend(frame_parts(unwrapped_message_parts(unwrapped_message)))
+        self.transport.writeSequence(sequence)
+
+    def connectionLost(self, reason):
+        if reactor.running:
+            reactor.stop()
+
+
+class WorkerMixProtocol(MixProtocol):
+    """
+    i drop packets which fail to unwrap instead of raising
+    into the transport
+    """
+
+    def received(self, raw_sphinx_packet):
+        try:
+            return MixProtocol.received(self, raw_sphinx_packet)
+        except PACKET_ERRORS + (ReplayError, ReplayCacheFullError):
+            pass
+
+
+def start_worker(supervisor, config):
+    """
+    start unwrapping packets as described by a worker_config,
+    returns the worker's key state
+    """
+    config = load_worker_config(config)
+    protocol = WorkerMixProtocol(config["replay_cache"],
+                                 config["key_state"],
+                                 config["params"],
+                                 DummyPKI(),
+                                 packet_received_handler=lambda x: supervisor.send_messages([x]),
+                                 batch_received_handler=lambda x: supervisor.send_messages(x))
+    transport = UDPTransport(reactor, config["addr"], batch_io=config["batch_io"], reuse_port=True)
+    d = protocol.make_connection(transport)
+    d.addCallback(lambda _: supervisor.transport.write(encode_frame(READY_FRAME)))
+    d.addErrback(lambda failure: supervisor.transport.loseConnection())
+    return config["key_state"]
+
+
+def main():
+    supervisor = SupervisorProtocol(lambda config: start_worker(supervisor, config))
+    stdio.StandardIO(supervisor)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""
+I run one mix node across several processes.
+
+Every process binds the node's UDP address with SO_REUSEPORT so
+that the kernel spreads incoming packets across them. The processes
+share one SharedMmapReplayCache file, which detects replays no matter
+which process a packet arrives at. Only the supervisor process batches
+and sends messages. The workers unwrap packets and pass the unwrapped
+messages to the supervisor over a pipe. The supervisor feeds them into
+its node together with the packets it unwrapped itself. This keeps the
+threshold and delay semantics of the node as a whole the same as
+those of a single process node.
+
+A worker is given the node's live keys in its configuration. If the
+node's keys are rotated, with an EpochKeyState, the supervisor writes
+the new live keys to every worker's stdin as another line of json.
+"""
+
+import os
+import sys
+import json
+import struct
+import binascii
+
+import attr
+from eliot import start_action, Message
+from eliot.twisted import DeferredContext
+from zope.interface import implementer
+
+from twisted.internet.interfaces import IReactorProcess
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet import defer, reactor
+
+from sphinxmixcrypto import UnwrappedMessage, SphinxPacket, SphinxBody, SphinxParams
+
+from txmix.framing import sphinx_packet_parts, client_packet_parts
+from txmix.interfaces import IEpochKeyState
+from txmix.key_rotation import EpochKeyState
+from txmix.replay_cache import SharedMmapReplayCache
+from txmix.unwrap import live_keys
+from txmix.utils import MixKeyState
+
+
+FRAME_LENGTH = struct.Struct("!I")
+READY_FRAME = b"r"
+NEXT_HOP_FRAME = b"n"
+CLIENT_HOP_FRAME = b"c"
+
+
+def unwrapped_message_parts(unwrapped_message):
+    """
+    encode an UnwrappedMessage with a next hop or client hop
+    as a frame given as a list of byte strings
+    """
+    if unwrapped_message.next_hop:
+        destination, sphinx_packet = unwrapped_message.next_hop
+        return [NEXT_HOP_FRAME, destination] + sphinx_packet_parts(sphinx_packet)
+    if unwrapped_message.client_hop:
+        client_id, message_id, client_message = unwrapped_message.client_hop
+        return [CLIENT_HOP_FRAME, struct.pack("B", len(client_id)), client_id] + \
+            client_packet_parts(message_id, client_message)
+    raise ValueError("only next hop and client hop messages can be encoded")
+
+
+def encode_unwrapped_message(unwrapped_message):
+    """
+    encode an UnwrappedMessage with a next hop or client hop as a frame
+    """
+    return b"".join(unwrapped_message_parts(unwrapped_message))
+
+
+def decode_unwrapped_message(params, frame):
+    """
+    decode a frame made by encode_unwrapped_message
+    """
+    kind, body = frame[:1], frame[1:]
+    if kind == NEXT_HOP_FRAME:
+        destination, raw_sphinx_packet = body[:16], body[16:]
+        sphinx_packet = SphinxPacket.from_raw_bytes(params, raw_sphinx_packet)
+        return UnwrappedMessage(next_hop=(destination, sphinx_packet), exit_hop=None, client_hop=None)
+    if kind == CLIENT_HOP_FRAME:
+        client_id_len = struct.unpack_from("B", body)[0]
+        client_id = body[1:1 + client_id_len]
+        message_id = body[1 + client_id_len:17 + client_id_len]
+        delta = body[17 + client_id_len:]
+        return UnwrappedMessage(client_hop=(client_id, message_id, SphinxBody(delta)), exit_hop=None, next_hop=None)
+    raise ValueError("unknown frame type %r" % (kind,))
+
+
+def encode_frame(frame):
+    return FRAME_LENGTH.pack(len(frame)) + frame
+
+
+def frame_parts(parts):
+    """
+    return the byte strings of a length prefixed frame
+    of the byte strings in parts
+    """
+    return [FRAME_LENGTH.pack(sum(len(part) for part in parts))] + parts
+
+
+def worker_keys(key_state):
+    """
+    return a dict of the epoch and live keys of key_state
+    as a shard worker is given them
+    """
+    return {
+        "epoch": getattr(key_state, "epoch", 0),
+        "keys": [[binascii.hexlify(key.get_public_key()).decode("ascii"),
+                  binascii.hexlify(key.get_private_key()).decode("ascii")] for key in live_keys(key_state)],
+    }
+
+
+@implementer(IEpochKeyState)
+class WorkerKeyState(object):
+    """
+    i am a shard worker's copy of the live keys of its node,
+    updated by the supervisor whenever they change
+    """
+
+    def __init__(self, keys):
+        self.update(keys)
+
+    def update(self, keys):
+        """
+        replace my keys with those of a worker_keys dict
+        """
+        self.epoch = keys["epoch"]
+        self._live_keys = tuple(MixKeyState(binascii.unhexlify(public_key), binascii.unhexlify(private_key))
+                                for public_key, private_key in keys["keys"])
+
+    def get_public_key(self):
+        return self._live_keys[0].get_public_key()
+
+    def get_private_key(self):
+        return self._live_keys[0].get_private_key()
+
+    def live_keys(self):
+        return self._live_keys
+
+
+def worker_config(node, batch_io=False):
+    """
+    return the json configuration a shard worker of node needs.
+    the configuration contains the node's private keys so it is
+    only ever written to the worker's stdin.
+    """
+    config = {
+        "addr": list(node.transport.addr),
+        "max_hops": node.params.max_hops,
+        "payload_size": node.params.payload_size,
+        "replay_cache_path": node.replay_cache.path,
+        "replay_cache_capacity": node.replay_cache.capacity,
+        "batch_io": batch_io,
+    }
+    config.update(worker_keys(node.key_state))
+    return json.dumps(config)
+
+
+def load_worker_config(config):
+    """
+    return a dict of the objects described by a worker_config
+    """
+    config = json.loads(config)
+    return {
+        "addr": (str(config["addr"][0]), config["addr"][1]),
+        "params": SphinxParams(config["max_hops"], config["payload_size"]),
+        "key_state": WorkerKeyState(config),
+        "replay_cache": SharedMmapReplayCache(config["replay_cache_path"], config["replay_cache_capacity"]),
+        "batch_io": config["batch_io"],
+    }
+
+
+class ShardWorkerProcessProtocol(ProcessProtocol):
+    """
+    i am the supervisor's end of the pipe to one shard worker.
+    i write the worker's configuration to its stdin and pass
+    the messages it unwraps to the supervisor.
+    """
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.ready = defer.Deferred()
+        self.ended = defer.Deferred()
+        self._buffer = b""
+
+    def connectionMade(self):
+        config = worker_config(self.supervisor.node, self.supervisor.batch_io)
+        self.transport.write(config.encode("ascii") + b"\n")
+
+    def send_keys(self, key_state):
+        """
+        give the worker the live keys of key_state
+        """
+        self.transport.write(json.dumps(worker_keys(key_state)).encode("ascii") + b"\n")
+
+    def outReceived(self, data):
+        buf = self._buffer + data if self._buffer else data
+        offset = 0
+        frames = []
+        while len(buf) - offset >= FRAME_LENGTH.size:
+            length = FRAME_LENGTH.unpack_from(buf, offset)[0]
+            end = offset + FRAME_LENGTH.size + length
+            if len(buf) < end:
+                break
+            frames.append(buf[offset + FRAME_LENGTH.size:end])
+            offset = end
+        self._buffer = buf[offset:]
+        messages = []
+        for frame in frames:
+            if frame == READY_FRAME:
+                if not self.ready.called:
+                    self.ready.callback(self)
+            else:
+                messages.append(decode_unwrapped_message(self.supervisor.node.params, frame))
+        if messages:
+            self.supervisor.worker_messages_received(self.index, messages)
+
+    def processEnded(self, reason):
+        if not self.ready.called:
+            self.ready.errback(reason)
+        self.ended.callback(None)
+        self.supervisor.worker_ended(self.index, reason)
+
+
+@attr.s
+class ShardedMixSupervisor(object):
+    """
+    i run a mix node and worker_count worker processes which share
+    its UDP address and replay cache. the node must use a UDPTransport
+    with reuse_port set and a SharedMmapReplayCache. the node batches
+    and sends the messages unwrapped by every process. workers which
+    exit while i am running are restarted after restart_delay seconds,
+    doubled for every restart of a worker which exits again before it
+    is listening, up to max_restart_delay. the node's key state must
+    be an EpochKeyState if its keys are rotated, so that i can pass
+    the new keys on to the workers.
+    """
+
+    node = attr.ib()
+    worker_count = attr.ib(validator=attr.validators.instance_of(int))
+    reactor = attr.ib(validator=attr.validators.provides(IReactorProcess), default=reactor)
+    batch_io = attr.ib(validator=attr.validators.instance_of(bool), default=False)
+    restart_delay = attr.ib(default=0.1)
+    max_restart_delay = attr.ib(default=30)
+
+    def start(self):
+        """
+        start the node and its workers. returns a deferred which
+        fires once every worker is listening.
+        """
+        assert isinstance(self.node.replay_cache, SharedMmapReplayCache)
+        assert getattr(self.node.transport, "reuse_port", False)
+        key_state = self.node.key_state
+        assert isinstance(key_state, EpochKeyState) or not IEpochKeyState.providedBy(key_state)
+        if isinstance(key_state, EpochKeyState):
+            key_state.add_observer(self._keys_changed)
+        self._running = True
+        self.workers = {}
+        self.messages_from_workers = 0
+        self._restart_delays = {}
+        self._restart_calls = {}
+        action = start_action(
+            action_type=u"start sharded mix",
+            worker_count=self.worker_count,
+        )
+        with action.context():
+            d = self.node.start()
+
+            def _spawn(_):
+                return defer.gatherResults([self._spawn_worker(i) for i in range(self.worker_count)],
+                                           consumeErrors=True)
+            d.addCallback(_spawn)
+            d.addCallback(lambda _: None)
+            return DeferredContext(d).addActionFinish()
+
+    def _spawn_worker(self, index):
+        process_protocol = ShardWorkerProcessProtocol(self, index)
+        self.workers[index] = process_protocol
+        self.reactor.spawnProcess(process_protocol,
+                                  sys.executable,
+                                  [sys.executable, "-m", "txmix.shard_worker"],
+                                  env=os.environ,
+                                  childFDs={0: "w", 1: "r", 2: 2})
+
+        def _ready(result):
+            self._restart_delays.pop(index, None)
+            return result
+        process_protocol.ready.addCallback(_ready)
+        return process_protocol.ready
+
+    def _restart_worker(self, index):
+        del self._restart_calls[index]
+        # the worker's failure to start is logged when it ends
+        self._spawn_worker(index).addErrback(lambda failure: None)
+
+    def _keys_changed(self, key_state):
+        for process_protocol in self.workers.values():
+            if process_protocol.transport is not None and process_protocol.transport.pid is not None:
+                process_protocol.send_keys(key_state)
+
+    def worker_messages_received(self, index, unwrapped_messages):
+        """
+        i am called with the messages unwrapped by a worker
+        """
+        self.messages_from_workers += len(unwrapped_messages)
+        self.node.messages_received(unwrapped_messages)
+
+    def worker_ended(self, index, reason):
+        Message.log(message_type=u"shard worker ended", index=index, reason=str(reason.value))
+        if self._running:
+            delay = self._restart_delays.get(index, self.restart_delay)
+            self._restart_delays[index] = min(delay * 2, self.max_restart_delay)
+            self._restart_calls[index] = self.reactor.callLater(delay, self._restart_worker, index)
+
+    def stop(self):
+        """
+        stop the workers. returns a deferred which fires once they have exited.
+        """
+        self._running = False
+        if isinstance(self.node.key_state, EpochKeyState):
+            self.node.key_state.remove_observer(self._keys_changed)
+        for call in self._restart_calls.values():
+            call.cancel()
+        self._restart_calls = {}
+        dl = []
+        for process_protocol in self.workers.values():
+            dl.append(process_protocol.ended)
+            if process_protocol.transport is not None and process_protocol.transport.pid is not None:
+                process_protocol.transport.closeStdin()
+        return defer.DeferredList(dl)
@@ -0,0 +1,165 @@
+"""
+an in-memory network for simulating mix networks in one process
+
+A SimulatedNetwork connects SimulatedTransports, which are ordinary
+IMixTransports, so mix nodes and clients run on it unchanged. It is
+driven by a twisted.internet.task.Clock shared with the nodes, and
+run_until advances that clock straight from one event to the next,
+so hours of traffic take only as long as the packets take to unwrap.
+
+Every datagram crosses a Link with a latency, optional jitter, an
+optional bandwidth, which queues the datagrams sent over it one after
+another, and a loss rate. Deliveries are held in one HeapScheduler so
+that the network uses a single reactor timer however many datagrams
+are in flight.
+"""
+
+import attr
+import random
+
+from zope.interface import implementer
+from twisted.internet import defer
+
+from eliot import start_action
+
+from txmix.interfaces import IMixTransport
+from txmix.scheduler import HeapScheduler
+
+
+@attr.s(frozen=True)
+class Link(object):
+    """
+    i describe one direction of a link: its latency and the maximum
+    jitter added to it in seconds, its bandwidth in bytes per second,
+    or None if it is unlimited, and the probability that a datagram
+    is lost
+    """
+    latency = attr.ib(default=0.0)
+    jitter = attr.ib(default=0.0)
+    bandwidth = attr.ib(default=None)
+    loss = attr.ib(default=0.0)
+
+
+@implementer(IMixTransport)
+class SimulatedTransport(object):
+    """
+    i am a transport on a SimulatedNetwork. like a udp transport i
+    don't tell the sender whether a datagram arrives.
+    """
+    name = "simulated"
+
+    def __init__(self, network, addr):
+        self.network = network
+        self.addr = addr
+        self.protocol = None
+
+    def register_protocol(self, protocol):
+        self.protocol = protocol
+
+    def start(self):
+        return defer.succeed(None)
+
+    def send(self, addr, message):
+        self.network.send(self.addr, addr, message)
+        return defer.succeed(None)
+
+
+class SimulatedNetwork(object):
+    """
+    i carry datagrams between SimulatedTransports over Links. the
+    link between two addresses is the one given to set_link for
+    them, or default_link. a datagram arriving at a protocol which
+    raises is counted as failed, like a datagram a real node drops.
+    """
+
+    def __init__(self, clock, default_link=Link(), seed=None):
+        self.clock = clock
+        self.default_link = default_link
+        self.rand = random.Random(seed)
+        self.transports = {}
+        self._links = {}
+        self._busy_until = {}  # (source, destination) -> time its bandwidth is free
+        self._deliveries = HeapScheduler(clock, self._deliver)
+        self.sent = 0
+        self.lost = 0
+        self.unrouted = 0
+        self.delivered = 0
+        self.failed = 0
+        self.bytes_sent = 0
+
+    def transport(self, addr):
+        """
+        return a new SimulatedTransport for addr
+        """
+        assert addr not in self.transports
+        transport = SimulatedTransport(self, addr)
+        self.transports[addr] = transport
+        return transport
+
+    def set_link(self, source, destination, link):
+        self._links[(source, destination)] = link
+
+    def link(self, source, destination):
+        return self._links.get((source, destination), self.default_link)
+
+    @property
+    def in_flight(self):
+        return len(self._deliveries)
+
+    def send(self, source, destination, message):
+        self.sent += 1
+        self.bytes_sent += len(message)
+        link = self.link(source, destination)
+        if link.loss and self.rand.random() < link.loss:
+            self.lost += 1
+            return
+        now = self.clock.seconds()
+        departure = now
+        if link.bandwidth is not None:
+            key = (source, destination)
+            departure = max(now, self._busy_until.get(key, now)) + float(len(message)) / link.bandwidth
+            self._busy_until[key] = departure
+        delay = departure - now + link.latency
+        if link.jitter:
+            delay += self.rand.uniform(0, link.jitter)
+        self._deliveries.schedule(delay, (destination, message))
+
+    def _deliver(self, deliveries):
+        for destination, message in deliveries:
+            transport = self.transports.get(destination)
+            if transport is None or transport.protocol is None:
+                self.unrouted += 1
+                continue
+            try:
+                transport.protocol.received(message)
+            except Exception:
+                self.failed += 1
+            else:
+                self.delivered += 1
+
+    def run_until(self, end_time):
+        """
+        advance my clock from each scheduled call to the next until
+        none are left or the next is after end_time, then to end_time
+        if it is later. returns the number of steps taken.
+        """
+        action = start_action(
+            action_type=u"simulated network run",
+            end_time=end_time,
+        )
+        with action:
+            steps = 0
+            while True:
+                # a reset call is out of order until the clock next advances
+                pending = self.clock.getDelayedCalls()
+                if not pending:
+                    break
+                next_time = min(call.getTime() for call in pending)
+                if next_time > end_time:
+                    break
+                self.clock.advance(max(0, next_time - self.clock.seconds()))
+                steps += 1
+            if end_time > self.clock.seconds():
+                self.clock.advance(end_time - self.clock.seconds())
+            action.addSuccessFields(steps=steps)
+            return steps
@@ -1,24 +1,73 @@
-
 from __future__ import print_function
 
+import errno
+import socket
+
 import attr
 from zope.interface import implementer
 from twisted.internet.interfaces import IReactorUDP
 from twisted.internet.protocol import DatagramProtocol
-from twisted.internet import defer
+from twisted.internet import defer, error, udp
+
+from txmix import IGatherTransport
+from txmix.mmsg import MmsgPort
+from txmix.metrics import transport_metrics
+
+
+DATAGRAMS_RECEIVED, DATAGRAMS_SENT, SEND_FAILURES = transport_metrics("udp")
+
+
+def _set_reuse_port(skt):
+    skt.setsockopt(socket.SOL_SOCKET, getattr(socket, "SO_REUSEPORT", 15), 1)
+    return skt
+
+
+class ReusePortUDPPort(udp.Port):
+    """
+    i am a twisted UDP port whose socket sets SO_REUSEPORT
+    so that several processes can bind the same address
+    """
+
+    def createInternetSocket(self):
+        return _set_reuse_port(udp.Port.createInternetSocket(self))
+
 
-from txmix import IMixTransport
+class ReusePortMmsgPort(MmsgPort):
+    """
+    i am an MmsgPort whose socket sets SO_REUSEPORT
+    """
 
+    def createInternetSocket(self):
+        return _set_reuse_port(MmsgPort.createInternetSocket(self))
 
-@implementer(IMixTransport)
+
+@implementer(IGatherTransport)
 @attr.s()
 class UDPTransport(DatagramProtocol, object):
     """
     implements the IMixTransport interface
+
+    with batch_io set I use recvmmsg and sendmmsg on linux to read
+    every waiting datagram with one system call, handing them to my
+    protocol's received_batch method, and to send all the datagrams
+    of a reactor turn with one system call.
+
+    with reuse_port set my socket uses SO_REUSEPORT so that the
+    kernel spreads the datagrams sent to my addr across every
+    process listening on it.
+
+    datagrams given to send_parts as several byte strings are
+    gathered by the kernel, with sendmmsg or sendmsg, instead of
+    being joined, unless neither is available. sockets only have
+    sendmsg on python 3, so on python 2 they are gathered only
+    with batch_io set.
     """
     name = "udp"
     reactor = attr.ib(validator=attr.validators.provides(IReactorUDP))
     addr = attr.ib(validator=attr.validators.instance_of(tuple))
+    batch_io = attr.ib(validator=attr.validators.instance_of(bool), default=False)
+    batch_size = attr.ib(validator=attr.validators.instance_of(int), default=64)
+    reuse_port = attr.ib(validator=attr.validators.instance_of(bool), default=False)
 
     def register_protocol(self, protocol):
         # XXX todo: assert that protocol provides the appropriate interface
@@ -30,7 +79,15 @@ class UDPTransport(DatagramProtocol, object):
         interface must be an IP address
         """
         interface, port = self.addr
-        self.reactor.listenUDP(port, self, interface=interface)
+        if self.batch_io:
+            port_class = ReusePortMmsgPort if self.reuse_port else MmsgPort
+            self.port = port_class(port, self, interface, reactor=self.reactor, batch_size=self.batch_size)
+            self.port.startListening()
+        elif self.reuse_port:
+            self.port = ReusePortUDPPort(port, self, interface, reactor=self.reactor)
+            self.port.startListening()
+        else:
+            self.port = self.reactor.listenUDP(port, self, interface=interface)
         return defer.succeed(None)
 
     def send(self, addr, message):
@@ -38,11 +95,57 @@ class UDPTransport(DatagramProtocol, object):
         send message to addr
         where addr is a 2-tuple of type: (ip address, UDP port)
         """
-        self.transport.write(message, addr)
+        return self.send_parts(addr, [message])
+
+    def send_parts(self, addr, parts):
+        """
+        send the byte strings in parts as one datagram to addr
+        """
+        if self.batch_io:
+            self.port.write_batched(parts, addr)
+        else:
+            try:
+                self._write_parts(parts, addr)
+            except socket.error:
+                SEND_FAILURES.inc()
+                return defer.fail()
+        DATAGRAMS_SENT.inc()
         return defer.succeed(None)
 
+    def _write_parts(self, parts, addr):
+        if len(parts) == 1:
+            return self.transport.write(parts[0], addr)
+        sendmsg = getattr(self.port.socket, "sendmsg", None)
+        if sendmsg is None:
+            return self.transport.write(b"".join(parts), addr)
+        # errors are handled as udp.Port.write handles them
+        while True:
+            try:
+                return sendmsg(parts, (), 0, addr)
+            except socket.error as se:
+                if se.args[0] == errno.EINTR:
+                    continue
+                if se.args[0] == errno.EMSGSIZE:
+                    raise error.MessageLengthError("message too long")
+                if se.args[0] == errno.ECONNREFUSED:
+                    return
+                raise
+
     def datagramReceived(self, datagram, addr):
         """
         i am called by the twisted reactor when our transport receives a UDP packet
         """
+        DATAGRAMS_RECEIVED.inc()
         self.protocol.received(datagram)
+
+    def datagramsReceived(self, datagrams):
+        """
+        i am called by MmsgPort with a list of (datagram, addr) 2-tuples
+        """
+        DATAGRAMS_RECEIVED.inc(len(datagrams))
+        received_batch = getattr(self.protocol, "received_batch", None)
+        if received_batch is not None:
+            received_batch([datagram for datagram, _ in datagrams])
+        else:
+            for datagram, _ in datagrams:
+                self.protocol.received(datagram)
@@ -0,0 +1,227 @@
+"""
+I unwrap sphinx packets off of the reactor thread.
+
+The replay cache is never touched by the workers; instead each
+unwrap reports the packet's replay tag and the caller checks and
+sets it on the reactor thread. This keeps replay detection
+consistent no matter how many packets are in flight.
+
+A packet whose result never comes back, because its worker died or
+its result could not be sent back, fails after unwrap_timeout seconds
+so that it does not hold one of the in-flight slots forever.
+"""
+
+import attr
+import sys
+import pickle
+import signal
+import multiprocessing
+
+from zope.interface import implementer
+
+from twisted.internet.interfaces import IReactorThreads
+from twisted.internet import defer
+
+from sphinxmixcrypto import sphinx_packet_unwrap, SphinxPacket, IPacketReplayCache, IncorrectMACError
+
+from txmix.interfaces import IPacketUnwrapper, IEpochKeyState
+from txmix.utils import MixKeyState
+from txmix import metrics
+
+
+@implementer(IPacketReplayCache)
+class ReplayTagRecorder(object):
+    """
+    i am a replay cache which has never seen anything.
+    i remember the tag that sphinx_packet_unwrap sets
+    so that it can be checked against a real replay cache later.
+    """
+
+    def __init__(self):
+        self.tag = None
+
+    def has_seen(self, tag):
+        return False
+
+    def set_seen(self, tag):
+        self.tag = tag
+
+    def flush(self):
+        self.tag = None
+
+
+def live_keys(key_state):
+    """
+    return a sequence of an IKeyState for each key a packet may
+    be encrypted to, the current key first
+    """
+    if IEpochKeyState.providedBy(key_state):
+        return key_state.live_keys()
+    return (key_state,)
+
+
+def unwrap_with_keys(params, replay_cache, keys, sphinx_packet):
+    """
+    unwrap sphinx_packet with the first of keys whose
+    header MAC checks out. a packet encrypted to none
+    of them raises the last key's IncorrectMACError.
+    """
+    for key_state in keys[:-1]:
+        try:
+            return sphinx_packet_unwrap(params, replay_cache, key_state, sphinx_packet)
+        except IncorrectMACError:
+            pass
+    return sphinx_packet_unwrap(params, replay_cache, keys[-1], sphinx_packet)
+
+
+def unwrap_packet(params, replay_cache, key_state, sphinx_packet):
+    """
+    unwrap sphinx_packet with the current key of key_state or,
+    while keys are being rotated, any of its other live keys
+    """
+    return unwrap_with_keys(params, replay_cache, live_keys(key_state), sphinx_packet)
+
+
+def unwrap_raw_packet(params, key_state, raw_sphinx_packet):
+    """
+    decode and unwrap a raw sphinx packet without consulting a replay cache.
+    returns a 2-tuple of the packet's replay tag and the UnwrappedMessage.
+    """
+    tag_recorder = ReplayTagRecorder()
+    sphinx_packet = SphinxPacket.from_raw_bytes(params, raw_sphinx_packet)
+    unwrapped_packet = unwrap_packet(params, tag_recorder, key_state, sphinx_packet)
+    return tag_recorder.tag, unwrapped_packet
+
+
+def _pool_initializer():
+    """
+    workers are forked from a process where twisted has installed
+    its own signal handlers; restore the defaults so that
+    Pool.terminate can stop the workers.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _pool_unwrap(params, key_pairs, raw_sphinx_packet):
+    """
+    i run inside a pool worker process. key_pairs is a list of
+    the live (public_key, private_key) pairs, the current first.
+    i return a 2-tuple of whether the unwrap succeeded and its
+    result or error. exceptions are returned rather than raised
+    because python 2's Pool.apply_async has no error callback,
+    and ones which cannot be pickled are replaced by an
+    UnwrapWorkerError.
+    """
+    try:
+        tag_recorder = ReplayTagRecorder()
+        keys = [MixKeyState(public_key, private_key) for public_key, private_key in key_pairs]
+        sphinx_packet = SphinxPacket.from_raw_bytes(params, raw_sphinx_packet)
+        unwrapped_packet = unwrap_with_keys(params, tag_recorder, keys, sphinx_packet)
+        return True, (tag_recorder.tag, unwrapped_packet)
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = UnwrapWorkerError(repr(e))
+        return False, e
+
+
+# python 3's Pool.apply_async reports results which could not be sent
+# back from the worker to an error callback; python 2 drops them
+_APPLY_ERROR_CALLBACK = sys.version_info[0] >= 3
+
+
+class UnwrapPoolFullError(Exception):
+    """
+    the maximum number of in-flight packets has been reached
+    """
+
+
+class UnwrapWorkerError(Exception):
+    """
+    a pool worker failed to unwrap a packet or to return its result
+    """
+
+
+class UnwrapTimeoutError(UnwrapWorkerError):
+    """
+    no result came back from the pool in time
+    """
+
+
+@implementer(IPacketUnwrapper)
+@attr.s
+class ProcessPoolUnwrapper(object):
+    """
+    i unwrap sphinx packets in a pool of worker processes
+    so that a mix can use more than one cpu core.
+    packets arriving while max_in_flight packets are
+    being unwrapped are dropped with an UnwrapPoolFullError.
+    a packet without a result after unwrap_timeout seconds
+    fails with an UnwrapTimeoutError and frees its slot.
+    """
+
+    reactor = attr.ib(validator=attr.validators.provides(IReactorThreads))
+    pool_size = attr.ib(validator=attr.validators.instance_of(int), default=multiprocessing.cpu_count())
+    max_in_flight = attr.ib(validator=attr.validators.instance_of(int), default=1024)
+    unwrap_timeout = attr.ib(validator=attr.validators.instance_of((int, float)), default=30)
+
+    _pool = None
+
+    def start(self):
+        """
+        start the worker processes if they aren't already running
+        """
+        if self._pool is None:
+            self._in_flight = 0
+            self._pool = multiprocessing.Pool(self.pool_size, initializer=_pool_initializer)
+
+    def stop(self):
+        """
+        terminate the worker processes
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def unwrap(self, params, key_state, raw_sphinx_packet):
+        """
+        returns a deferred which fires with a 2-tuple of the
+        packet's replay tag and the UnwrappedMessage
+        """
+        if self._in_flight >= self.max_in_flight:
+            metrics.UNWRAP_POOL_FULL.inc()
+            return defer.fail(UnwrapPoolFullError())
+        self._in_flight += 1
+        d = defer.Deferred()
+        timeout_call = self.reactor.callLater(self.unwrap_timeout, self._finish, d, (False, UnwrapTimeoutError()))
+
+        def _done(result):
+            # called from the pool's result handler thread
+            self.reactor.callFromThread(self._finish, d, result, timeout_call)
+
+        kwargs = {"callback": _done}
+        if _APPLY_ERROR_CALLBACK:
+            kwargs["error_callback"] = lambda e: _done((False, UnwrapWorkerError(repr(e))))
+        key_pairs = [(key.get_public_key(), key.get_private_key()) for key in live_keys(key_state)]
+        self._pool.apply_async(_pool_unwrap, (params, key_pairs, raw_sphinx_packet), **kwargs)
+        return d
+
+    def _finish(self, d, result, timeout_call=None):
+        if d.called:
+            # the result came back after the packet timed out
+            return
+        if timeout_call is not None:
+            timeout_call.cancel()
+        self._in_flight -= 1
+        ok, value = result
+        if ok:
+            d.callback(value)
+        else:
+            d.errback(value)
@@ -1,7 +1,9 @@
 
 import os
+import time
 import attr
 from zope.interface.declarations import implementer
+from Cryptodome.Cipher import ChaCha20
 
 from sphinxmixcrypto import IReader, IMixPKI, IKeyState, GroupCurve25519, SECURITY_PARAMETER
 
@@ -38,16 +40,22 @@ class MixKeyState(object):
 
 @implementer(IMixPKI)
 class DummyPKI(object):
+    """
+    i am an in memory pki. my version is increased whenever my
+    mix nodes change, so that it can be used to cache them.
+    """
 
     def __init__(self):
         self.node_map = {}
         self.addr_map = {}
         self.client_map = {}
+        self.version = 0
 
     def set(self, node_id, pub_key, addr):
         assert node_id not in self.node_map.keys()
         self.node_map[node_id] = pub_key
         self.addr_map[node_id] = addr
+        self.version += 1
 
     def get(self, node_id):
         return self.node_map[node_id]
@@ -65,7 +73,13 @@ class DummyPKI(object):
         return self.addr_map[node_id]
 
     def rotate(self, node_id, new_pub_key, signature):
-        pass
+        """
+        replace the public key of a mix node. i am a dummy
+        so the signature is not checked.
+        """
+        assert node_id in self.node_map
+        self.node_map[node_id] = new_pub_key
+        self.version += 1
 
 
 def generate_node_keypair(rand_reader):
@@ -88,3 +102,85 @@ class EntropyReader:
 
     def read(self, n):
         return os.urandom(n)
+
+
+if hasattr(os, "register_at_fork"):
+    _forks = [0]
+
+    def _count_fork():
+        _forks[0] += 1
+    os.register_at_fork(after_in_child=_count_fork)
+
+    def _fork_marker():
+        return _forks[0]
+else:
+    # without fork hooks a change of process ID gives the fork away
+    _fork_marker = os.getpid
+
+
+@implementer(IReader)
+class BufferedEntropyReader(object):
+    """
+    i am a csprng which serves reads from blocks of ChaCha20 keystream
+    instead of making a system call for each of them. i am seeded from
+    os.urandom and use fast key erasure: the first 32 bytes of every
+    block become the key of the next, and every range of my block is
+    zeroed as soon as it is copied out, so the bytes already read
+    cannot be recovered from my state. every reseed_interval seconds,
+    and in a child process after a fork, i discard my buffer and
+    reseed from os.urandom so that a child never repeats its parent's
+    output.
+    """
+
+    KEY_SIZE = 32
+
+    def __init__(self, block_size=65536, reseed_interval=300):
+        assert block_size > self.KEY_SIZE
+        self.block_size = block_size
+        self.reseed_interval = reseed_interval
+        self._zeros = b"\x00" * block_size
+        self._block = bytearray(block_size)
+        self._view = memoryview(self._block)
+        self.reseed()
+
+    def reseed(self):
+        """
+        discard my buffer and key and reseed from os.urandom
+        """
+        self._fork_marker = _fork_marker()
+        self._reseed_deadline = time.time() + self.reseed_interval
+        self._key = os.urandom(self.KEY_SIZE)
+        self._refill()
+
+    def _refill(self):
+        ChaCha20.new(key=self._key, nonce=b"\x00" * 8).encrypt(self._zeros, output=self._block)
+        self._key = self._take(0, self.KEY_SIZE)
+
+    def _take(self, offset, end):
+        view = self._view
+        data = view[offset:end].tobytes()
+        view[offset:end] = self._zeros[:end - offset]
+        self._offset = end
+        return data
+
+    def read(self, n):
+        offset = self._offset
+        end = offset + n
+        fresh = _fork_marker() == self._fork_marker and time.time() < self._reseed_deadline
+        if fresh and end <= self.block_size:
+            # _take, inlined as nearly every read is served here
+            view = self._view
+            data = view[offset:end].tobytes()
+            view[offset:end] = self._zeros[:n]
+            self._offset = end
+            return data
+        if not fresh:
+            self.reseed()
+        parts = []
+        while n > 0:
+            if self._offset == self.block_size:
+                self._refill()
+            taken = min(n, self.block_size - self._offset)
+            parts.append(self._take(self._offset, self._offset + taken))
+            n -= taken
+        return b"".join(parts)